@@ -0,0 +1,224 @@
+"""
+Замеры производительности DB-слоя бота на временной базе (боевая economy.db не трогается).
+
+Запуск:
+  python bench.py                  # все замеры
+  python bench.py role-money       # только выбранный
+"""
+import os
+import sys
+import tempfile
+import time
+
+import main
+
+
+def use_temp_db() -> str:
+    """Переключает пул соединений на новую временную базу и создаёт схему."""
+    path = os.path.join(tempfile.mkdtemp(prefix="cwbot-bench-"), "bench.db")
+    if main._db_pool is not None:
+        main._db_pool.close_all()
+    main._db_pool = main.DBPool(path)
+    main.run_migrations()
+    return path
+
+
+def _timed(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+# ======== !add-money-role / !reset-money-role: поштучно vs пакетно ========
+def bench_role_money(members: int = 20_000, per_member_sample: int = 2_000):
+    use_temp_db()
+    guild_id = 1
+    user_ids = list(range(10_000_000, 10_000_000 + members))
+
+    # Поштучный вариант слишком долгий на всю роль — меряем выборку и экстраполируем
+    sample = user_ids[:per_member_sample]
+    t_single = _timed(lambda: [main.update_balance(guild_id, uid, 100) for uid in sample])
+    t_single_full = t_single / len(sample) * members
+
+    st0 = main.db_stats()
+    t_bulk = _timed(main.db_bulk_update_balance, guild_id, user_ids, 100)
+    st1 = main.db_stats()
+    t_reset = _timed(main.db_bulk_set_balance, guild_id, user_ids, 0)
+
+    print(f"[role-money] участников: {members}")
+    print(f"  поштучно update_balance: {t_single * 1000:.0f} мс на {len(sample)} "
+          f"(≈ {t_single_full:.1f} с на всю роль)")
+    print(f"  пакетно db_bulk_update_balance: {t_bulk * 1000:.0f} мс "
+          f"(SQL-выражений: {st1['statements_executed'] - st0['statements_executed']})")
+    print(f"  пакетно db_bulk_set_balance: {t_reset * 1000:.0f} мс")
+    if t_bulk > 0:
+        print(f"  ускорение: ×{t_single_full / t_bulk:.0f}")
+
+
+# ======== Поиск предметов: индекс vs LIKE '%q%' ========
+def bench_item_search(items: int = 10_000, queries: int = 2_000):
+    import random
+    import sqlite3
+
+    rnd = random.Random(42)
+    words = ["меч", "щит", "руда", "слиток", "зелье", "лук", "стрела", "камень",
+             "доска", "ткань", "gold", "iron", "wood", "золото", "сталь", "хлеб"]
+    catalog = [{"id": i, "name": f"{rnd.choice(words)} {rnd.choice(words)} {i}"} for i in range(1, items + 1)]
+    qs = [rnd.choice([
+        lambda it: it["name"],                # точное имя
+        lambda it: it["name"][:4],            # префикс
+        lambda it: it["name"].split()[1],     # подстрока
+        lambda it: str(it["id"]),             # ID
+    ])(rnd.choice(catalog)) for _ in range(queries)]
+
+    start = time.perf_counter()
+    index = main.ItemSearchIndex(catalog)
+    t_build = time.perf_counter() - start
+    t_index = _timed(lambda: [index.search(q) for q in qs])
+
+    # Прежний путь: LIKE по name_lower (полный скан таблицы)
+    conn = sqlite3.connect(":memory:")
+    conn.execute("CREATE TABLE items (guild_id INTEGER, id INTEGER, name TEXT, name_lower TEXT)")
+    conn.executemany("INSERT INTO items VALUES (1, ?, ?, ?)", [(it["id"], it["name"], it["name"].lower()) for it in catalog])
+
+    def like_search(q: str):
+        if q.isdigit():
+            row = conn.execute("SELECT * FROM items WHERE guild_id = 1 AND id = ?", (int(q),)).fetchone()
+            if row:
+                return [row]
+        return conn.execute("SELECT * FROM items WHERE guild_id = 1 AND name_lower LIKE ? LIMIT 10", (f"%{q.lower()}%",)).fetchall()
+
+    t_like = _timed(lambda: [like_search(q) for q in qs])
+    conn.close()
+
+    print(f"[item-search] предметов: {items}, запросов: {queries}")
+    print(f"  построение индекса: {t_build * 1000:.0f} мс")
+    print(f"  индекс: {t_index / queries * 1e6:.1f} мкс/запрос")
+    print(f"  SQL LIKE: {t_like / queries * 1e6:.1f} мкс/запрос")
+
+
+# ======== Нечёткий поиск: триграммы + SequenceMatcher vs полный перебор ========
+def bench_fuzzy(names: int = 5_000, queries: int = 500):
+    import random
+    from difflib import SequenceMatcher
+
+    rnd = random.Random(7)
+    alpha = "абвгдежзийклмнопрстуфхцчшщыэюя"
+    pool = ["".join(rnd.choice(alpha) for _ in range(rnd.randint(5, 14))) for _ in range(names)]
+    qs = []
+    for _ in range(queries):
+        w = list(rnd.choice(pool))
+        w[rnd.randrange(len(w))] = rnd.choice(alpha)  # одна опечатка
+        qs.append("".join(w))
+
+    start = time.perf_counter()
+    fm = main.FuzzyMatcher([(n, n) for n in pool])
+    t_build = time.perf_counter() - start
+
+    lat = []
+    found = 0
+    for q in qs:
+        t0 = time.perf_counter()
+        found += bool(fm.suggest(q))
+        lat.append(time.perf_counter() - t0)
+    lat.sort()
+
+    # Наивный вариант: ratio() со всеми именами
+    t_naive = _timed(lambda: [max(pool, key=lambda n: SequenceMatcher(None, q, n).ratio()) for q in qs[:50]])
+
+    print(f"[fuzzy] имён: {names}, запросов с опечаткой: {queries}")
+    print(f"  построение: {t_build * 1000:.0f} мс, найдено подсказок: {found}/{queries}")
+    print(f"  p50: {lat[len(lat) // 2] * 1e6:.0f} мкс, p99: {lat[int(len(lat) * 0.99)] * 1e6:.0f} мкс, "
+          f"макс: {lat[-1] * 1e6:.0f} мкс (лимит {main.FUZZY_BUDGET_MS:.0f} мс)")
+    print(f"  полный перебор SequenceMatcher: {t_naive / 50 * 1e3:.1f} мс/запрос")
+
+
+# ======== Слушатель бампов: поток обычных сообщений ========
+def bench_bump(messages: int = 100_000, bump_share: float = 0.01):
+    import asyncio
+    import random
+    from types import SimpleNamespace
+
+    import disnake
+
+    use_temp_db()
+    rnd = random.Random(3)
+    bumpers = {uid: SimpleNamespace(id=uid, mention=f"<@{uid}>", display_name=f"bumper{uid}",
+                                    display_avatar=SimpleNamespace(url="https://cdn.invalid/a.png"))
+               for uid in range(20_000, 20_010)}
+    guild = SimpleNamespace(id=1, name="bench", icon=None, get_member=bumpers.get, members=[])
+
+    async def send(*args, **kwargs):
+        return None
+
+    channel = SimpleNamespace(send=send)
+    main.db_set_bump_enabled(guild.id, True)
+    main.db_set_bump_amount(guild.id, 100)
+
+    def bump_embed(bot_id: int) -> disnake.Embed:
+        uid = rnd.choice(list(bumpers))
+        if rnd.random() < 0.5:
+            return disnake.Embed(description="Подождите ещё 3 часа")
+        if bot_id == main.SERVER_MONITORING_BOT_ID:
+            return disnake.Embed(description=f"Server bumped by <@{uid}>")
+        return disnake.Embed(title="Сервер продвинут", description=f"Запущенная команда: /bump\n<@{uid}>")
+
+    # Настоящие snowflake «сейчас»: слушатель не награждает сообщения старше BUMP_AWARD_MAX_AGE_SECONDS
+    base_id = (int(time.time() * 1000) - disnake.utils.DISCORD_EPOCH) << 22
+    stream = []
+    for i in range(messages):
+        if rnd.random() < bump_share:
+            author = SimpleNamespace(id=rnd.choice(sorted(main.SUPPORTED_BUMP_BOT_IDS)), bot=True)
+            stream.append(SimpleNamespace(id=base_id + i, author=author, guild=guild, channel=channel,
+                                          content="", embeds=[bump_embed(author.id)], mentions=[]))
+        else:
+            author = SimpleNamespace(id=10_000 + i % 500, bot=False)
+            stream.append(SimpleNamespace(id=base_id + i, author=author, guild=guild, channel=channel,
+                                          content=f"сообщение {i}", embeds=[], mentions=[]))
+    bumps = [m for m in stream if m.author.id in main.SUPPORTED_BUMP_BOT_IDS]
+    plain = [m for m in stream if m.author.id not in main.SUPPORTED_BUMP_BOT_IDS]
+
+    async def feed(msgs) -> float:
+        start = time.perf_counter()
+        for m in msgs:
+            await main.bump_reward_listener(m)
+        return time.perf_counter() - start
+
+    def reset_awards() -> int:
+        """Снять отметки о наградах, чтобы повторный прогон снова шёл по пути начисления."""
+        with main.db_writer() as conn:
+            n = conn.execute("DELETE FROM bump_reward_awards").rowcount
+            conn.commit()
+        return n
+
+    main._bump_settings_cache.clear()
+    st0 = main.db_stats()
+    t_all = asyncio.run(feed(stream))
+    st1 = main.db_stats()
+    awarded = reset_awards()
+    t_plain = asyncio.run(feed(plain))
+    t_bumps = asyncio.run(feed(bumps))
+    reset_awards()
+
+    print(f"[bump] сообщений: {messages}, от бамп-ботов: {len(bumps)}, наград начислено: {awarded}")
+    print(f"  весь поток: {t_all / messages * 1e9:.0f} нс/сообщение "
+          f"(SQL-выражений: {st1['statements_executed'] - st0['statements_executed']})")
+    print(f"  обычные сообщения: {t_plain / max(1, len(plain)) * 1e9:.0f} нс/сообщение")
+    print(f"  сообщения бамп-ботов (с начислением): {t_bumps / max(1, len(bumps)) * 1e6:.1f} мкс/сообщение")
+
+
+BENCHES = {
+    "role-money": bench_role_money,
+    "item-search": bench_item_search,
+    "fuzzy": bench_fuzzy,
+    "bump": bench_bump,
+}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHES)
+    for name in names:
+        if name not in BENCHES:
+            print(f"Неизвестный замер: {name}. Доступны: {', '.join(BENCHES)}")
+            continue
+        BENCHES[name]()
@@ -0,0 +1,279 @@
+"""
+Нагрузочный прогон команд бота без Discord: настоящие колбэки команд (buy, pay, work,
+collect, shop, leaderboard) вызываются с объектами-заглушками Context/Member/Guild
+на временной базе (боевая economy.db не трогается).
+
+Запуск:
+  python loadtest.py                       # все сценарии, 50 пользователей × 20 команд
+  python loadtest.py buy pay --users 200   # выбранные сценарии
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import main
+from bench import use_temp_db
+
+GUILD_ID = 1
+FIRST_USER_ID = 10_000
+START_BALANCE = 1_000_000
+INCOME_MONEY_ROLE_ID = 500
+INCOME_ITEMS_ROLE_ID = 501
+
+
+# ======== Заглушки объектов Discord ========
+class StubAsset:
+    url = "https://cdn.discordapp.com/embed/avatars/0.png"
+
+
+class StubPermissions:
+    def __init__(self, administrator: bool = False):
+        self.administrator = administrator
+
+
+class StubRole:
+    def __init__(self, guild: "StubGuild", role_id: int, name: str = ""):
+        self.guild = guild
+        self.id = role_id
+        self.name = name or f"role-{role_id}"
+        self.mention = f"<@&{role_id}>"
+        self.members: list["StubMember"] = []
+
+
+class StubMessage:
+    _next_id = 1
+
+    def __init__(self, channel: "StubChannel", content=None, embed=None, view=None):
+        StubMessage._next_id += 1
+        self.id = StubMessage._next_id
+        self.channel = channel
+        self.content = content
+        self.embeds = [embed] if embed is not None else []
+        self.view = view
+
+    async def edit(self, **kwargs):
+        return self
+
+    async def delete(self, **kwargs):
+        return None
+
+    async def add_reaction(self, emoji):
+        return None
+
+
+class StubChannel:
+    def __init__(self, channel_id: int = 1):
+        self.id = channel_id
+        self.mention = f"<#{channel_id}>"
+        self.sent = 0
+
+    async def send(self, content=None, *, embed=None, view=None, **kwargs):
+        self.sent += 1
+        return StubMessage(self, content, embed, view)
+
+
+class StubMember:
+    def __init__(self, guild: "StubGuild", user_id: int, roles: list[StubRole]):
+        self.guild = guild
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.mention = f"<@{user_id}>"
+        self.bot = False
+        self.roles = roles
+        self.display_avatar = StubAsset()
+        self.avatar = None
+        self.guild_permissions = StubPermissions()
+
+    async def add_roles(self, *roles, reason=None):
+        return None
+
+    async def remove_roles(self, *roles, reason=None):
+        return None
+
+    def __str__(self):
+        return self.name
+
+
+class StubGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.name = "Load test"
+        self.icon = None
+        self.owner_id = 0
+        self._members: dict[int, StubMember] = {}
+        self._roles: dict[int, StubRole] = {}
+
+    @property
+    def members(self) -> list[StubMember]:
+        return list(self._members.values())
+
+    @property
+    def roles(self) -> list[StubRole]:
+        return list(self._roles.values())
+
+    def add_role(self, role_id: int) -> StubRole:
+        return self._roles.setdefault(role_id, StubRole(self, role_id))
+
+    def get_member(self, user_id: int):
+        return self._members.get(user_id)
+
+    def get_role(self, role_id: int):
+        return self._roles.get(role_id)
+
+    def get_channel(self, channel_id: int):
+        return None
+
+
+class StubContext:
+    def __init__(self, guild: StubGuild, author: StubMember, channel: StubChannel):
+        self.guild = guild
+        self.author = author
+        self.channel = channel
+        self.bot = main.bot
+        self.prefix = "!"
+        self.message = StubMessage(channel)
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    async def reply(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+
+# ======== Подготовка данных ========
+def seed(users: int) -> tuple[StubGuild, list[StubMember], dict]:
+    use_temp_db()
+    guild = StubGuild(GUILD_ID)
+    channel = StubChannel()
+
+    # роли, которые дают доступ к командам (ALLOWED_*), и доходные роли
+    access_role_ids = set()
+    for name, val in vars(main).items():
+        if name.startswith("ALLOWED_") and isinstance(val, list):
+            access_role_ids |= main.compile_allowed(val).role_ids
+    roles = [guild.add_role(rid) for rid in sorted(access_role_ids | {INCOME_MONEY_ROLE_ID, INCOME_ITEMS_ROLE_ID})]
+
+    members = []
+    for i in range(users):
+        m = StubMember(guild, FIRST_USER_ID + i, roles)
+        guild._members[m.id] = m
+        members.append(m)
+    for r in roles:
+        r.members = members
+
+    conn = main.db_connect()
+    c = conn.cursor()
+    c.executemany("INSERT INTO balances (guild_id, user_id, balance) VALUES (?, ?, ?)",
+                  [(GUILD_ID, m.id, START_BALANCE) for m in members])
+    c.execute("""
+        INSERT INTO items (guild_id, name, name_lower, price, description, buy_price_type, is_listed)
+        VALUES (?, 'Хлеб', 'хлеб', 10, 'Нагрузочный предмет', 'currency', 1)
+    """, (GUILD_ID,))
+    bread_id = c.lastrowid
+    c.executemany("""
+        INSERT INTO items (guild_id, name, name_lower, price, description, buy_price_type, is_listed)
+        VALUES (?, ?, ?, ?, 'Витрина', 'currency', 1)
+    """, [(GUILD_ID, f"Товар {i}", f"товар {i}", 100 + i) for i in range(60)])
+    c.execute("INSERT INTO work_settings (guild_id, min_income, max_income, cooldown_seconds) VALUES (?, 10, 100, 0)",
+              (GUILD_ID,))
+    c.execute("""
+        INSERT INTO role_incomes (guild_id, role_id, income_type, money_amount, items_json, cooldown_seconds)
+        VALUES (?, ?, 'money', 10, NULL, 0), (?, ?, 'items', 0, ?, 0)
+    """, (GUILD_ID, INCOME_MONEY_ROLE_ID, GUILD_ID, INCOME_ITEMS_ROLE_ID,
+          json.dumps([{"item_id": bread_id, "qty": 1}])))
+    conn.commit()
+    conn.close()
+    main.invalidate_item_catalog(GUILD_ID)
+    main.invalidate_leaderboard(GUILD_ID)
+    return guild, members, {"channel": channel}
+
+
+# ======== Сценарии ========
+SCENARIOS = {
+    "buy": lambda ctx, members, i: main.buy_cmd.callback(ctx, raw="1 Хлеб"),
+    "pay": lambda ctx, members, i: main.pay_prefix.callback(ctx, members[(ctx.author.id - FIRST_USER_ID + 1) % len(members)], "5"),
+    "work": lambda ctx, members, i: main.work_cmd.callback(ctx),
+    "collect": lambda ctx, members, i: main.collect_cmd.callback(ctx),
+    "shop": lambda ctx, members, i: main.shop_cmd.callback(ctx, page=1 + i % 12),
+    "leaderboard": lambda ctx, members, i: main.leaderboard_prefix.callback(ctx),
+}
+
+
+def _percentile(sorted_vals: list[float], p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(p / 100 * len(sorted_vals) + 0.5)) - 1))
+    return sorted_vals[k]
+
+
+async def run_scenario(name: str, users: int, ops: int) -> dict:
+    guild, members, env = seed(users)
+    call = SCENARIOS[name]
+    latencies: list[float] = []
+    errors = 0
+
+    async def user_loop(member: StubMember):
+        nonlocal errors
+        ctx = StubContext(guild, member, env["channel"])
+        for i in range(ops):
+            t0 = time.perf_counter()
+            try:
+                await call(ctx, members, i)
+            except Exception as e:
+                errors += 1
+                if errors == 1:
+                    print(f"  [{name}] первая ошибка: {type(e).__name__}: {e}")
+            latencies.append(time.perf_counter() - t0)
+
+    main.flush_balances()
+    st0 = main.db_stats()
+    start = time.perf_counter()
+    await asyncio.gather(*(user_loop(m) for m in members))
+    wall = time.perf_counter() - start
+    main.flush_balances()
+    st1 = main.db_stats()
+
+    latencies.sort()
+    total = len(latencies)
+    return {
+        "scenario": name,
+        "users": users,
+        "ops": total,
+        "errors": errors,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p95_ms": _percentile(latencies, 95) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "commits_per_op": (st1["commits"] - st0["commits"]) / total if total else 0.0,
+        "statements_per_op": (st1["statements_executed"] - st0["statements_executed"]) / total if total else 0.0,
+        "throughput": total / wall if wall > 0 else 0.0,
+    }
+
+
+def print_report(r: dict):
+    print(f"[{r['scenario']}] пользователей: {r['users']}, команд: {r['ops']}, ошибок: {r['errors']}")
+    print(f"  p50 {r['p50_ms']:.1f} мс • p95 {r['p95_ms']:.1f} мс • p99 {r['p99_ms']:.1f} мс")
+    print(f"  коммитов/команду: {r['commits_per_op']:.2f} • SQL/команду: {r['statements_per_op']:.1f}")
+    print(f"  пропускная способность: {r['throughput']:.0f} команд/с")
+
+
+async def _main(names: list[str], users: int, ops: int):
+    main.start_loop_lag_monitor()
+    for name in names:
+        print_report(await run_scenario(name, users, ops))
+    print(f"Задержка event loop: средняя {main.LOOP_LAG_STATS['avg_ms']:.1f} мс, "
+          f"макс. {main.LOOP_LAG_STATS['max_ms']:.0f} мс")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон команд бота")
+    parser.add_argument("scenarios", nargs="*", help=f"сценарии: {', '.join(SCENARIOS)}")
+    parser.add_argument("--users", type=int, default=50, help="одновременных пользователей")
+    parser.add_argument("--ops", type=int, default=20, help="команд на пользователя")
+    args = parser.parse_args()
+
+    unknown = [n for n in args.scenarios if n not in SCENARIOS]
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(unknown)}")
+    asyncio.run(_main(args.scenarios or list(SCENARIOS), args.users, args.ops))
@@ -2,17 +2,24 @@ import disnake
 from disnake.ext import commands
 import sqlite3
 import os
+import tempfile
 import random
 import time
 import json
 import asyncio
+import threading
+import bisect
+import atexit
+import functools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import contextlib
 import re
 import math
 from difflib import SequenceMatcher
 from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Union, Optional
+from typing import Union, Optional, Callable
 from typing import Optional, List
 from datetime import timedelta
 
@@ -57,6 +64,7 @@ ALLOWED_RESET_MONEY = ["Administrator"]
 ALLOWED_ADD_MONEY_ROLE = ["Administrator"]
 ALLOWED_REMOVE_MONEY_ROLE = ["Administrator"]
 ALLOWED_RESET_MONEY_ROLE = ["Administrator"]
+ALLOWED_HISTORY = ["Administrator"]  # кто может смотреть историю операций других участников (свою — все)
 
 # ===== Конфигурация Всемирного банка =====
 # УКАЖИТЕ ID роли Президента ниже:
@@ -80,29 +88,118 @@ ALLOWED_COUNTRY_LIST = []  # список доступен всем
 ALLOWED_REG_COUNTRY = ["Administrator"]
 ALLOWED_UNREG_COUNTRY = ["Administrator"]
 
-def is_user_allowed_for(allowed: list[Union[int, str]], member: disnake.Member) -> bool:
+@dataclass(frozen=True)
+class AllowedRule:
     """
-    Возвращает True, если член сервера имеет доступ на основе списка allowed.
-    allowed: список из чисел (ID ролей) и/или строки "Administrator".
-    Пустой список => доступ всем.
+    Скомпилированный ALLOWED_*: пусто => всем; admin => «Administrator»; role_ids — ID ролей.
+    name — имя настройки («ALLOWED_WORK»), ключ кэша решений; у списков не из модуля пустое.
     """
+    open: bool
+    admin: bool
+    role_ids: frozenset
+    name: str = ""
+
+def compile_allowed(allowed: list[Union[int, str]], name: str = "") -> AllowedRule:
     if not allowed:
-        return True
-    # Разрешить администраторам, если явно указано "Administrator"
-    if any(isinstance(x, str) and x.strip().lower() == "administrator" for x in allowed):
-        if member.guild_permissions.administrator:
-            return True
-    user_role_ids = {r.id for r in member.roles}
+        return AllowedRule(open=True, admin=False, role_ids=frozenset(), name=name)
+    admin = False
+    ids = set()
     for x in allowed:
         if isinstance(x, int):
-            if x in user_role_ids:
-                return True
+            ids.add(x)
         elif isinstance(x, str):
             s = x.strip()
-            if s.isdigit() and int(s) in user_role_ids:
-                return True
-    return False
+            if s.lower() == "administrator":
+                admin = True
+            elif s.isdigit():
+                ids.add(int(s))
+    return AllowedRule(open=False, admin=admin, role_ids=frozenset(ids), name=name)
+
+# id(список) -> (сам список, правило). Заполняется один раз в compile_all_allowed();
+# список храним, чтобы id не совпал с чужим объектом.
+_allowed_rules: dict[int, tuple[list, AllowedRule]] = {}
+
+def get_allowed_rule(allowed: list[Union[int, str]]) -> AllowedRule:
+    entry = _allowed_rules.get(id(allowed))
+    if entry is not None and entry[0] is allowed:
+        return entry[1]
+    # список не из ALLOWED_* модуля: правило без имени, решения по нему не кэшируются
+    return compile_allowed(allowed)
+
+def compile_all_allowed():
+    """
+    Скомпилировать все ALLOWED_* модуля (вызывается из on_ready). Правила компилируются
+    один раз: повторные вызовы после переподключения ничего не меняют.
+    """
+    if _allowed_rules:
+        return
+    _perm_cache.clear()
+    for name, val in list(globals().items()):
+        if name.startswith("ALLOWED_") and isinstance(val, list):
+            _allowed_rules[id(val)] = (val, compile_allowed(val, name))
+
+# Кэш решений: (guild_id, member_id, имя правила) -> (версия гильдии, версия участника, результат).
+# Версии растут на on_guild_role_update/on_guild_role_delete/on_guild_update (гильдия)
+# и on_member_update (участник) — устаревшие решения просто не совпадают по версии.
+PERM_CACHE_MAX = 50_000
+_perm_cache: dict[tuple[int, int, str], tuple[int, int, bool]] = {}
+_perm_guild_version: dict[int, int] = {}
+_perm_member_version: dict[tuple[int, int], int] = {}
+
+def invalidate_perm_guild(guild_id: int):
+    _perm_guild_version[guild_id] = _perm_guild_version.get(guild_id, 0) + 1
+
+def invalidate_perm_member(guild_id: int, member_id: int):
+    key = (guild_id, member_id)
+    _perm_member_version[key] = _perm_member_version.get(key, 0) + 1
 
+def is_user_allowed_for(allowed: list[Union[int, str]], member: disnake.Member) -> bool:
+    """
+    Возвращает True, если член сервера имеет доступ на основе списка allowed.
+    allowed: список из чисел (ID ролей) и/или строки "Administrator".
+    Пустой список => доступ всем.
+    """
+    rule = get_allowed_rule(allowed)
+    if rule.open:
+        return True
+    if not rule.name:
+        return (rule.admin and member.guild_permissions.administrator) or \
+            not rule.role_ids.isdisjoint(r.id for r in member.roles)
+
+    gid = member.guild.id
+    gv = _perm_guild_version.get(gid, 0)
+    mv = _perm_member_version.get((gid, member.id), 0)
+    key = (gid, member.id, rule.name)
+    hit = _perm_cache.get(key)
+    if hit is not None and hit[0] == gv and hit[1] == mv:
+        return hit[2]
+
+    result = (rule.admin and member.guild_permissions.administrator) or \
+        not rule.role_ids.isdisjoint(r.id for r in member.roles)
+
+    if len(_perm_cache) >= PERM_CACHE_MAX:
+        _perm_cache.clear()
+    _perm_cache[key] = (gv, mv, result)
+    return result
+
+@bot.listen("on_member_update")
+async def _perm_on_member_update(before: disnake.Member, after: disnake.Member):
+    if before.roles != after.roles:
+        invalidate_perm_member(after.guild.id, after.id)
+
+@bot.listen("on_guild_role_update")
+async def _perm_on_role_update(before: disnake.Role, after: disnake.Role):
+    if before.permissions != after.permissions:
+        invalidate_perm_guild(after.guild.id)
+
+@bot.listen("on_guild_role_delete")
+async def _perm_on_role_delete(role: disnake.Role):
+    invalidate_perm_guild(role.guild.id)
+
+@bot.listen("on_guild_update")
+async def _perm_on_guild_update(before: disnake.Guild, after: disnake.Guild):
+    if before.owner_id != after.owner_id:
+        invalidate_perm_guild(after.id)
 
 async def ensure_allowed_ctx(ctx: commands.Context, allowed: list[Union[int, str]]) -> bool:
     """Проверяет доступ для автора команды. Возвращает True если доступ разрешён, иначе отправляет сообщение и возвращает False."""
@@ -167,11 +264,238 @@ from typing import List, Tuple, Optional
 def get_db_path():
     return os.path.join(os.path.dirname(__file__), 'economy.db')
 
-def setup_database():
-    conn = sqlite3.connect(get_db_path())
-    cursor = conn.cursor()
+# ======== Пул соединений SQLite ========
+# Раньше каждый хелпер открывал новое соединение и закрывал его после одного запроса.
+# Теперь соединения живут весь процесс: один писатель (все изменения идут через него)
+# и небольшой пул читателей. WAL позволяет читателям не ждать писателя.
+DB_READER_POOL_SIZE = 4
+DB_BUSY_TIMEOUT_MS = 5000
+
+class PooledConnection:
+    """
+    Обёртка над соединением из пула. Ведёт себя как sqlite3.Connection,
+    но close() возвращает соединение в пул (незакоммиченное откатывается, как при закрытии).
+    close() обязан вызвать тот же поток, что взял соединение: писатель держит RLock,
+    поэтому берите соединение через with db_writer()/db_reader() или закрывайте в finally.
+    """
+    __slots__ = ("_pool", "_conn", "_readonly", "_released")
+
+    def __init__(self, pool: "DBPool", conn: sqlite3.Connection, readonly: bool):
+        object.__setattr__(self, "_pool", pool)
+        object.__setattr__(self, "_conn", conn)
+        object.__setattr__(self, "_readonly", readonly)
+        object.__setattr__(self, "_released", False)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        # row_factory и прочие атрибуты ставим на реальное соединение (сбросятся при возврате в пул)
+        setattr(self._conn, name, value)
+
+    def __enter__(self):
+        self._conn.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return self._conn.__exit__(exc_type, exc, tb)
+
+    def close(self):
+        if self._released:
+            return
+        object.__setattr__(self, "_released", True)
+        self._pool._release(self._conn, self._readonly)
+
+
+class DBPool:
+    """Процесс-общий менеджер соединений: один писатель + пул читателей, PRAGMA применяются один раз."""
+
+    def __init__(self, path: str, readers: int = DB_READER_POOL_SIZE):
+        self.path = path
+        self.max_readers = max(0, int(readers))
+        self._lock = threading.Lock()
+        self._writer: Optional[sqlite3.Connection] = None
+        self._writer_lock = threading.RLock()
+        self._writer_depth = 0
+        self._idle_readers: list[sqlite3.Connection] = []
+        self._readers_total = 0
+        self.connections_opened = 0
+        self.statements_executed = 0
+        self.commits = 0
+        self.checkouts = 0
+
+    def _count_statement(self, sql: str):
+        self.statements_executed += 1
+        if sql[:6].upper() == "COMMIT":
+            self.commits += 1
+
+    def _open(self, readonly: bool) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-16000")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        conn.set_trace_callback(self._count_statement)
+        self.connections_opened += 1
+        return conn
+
+    def acquire(self, readonly: bool = False) -> PooledConnection:
+        self.checkouts += 1
+        if readonly:
+            conn = None
+            with self._lock:
+                if self._idle_readers:
+                    conn = self._idle_readers.pop()
+                elif self._readers_total < self.max_readers:
+                    self._readers_total += 1
+                    conn = self._open(readonly=True)
+            if conn is not None:
+                return PooledConnection(self, conn, True)
+            # все читатели заняты — читаем через писателя
+
+        self._writer_lock.acquire()
+        if self._writer is None:
+            self._writer = self._open(readonly=False)
+        self._writer_depth += 1
+        return PooledConnection(self, self._writer, False)
+
+    def _release(self, conn: sqlite3.Connection, readonly: bool):
+        if readonly:
+            with contextlib.suppress(Exception):
+                conn.row_factory = None
+            with self._lock:
+                self._idle_readers.append(conn)
+            return
+
+        try:
+            self._writer_depth -= 1
+            if self._writer_depth == 0:
+                # Поведение как у close(): незакоммиченные изменения не сохраняются
+                with contextlib.suppress(Exception):
+                    if conn.in_transaction:
+                        conn.rollback()
+                with contextlib.suppress(Exception):
+                    conn.row_factory = None
+        finally:
+            self._writer_lock.release()
+
+    def stats(self) -> dict:
+        return {
+            "connections_opened": self.connections_opened,
+            "statements_executed": self.statements_executed,
+            "commits": self.commits,
+            "checkouts": self.checkouts,
+            "readers_open": self._readers_total,
+            "readers_idle": len(self._idle_readers),
+        }
+
+    def close_all(self):
+        with self._lock:
+            for conn in self._idle_readers:
+                with contextlib.suppress(Exception):
+                    conn.close()
+            self._idle_readers.clear()
+            self._readers_total = 0
+        with self._writer_lock:
+            if self._writer is not None:
+                with contextlib.suppress(Exception):
+                    self._writer.close()
+                self._writer = None
+                self._writer_depth = 0
+
+
+_db_pool: Optional[DBPool] = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool() -> DBPool:
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = DBPool(get_db_path())
+    return _db_pool
+
+def db_connect(readonly: bool = False) -> PooledConnection:
+    """Соединение из общего пула вместо sqlite3.connect(get_db_path()). close() возвращает его в пул —
+    только в finally того же потока (см. db_writer/db_reader)."""
+    return get_db_pool().acquire(readonly=readonly)
+
+@contextlib.contextmanager
+def db_writer():
+    """with db_writer() as conn: — соединение писателя, возвращается в пул при выходе из блока."""
+    conn = get_db_pool().acquire(readonly=False)
+    try:
+        yield conn
+    finally:
+        conn.close()
 
-    cursor.execute("""
+@contextlib.contextmanager
+def db_reader():
+    """with db_reader() as conn: — соединение только для чтения (или писатель, если читатели заняты)."""
+    conn = get_db_pool().acquire(readonly=True)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+def db_stats() -> dict:
+    """Счётчики пула: сколько соединений открыто и сколько SQL-выражений выполнено."""
+    return get_db_pool().stats()
+
+# ======== Асинхронный доступ к БД ========
+# Синхронные sqlite3-хелперы, вызванные прямо из async def, блокируют event loop
+# (heartbeat и команды всех серверов ждут fsync). Поэтому работа с БД из обработчиков
+# уходит в отдельный поток: await db_run(get_balance, gid, uid).
+DB_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-db")
+
+async def db_run(func, *args, **kwargs):
+    """Выполнить синхронный DB-хелпер в потоке БД и дождаться результата."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DB_EXECUTOR, functools.partial(func, *args, **kwargs))
+
+# Метрика задержки event loop: насколько позже запланированного просыпается таймер
+LOOP_LAG_INTERVAL = 0.5  # секунд
+LOOP_LAG_STATS = {"last_ms": 0.0, "max_ms": 0.0, "avg_ms": 0.0, "samples": 0}
+_loop_lag_task: Optional[asyncio.Task] = None
+
+async def _loop_lag_monitor():
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag_ms = max(0.0, (loop.time() - start - LOOP_LAG_INTERVAL) * 1000.0)
+        st = LOOP_LAG_STATS
+        st["last_ms"] = lag_ms
+        st["max_ms"] = max(st["max_ms"], lag_ms)
+        # экспоненциальное сглаживание, чтобы не хранить историю
+        st["avg_ms"] = lag_ms if st["samples"] == 0 else st["avg_ms"] * 0.9 + lag_ms * 0.1
+        st["samples"] += 1
+
+def start_loop_lag_monitor():
+    global _loop_lag_task
+    if _loop_lag_task is None or _loop_lag_task.done():
+        _loop_lag_task = asyncio.get_running_loop().create_task(_loop_lag_monitor())
+
+# ======== Миграции схемы ========
+# Схема версионируется через PRAGMA user_version: каждый шаг применяется один раз,
+# все новые шаги — одной транзакцией. run_migrations() вызывается перед bot.run,
+# поэтому переподключения к шлюзу (повторные on_ready) схему не трогают.
+# Шаги идемпотентны (IF NOT EXISTS / проверка колонок) — базы, созданные до появления
+# версий (user_version = 0), доводятся до текущей схемы без потерь.
+
+def _table_columns(c: sqlite3.Cursor, table: str) -> set[str]:
+    c.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in c.fetchall()}
+
+def _migration_base(c: sqlite3.Cursor):
+    c.execute("""
         CREATE TABLE IF NOT EXISTS balances (
             guild_id INTEGER,
             user_id INTEGER,
@@ -180,7 +504,7 @@ def setup_database():
         )
     """)
 
-    cursor.execute("""
+    c.execute("""
         CREATE TABLE IF NOT EXISTS inventories (
             guild_id INTEGER,
             user_id INTEGER,
@@ -191,14 +515,17 @@ def setup_database():
     """)
 
     # Рекомендуемый индекс для быстрых запросов топа по балансу
-    cursor.execute("""
+    c.execute("""
         CREATE INDEX IF NOT EXISTS idx_balances_guild_balance
         ON balances (guild_id, balance DESC)
     """)
+    # Полный порядок топа (balance DESC, user_id) — для keyset-пагинации лидерборда
+    c.execute("""
+        CREATE INDEX IF NOT EXISTS idx_balances_guild_balance_user
+        ON balances (guild_id, balance DESC, user_id)
+    """)
 
-    # УДАЛЕНО: таблица permissions и всё связанное с ней
-
-    cursor.execute("""
+    c.execute("""
         CREATE TABLE IF NOT EXISTS work_settings (
             guild_id INTEGER PRIMARY KEY,
             min_income INTEGER NOT NULL,
@@ -207,7 +534,7 @@ def setup_database():
         )
     """)
 
-    cursor.execute("""
+    c.execute("""
         CREATE TABLE IF NOT EXISTS work_cooldowns (
             guild_id INTEGER,
             user_id INTEGER,
@@ -217,7 +544,7 @@ def setup_database():
     """)
 
     # Всемирный банк: комиссия и бюджет
-    cursor.execute("""
+    c.execute("""
         CREATE TABLE IF NOT EXISTS worldbank (
             guild_id INTEGER PRIMARY KEY,
             commission_percent INTEGER NOT NULL,
@@ -226,7 +553,7 @@ def setup_database():
     """)
 
     # Доходные роли: конфигурация
-    cursor.execute("""
+    c.execute("""
         CREATE TABLE IF NOT EXISTS role_incomes (
             guild_id INTEGER,
             role_id INTEGER,
@@ -239,7 +566,7 @@ def setup_database():
     """)
 
     # Доходные роли: кулдауны по пользователю
-    cursor.execute("""
+    c.execute("""
         CREATE TABLE IF NOT EXISTS role_income_cooldowns (
             guild_id INTEGER,
             role_id INTEGER,
@@ -249,14 +576,245 @@ def setup_database():
         )
     """)
 
-# Логи доходных ролей: конфигурация канала логов
-    cursor.execute("""
+    # Логи доходных ролей: конфигурация канала логов
+    c.execute("""
         CREATE TABLE IF NOT EXISTS guild_logs (
             guild_id INTEGER PRIMARY KEY,
             role_income_log_channel_id INTEGER
         )
     """)
 
+def _migration_role_incomes_author(c: sqlite3.Cursor):
+    # кто добавил запись и когда
+    cols = _table_columns(c, "role_incomes")
+    if "created_by" not in cols:
+        c.execute("ALTER TABLE role_incomes ADD COLUMN created_by INTEGER")
+    if "created_ts" not in cols:
+        c.execute("ALTER TABLE role_incomes ADD COLUMN created_ts INTEGER")
+
+def _migration_shop(c: sqlite3.Cursor):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            name_lower TEXT,
+            price INTEGER DEFAULT 0,
+            sell_price INTEGER,
+            description TEXT,
+            buy_price_type TEXT DEFAULT 'currency',   -- 'currency' | 'items'
+            cost_items TEXT,                          -- JSON: [{"item_id": int, "qty": int}, ...]
+            is_listed INTEGER DEFAULT 1,
+            stock_total INTEGER,
+            restock_per_day INTEGER DEFAULT 0,
+            per_user_daily_limit INTEGER DEFAULT 0,
+            roles_required_buy TEXT,
+            roles_required_sell TEXT,
+            roles_granted_on_buy TEXT,
+            roles_removed_on_buy TEXT,
+            disallow_sell INTEGER DEFAULT 0,
+            license_role_id INTEGER
+        )
+    """)
+
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS export_deals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            seller_id INTEGER NOT NULL,
+            buyer_id INTEGER NOT NULL,
+            item_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            price INTEGER NOT NULL,           -- сумма продажи БЕЗ доставки (то, что получает продавец)
+            delivery INTEGER NOT NULL,        -- 5% от суммы продажи
+            total_paid INTEGER NOT NULL,      -- price + delivery (списать с покупателя)
+            status TEXT NOT NULL,             -- 'pending' | 'accepted' | 'rejected' | 'expired'
+            created_at INTEGER NOT NULL,      -- unix time
+            decided_at INTEGER                -- unix time
+        )
+    """)
+
+    # Старые базы: таблица items без новых колонок
+    cols = _table_columns(c, "items")
+
+    def addcol(name, sql):
+        if name not in cols:
+            c.execute(f"ALTER TABLE items ADD COLUMN {sql}")
+
+    addcol("name_lower", "name_lower TEXT")
+    addcol("sell_price", "sell_price INTEGER")
+    addcol("buy_price_type", "buy_price_type TEXT DEFAULT 'currency'")
+    addcol("cost_items", "cost_items TEXT")
+    addcol("is_listed", "is_listed INTEGER DEFAULT 1")
+    addcol("stock_total", "stock_total INTEGER")
+    addcol("restock_per_day", "restock_per_day INTEGER DEFAULT 0")
+    addcol("per_user_daily_limit", "per_user_daily_limit INTEGER DEFAULT 0")
+    addcol("roles_required_buy", "roles_required_buy TEXT")
+    addcol("roles_required_sell", "roles_required_sell TEXT")
+    addcol("roles_granted_on_buy", "roles_granted_on_buy TEXT")
+    addcol("roles_removed_on_buy", "roles_removed_on_buy TEXT")
+    addcol("disallow_sell", "disallow_sell INTEGER DEFAULT 0")
+    addcol("license_role_id", "license_role_id INTEGER")
+
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS item_shop_state (
+            guild_id INTEGER,
+            item_id INTEGER,
+            current_stock INTEGER,
+            last_restock_ymd TEXT,
+            PRIMARY KEY (guild_id, item_id)
+        )
+    """)
+
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS item_user_daily (
+            guild_id INTEGER,
+            item_id INTEGER,
+            user_id INTEGER,
+            ymd TEXT,
+            used INTEGER DEFAULT 0,
+            PRIMARY KEY (guild_id, item_id, user_id, ymd)
+        )
+    """)
+
+    c.execute("UPDATE items SET name_lower = lower(name) WHERE name_lower IS NULL")
+
+def _migration_countries(c: sqlite3.Cursor):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS countries (
+            guild_id INTEGER,
+            code TEXT,
+            name TEXT NOT NULL,
+            flag TEXT,
+            ruler TEXT,
+            continent TEXT,
+            territory_km2 INTEGER,
+            population INTEGER,
+            sea_access INTEGER,
+            created_by INTEGER,
+            created_ts INTEGER,
+            updated_ts INTEGER,
+            license_role_id INTEGER,
+            PRIMARY KEY (guild_id, code)
+        )
+    """)
+    # Регистрации
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS country_registrations (
+            guild_id INTEGER,
+            code TEXT,
+            user_id INTEGER,
+            registered_ts INTEGER,
+            PRIMARY KEY (guild_id, code),
+            UNIQUE (guild_id, user_id)
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_countries_name ON countries (guild_id, name)")
+    # Старые базы: license_role_id
+    if "license_role_id" not in _table_columns(c, "countries"):
+        c.execute("ALTER TABLE countries ADD COLUMN license_role_id INTEGER")
+
+def _migration_bump(c: sqlite3.Cursor):
+    """Таблицы для настроек и логов наград за бамп."""
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS bump_reward_settings (
+            guild_id INTEGER PRIMARY KEY,
+            enabled INTEGER NOT NULL DEFAULT 0,
+            amount INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS bump_reward_awards (
+            guild_id INTEGER NOT NULL,
+            message_id INTEGER PRIMARY KEY,
+            awarded_user_id INTEGER NOT NULL,
+            awarded_ts INTEGER NOT NULL
+        )
+    """)
+
+def _migration_hot_indexes(c: sqlite3.Cursor):
+    # !collect и автовыплата: все кулдауны участника
+    c.execute("CREATE INDEX IF NOT EXISTS idx_ri_cooldowns_user ON role_income_cooldowns (guild_id, user_id)")
+    # Экспортные сделки по статусу и возрасту (просроченные/очистка)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_export_deals_status ON export_deals (status, created_at)")
+    # Предметы: поиск по имени внутри сервера; имя уникально в пределах сервера
+    c.execute("""
+        SELECT 1 FROM items GROUP BY guild_id, name_lower HAVING COUNT(*) > 1 LIMIT 1
+    """)
+    if c.fetchone() is None:
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_items_guild_name ON items (guild_id, name_lower)")
+    else:
+        print("[schema] в items есть повторяющиеся имена — индекс (guild_id, name_lower) создан неуникальным")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_items_guild_name ON items (guild_id, name_lower)")
+    # Страны: запросы сравнивают upper(code)/lower(name) — обычный индекс по колонке их не покрывает
+    c.execute("CREATE INDEX IF NOT EXISTS idx_countries_code_upper ON countries (guild_id, upper(code))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_countries_name_lower ON countries (guild_id, lower(name))")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_country_reg_code_upper ON country_registrations (guild_id, upper(code))")
+
+def _migration_journal(c: sqlite3.Cursor):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS economy_journal (
+            id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            item_id INTEGER,
+            amount INTEGER NOT NULL,
+            reason TEXT
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_journal_user_ts ON economy_journal (guild_id, user_id, ts, id)")
+
+def _migration_prune_indexes(c: sqlite3.Cursor):
+    # Очистка в db_maintenance: без индексов каждый DELETE — полный скан таблицы.
+    # Для export_deals хватает idx_export_deals_status (status, created_at) из шага 6.
+    c.execute("CREATE INDEX IF NOT EXISTS idx_item_user_daily_ymd ON item_user_daily (ymd)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_bump_awards_ts ON bump_reward_awards (awarded_ts)")
+
+# Порядок менять нельзя, только дописывать в конец: номер шага = user_version после него
+SCHEMA_MIGRATIONS: list[tuple[str, Callable[[sqlite3.Cursor], None]]] = [
+    ("базовые таблицы экономики", _migration_base),
+    ("role_incomes: created_by/created_ts", _migration_role_incomes_author),
+    ("магазин: items, export_deals, склад, дневные лимиты", _migration_shop),
+    ("страны и регистрации", _migration_countries),
+    ("награды за бамп", _migration_bump),
+    ("индексы горячих запросов", _migration_hot_indexes),
+    ("журнал операций экономики", _migration_journal),
+    ("индексы для очистки устаревших строк", _migration_prune_indexes),
+]
+
+def run_migrations() -> int:
+    """Довести схему до последней версии. Возвращает число применённых шагов."""
+    start = time.perf_counter()
+    conn = db_connect()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        current = c.execute("PRAGMA user_version").fetchone()[0]
+        applied = 0
+        for version, (title, step) in enumerate(SCHEMA_MIGRATIONS, start=1):
+            if version <= current:
+                continue
+            t0 = time.perf_counter()
+            step(c)
+            applied += 1
+            print(f"[schema] {version}: {title} — {(time.perf_counter() - t0) * 1000:.1f} мс")
+        if applied:
+            c.execute(f"PRAGMA user_version = {len(SCHEMA_MIGRATIONS)}")
+        conn.commit()
+    except Exception:
+        with contextlib.suppress(Exception):
+            conn.rollback()
+        raise
+    finally:
+        conn.close()
+    if applied:
+        invalidate_item_catalog()
+    print(f"[schema] версия {max(current, len(SCHEMA_MIGRATIONS))}, применено шагов: {applied}, "
+          f"{(time.perf_counter() - start) * 1000:.1f} мс")
+    return applied
+
 MAX_SQL_INT = 9_223_372_036_854_775_807
 MIN_SQL_INT = -9_223_372_036_854_775_808
 
@@ -301,101 +859,533 @@ def safe_int(v: int, *, name: str = "value", min_v: int = 0, max_v: int = MAX_SQ
     return iv
 
 def get_top_balances(guild_id: int, limit: int, offset: int = 0) -> List[Tuple[int, int]]:
-    conn = sqlite3.connect(get_db_path())
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT user_id, balance
-        FROM balances
-        WHERE guild_id = ?
-        ORDER BY balance DESC, user_id ASC
-        LIMIT ? OFFSET ?
-    """, (guild_id, limit, offset))
-    rows = cursor.fetchall()
-    conn.close()
+    flush_balances()
+    with db_reader() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT user_id, balance
+            FROM balances
+            WHERE guild_id = ?
+            ORDER BY balance DESC, user_id ASC
+            LIMIT ? OFFSET ?
+        """, (guild_id, limit, offset))
+        rows = cursor.fetchall()
     return rows
 
 
 def get_balances_count(guild_id: int) -> int:
-    conn = sqlite3.connect(get_db_path())
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM balances WHERE guild_id = ?", (guild_id,))
-    result = cursor.fetchone()
-    total = result[0] if result and result[0] is not None else 0
-    conn.close()
+    flush_balances()
+    with db_reader() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM balances WHERE guild_id = ?", (guild_id,))
+        result = cursor.fetchone()
+        total = result[0] if result and result[0] is not None else 0
     return total
 
-# >>> ДОБАВИТЬ ПОСЛЕ СОЗДАНИЯ ТАБЛИЦ И ПЕРЕД conn.commit()
-def ensure_role_incomes_extra_columns():
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("PRAGMA table_info(role_incomes)")
-    cols = {row[1] for row in c.fetchall()}
+# ======== Лидерборд: keyset-пагинация, снимок для места и кэш имён ========
+LEADERBOARD_TOTAL_TTL = 30           # сек: сколько живёт кэшированное число строк топа
+LEADERBOARD_TOTAL_CACHE_SIZE = 1000  # гильдий в кэше числа строк (LRU)
+LEADERBOARD_NAME_CACHE_SIZE = 5000   # LRU имён пользователей, которых нет в кэше гильдии
 
-    # кто добавил запись и когда
-    if "created_by" not in cols:
-        c.execute("ALTER TABLE role_incomes ADD COLUMN created_by INTEGER")
-    if "created_ts" not in cols:
-        c.execute("ALTER TABLE role_incomes ADD COLUMN created_ts INTEGER")
+# guild_id -> (monotonic-время, число строк balances гильдии)
+_lb_totals: "OrderedDict[int, tuple[float, int]]" = OrderedDict()
+_lb_names: "OrderedDict[int, str]" = OrderedDict()
 
-    conn.commit()
-    conn.close()
+def get_top_balances_after(guild_id: int, limit: int, after: Optional[tuple[int, int]] = None) -> list[tuple[int, int]]:
+    """
+    Страница топа по курсору: after = (balance, user_id) последней строки предыдущей страницы.
+    Без OFFSET: продолжение страницы — два диапазона по индексу (guild_id, balance DESC, user_id),
+    как в leaderboard_rank (условие с OR SQLite ограничивает только по guild_id).
+    """
+    flush_balances()
+    conn = db_connect(readonly=True)
+    try:
+        c = conn.cursor()
+        if after is None:
+            c.execute("""
+                SELECT user_id, balance FROM balances
+                WHERE guild_id = ?
+                ORDER BY balance DESC, user_id ASC
+                LIMIT ?
+            """, (guild_id, limit))
+            return c.fetchall()
+        # остаток строк с тем же балансом, что у курсора
+        c.execute("""
+            SELECT user_id, balance FROM balances
+            WHERE guild_id = ? AND balance = ? AND user_id > ?
+            ORDER BY user_id ASC
+            LIMIT ?
+        """, (guild_id, after[0], after[1], limit))
+        rows = c.fetchall()
+        if len(rows) < limit:
+            c.execute("""
+                SELECT user_id, balance FROM balances
+                WHERE guild_id = ? AND balance < ?
+                ORDER BY balance DESC, user_id ASC
+                LIMIT ?
+            """, (guild_id, after[0], limit - len(rows)))
+            rows += c.fetchall()
+        return rows
+    finally:
+        conn.close()
 
-# вызвать миграцию
-ensure_role_incomes_extra_columns()
+def invalidate_leaderboard(guild_id: Optional[int] = None):
+    if guild_id is None:
+        _lb_totals.clear()
+    else:
+        _lb_totals.pop(guild_id, None)
+
+def leaderboard_total(guild_id: int) -> int:
+    """Число строк топа: COUNT(*) по индексу, кэшируется на LEADERBOARD_TOTAL_TTL."""
+    cached = _lb_totals.get(guild_id)
+    if cached is not None and time.monotonic() - cached[0] < LEADERBOARD_TOTAL_TTL:
+        _lb_totals.move_to_end(guild_id)
+        return cached[1]
+    flush_balances()
+    conn = db_connect(readonly=True)
+    try:
+        total = int(conn.execute("SELECT COUNT(*) FROM balances WHERE guild_id = ?", (guild_id,)).fetchone()[0])
+    finally:
+        conn.close()
+    _lb_totals[guild_id] = (time.monotonic(), total)
+    _lb_totals.move_to_end(guild_id)
+    while len(_lb_totals) > LEADERBOARD_TOTAL_CACHE_SIZE:
+        _lb_totals.popitem(last=False)
+    return total
+
+def leaderboard_rank(guild_id: int, user_id: int) -> int:
+    """Место пользователя: сколько строк выше него — COUNT(*) по idx_balances_guild_balance_user."""
+    # баланс и места считаем по одним и тем же записанным строкам; чтение строку не создаёт
+    flush_balances()
+    conn = db_connect(readonly=True)
+    try:
+        row = conn.execute("SELECT balance FROM balances WHERE guild_id = ? AND user_id = ?",
+                           (guild_id, user_id)).fetchone()
+        balance = int(row[0]) if row else 0
+        # Два диапазона вместо OR: так SQLite идёт по индексу только по строкам выше пользователя
+        above = conn.execute("""
+            SELECT (SELECT COUNT(*) FROM balances WHERE guild_id = ? AND balance > ?)
+                 + (SELECT COUNT(*) FROM balances WHERE guild_id = ? AND balance = ? AND user_id < ?)
+        """, (guild_id, balance, guild_id, balance, user_id)).fetchone()[0]
+    finally:
+        conn.close()
+    return int(above) + 1
+
+NAME_FETCH_CONCURRENCY = 10    # одновременных fetch_user на одну страницу (не меньше размера страницы топа)
+NAME_FETCH_DEADLINE = 1.8      # сек на все запросы страницы: ответ на взаимодействие нужен за 3 с
+NAME_NOT_FOUND_TTL = 3600      # сек: сколько помнить удалённых пользователей (404)
+NAME_NOT_FOUND_MAX = 10000     # при превышении выбрасываются истёкшие, затем самые старые записи
+
+_lb_not_found: dict[int, float] = {}  # user_id -> monotonic-время, когда fetch_user вернул 404
+
+def _lb_not_found_put(user_id: int):
+    now = time.monotonic()
+    _lb_not_found[user_id] = now
+    if len(_lb_not_found) > NAME_NOT_FOUND_MAX:
+        for uid in [u for u, ts in _lb_not_found.items() if now - ts >= NAME_NOT_FOUND_TTL]:
+            del _lb_not_found[uid]
+        # dict хранит порядок вставки — первыми идут самые старые
+        while len(_lb_not_found) > NAME_NOT_FOUND_MAX:
+            del _lb_not_found[next(iter(_lb_not_found))]
+
+def lb_name_get(user_id: int) -> Optional[str]:
+    name = _lb_names.get(user_id)
+    if name is not None:
+        _lb_names.move_to_end(user_id)
+    return name
+
+def lb_name_put(user_id: int, name: str):
+    _lb_names[user_id] = name
+    _lb_names.move_to_end(user_id)
+    while len(_lb_names) > LEADERBOARD_NAME_CACHE_SIZE:
+        _lb_names.popitem(last=False)
+
+async def resolve_user_names(guild: disnake.Guild, user_ids: list[int]) -> dict[int, str]:
+    """
+    Имена для страницы: кэш гильдии -> LRU -> fetch_user.
+    Промахи запрашиваются параллельно (не более NAME_FETCH_CONCURRENCY) с общим сроком
+    NAME_FETCH_DEADLINE: не успевшие показываются как ID. 404 запоминается на NAME_NOT_FOUND_TTL.
+    """
+    names: dict[int, str] = {}
+    missing: list[int] = []
+    now = time.monotonic()
+    for uid in user_ids:
+        member = guild.get_member(uid)
+        if member:
+            names[uid] = member.display_name
+            continue
+        cached = lb_name_get(uid)
+        if cached is not None:
+            names[uid] = cached
+            continue
+        user = bot.get_user(uid)
+        if user is not None:
+            lb_name_put(uid, user.name)
+            names[uid] = user.name
+            continue
+        nf = _lb_not_found.get(uid)
+        if nf is not None:
+            if now - nf < NAME_NOT_FOUND_TTL:
+                continue
+            del _lb_not_found[uid]
+        missing.append(uid)
+
+    if missing:
+        sem = asyncio.Semaphore(NAME_FETCH_CONCURRENCY)
+
+        async def _fetch(uid: int):
+            async with sem:
+                try:
+                    user = await bot.fetch_user(uid)
+                except disnake.NotFound:
+                    _lb_not_found_put(uid)
+                    return
+                except Exception:
+                    return
+            lb_name_put(uid, user.name)
+            names[uid] = user.name
+
+        tasks = [asyncio.ensure_future(_fetch(uid)) for uid in dict.fromkeys(missing)]
+        _done, pending = await asyncio.wait(tasks, timeout=NAME_FETCH_DEADLINE)
+        for t in pending:
+            t.cancel()
+
+    for uid in user_ids:
+        names.setdefault(uid, f"ID {uid}")
+    return names
 
 
 def migrate_roles_columns():
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("SELECT id, roles_required_buy, roles_required_sell, roles_granted_on_buy, roles_removed_on_buy FROM items")
-    rows = c.fetchall()
-    for iid, rb, rs, gb, rm in rows:
-        rb2 = csv_from_ids(parse_roles_field(rb)) or None
-        rs2 = csv_from_ids(parse_roles_field(rs)) or None
-        gb2 = csv_from_ids(parse_roles_field(gb)) or None
-        rm2 = csv_from_ids(parse_roles_field(rm)) or None
-        if (rb2 != (rb or None)) or (rs2 != (rs or None)) or (gb2 != (gb or None)) or (rm2 != (rm or None)):
+    with db_writer() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, roles_required_buy, roles_required_sell, roles_granted_on_buy, roles_removed_on_buy FROM items")
+        rows = c.fetchall()
+        for iid, rb, rs, gb, rm in rows:
+            rb2 = csv_from_ids(parse_roles_field(rb)) or None
+            rs2 = csv_from_ids(parse_roles_field(rs)) or None
+            gb2 = csv_from_ids(parse_roles_field(gb)) or None
+            rm2 = csv_from_ids(parse_roles_field(rm)) or None
+            if (rb2 != (rb or None)) or (rs2 != (rs or None)) or (gb2 != (gb or None)) or (rm2 != (rm or None)):
+                c.execute("""
+                    UPDATE items SET roles_required_buy=?, roles_required_sell=?, roles_granted_on_buy=?, roles_removed_on_buy=?
+                    WHERE id=?
+                """, (rb2, rs2, gb2, rm2, iid))
+        conn.commit()
+    invalidate_item_catalog()
+
+
+# ======== Журнал операций экономики ========
+# Только дописывается: каждая запись балансов/инвентарей/Всемирного банка добавляет
+# строки в economy_journal в той же транзакции, что и само изменение.
+JOURNAL_MONEY = "m"       # amount — изменение баланса
+JOURNAL_MONEY_SET = "s"   # amount — новый баланс (установка значения)
+JOURNAL_ITEM = "i"        # amount — изменение количества предмета item_id
+JOURNAL_BANK = "b"        # amount — изменение бюджета Всемирного банка
+JOURNAL_BANK_USER_ID = 0  # user_id строк Всемирного банка
+JOURNAL_PAGE_SIZE = 15
+
+# (guild_id, user_id, ts, kind, item_id, amount, reason)
+JournalRow = tuple[int, int, int, str, Optional[int], int, Optional[str]]
+
+def journal_row(guild_id: int, user_id: int, kind: str, amount: int,
+                item_id: Optional[int] = None, reason: Optional[str] = None,
+                ts: Optional[int] = None) -> JournalRow:
+    return (guild_id, user_id, int(ts if ts is not None else time.time()), kind, item_id, int(amount), reason)
+
+def _journal(c: sqlite3.Cursor, rows: list[JournalRow]):
+    """Дописать строки журнала на курсоре текущей транзакции (одним executemany)."""
+    if rows:
+        c.executemany("""
+            INSERT INTO economy_journal (guild_id, user_id, ts, kind, item_id, amount, reason)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+
+def _journal_inventory_removal(c: sqlite3.Cursor, where: str, params: tuple, reason: str):
+    """Записать в журнал удаление строк inventories (WHERE where) до самого DELETE."""
+    c.execute(f"""
+        INSERT INTO economy_journal (guild_id, user_id, ts, kind, item_id, amount, reason)
+        SELECT guild_id, user_id, ?, ?, item_id, -quantity, ?
+        FROM inventories WHERE {where} AND quantity != 0
+    """, (int(time.time()), JOURNAL_ITEM, reason, *params))
+
+def db_get_journal_page(guild_id: int, user_id: int, before: Optional[tuple[int, int]] = None,
+                        limit: int = JOURNAL_PAGE_SIZE) -> list[dict]:
+    """
+    Страница истории пользователя, новые сверху. before = (ts, id) последней строки
+    предыдущей страницы — keyset по индексу (guild_id, user_id, ts, id), без OFFSET.
+    """
+    flush_balances()
+    conn = db_connect(readonly=True)
+    try:
+        c = conn.cursor()
+        if before is None:
+            c.execute("""
+                SELECT id, ts, kind, item_id, amount, reason FROM economy_journal
+                WHERE guild_id = ? AND user_id = ?
+                ORDER BY ts DESC, id DESC LIMIT ?
+            """, (guild_id, user_id, limit))
+        else:
             c.execute("""
-                UPDATE items SET roles_required_buy=?, roles_required_sell=?, roles_granted_on_buy=?, roles_removed_on_buy=?
-                WHERE id=?
-            """, (rb2, rs2, gb2, rm2, iid))
-    conn.commit()
-    conn.close()
+                SELECT id, ts, kind, item_id, amount, reason FROM economy_journal
+                WHERE guild_id = ? AND user_id = ? AND (ts, id) < (?, ?)
+                ORDER BY ts DESC, id DESC LIMIT ?
+            """, (guild_id, user_id, before[0], before[1], limit))
+        return [{"id": r[0], "ts": r[1], "kind": r[2], "item_id": r[3], "amount": r[4], "reason": r[5]}
+                for r in c.fetchall()]
+    finally:
+        conn.close()
+
+
+# ======== Отложенная запись балансов (write-behind) ========
+# Опционально: изменения балансов копятся в памяти по (guild_id, user_id) и пишутся
+# одной транзакцией по таймеру или по числу операций. Чтение get_balance учитывает
+# ещё не записанное; агрегирующие запросы (топ, массовые операции) перед выполнением
+# сбрасывают очередь в БД, а атомарные проводки — внутри своей транзакции (flush_balances_into).
+BALANCE_WRITE_BEHIND = False
+BALANCE_FLUSH_INTERVAL_MS = 500   # период фонового сброса
+BALANCE_FLUSH_MAX_OPS = 200       # сброс, если накопилось столько операций
+BALANCE_MAX_UNFLUSHED_MS = 2000   # граница надёжности: старше этого изменения в памяти не живут
+
+class BalanceWriteBehind:
+    """Очередь несохранённых изменений балансов: key -> [set_value | None, delta]."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: dict[tuple[int, int], list] = {}
+        self._journal: list[JournalRow] = []
+        self._ops = 0
+        self._oldest: Optional[float] = None
+        self.flushes = 0
+        self.flushed_rows = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _due(self) -> bool:
+        if self._ops >= BALANCE_FLUSH_MAX_OPS:
+            return True
+        return self._oldest is not None and (time.monotonic() - self._oldest) * 1000 >= BALANCE_MAX_UNFLUSHED_MS
+
+    def _record(self, key: tuple[int, int], set_value: Optional[int], delta: int, jrow: JournalRow):
+        with self._lock:
+            self._journal.append(jrow)
+            entry = self._pending.get(key)
+            if set_value is not None or entry is None:
+                self._pending[key] = [set_value, delta]
+            else:
+                entry[1] += delta
+            self._ops += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            due = self._due()
+        if due:
+            self.flush()
+
+    def add(self, guild_id: int, user_id: int, delta: int, reason: Optional[str] = None):
+        self._record((guild_id, user_id), None, int(delta),
+                     journal_row(guild_id, user_id, JOURNAL_MONEY, delta, reason=reason))
+
+    def set(self, guild_id: int, user_id: int, value: int, reason: Optional[str] = None):
+        self._record((guild_id, user_id), int(value), 0,
+                     journal_row(guild_id, user_id, JOURNAL_MONEY_SET, value, reason=reason))
+
+    def get(self, guild_id: int, user_id: int) -> Optional[tuple[Optional[int], int]]:
+        with self._lock:
+            entry = self._pending.get((guild_id, user_id))
+            return (entry[0], entry[1]) if entry else None
+
+    def _take(self) -> tuple[dict, list]:
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            jrows, self._journal = self._journal, []
+            self._ops = 0
+            self._oldest = None
+        return batch, jrows
+
+    @staticmethod
+    def _write(c: sqlite3.Cursor, batch: dict, jrows: list):
+        c.executemany("""
+            INSERT INTO balances (guild_id, user_id, balance) VALUES (?, ?, ?)
+            ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = excluded.balance
+        """, [(g, u, sv + d) for (g, u), (sv, d) in batch.items() if sv is not None])
+        c.executemany("""
+            INSERT INTO balances (guild_id, user_id, balance) VALUES (?, ?, ?)
+            ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = balance + excluded.balance
+        """, [(g, u, d) for (g, u), (sv, d) in batch.items() if sv is None])
+        _journal(c, jrows)
+
+    def requeue(self, taken: tuple[dict, list]):
+        """Вернуть несохранённое в очередь (поверх того, что успело накопиться)."""
+        batch, jrows = taken
+        with self._lock:
+            self._journal[:0] = jrows
+            for key, (sv, d) in batch.items():
+                newer = self._pending.get(key)
+                if newer is None:
+                    self._pending[key] = [sv, d]
+                elif newer[0] is None:
+                    self._pending[key] = [sv, d + newer[1]]
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+
+    def flush_into(self, c: sqlite3.Cursor) -> Optional[tuple[dict, list]]:
+        """
+        Записать очередь в уже открытую транзакцию вызывающего (писатель у него),
+        чтобы условие balance >= ? видело все изменения до него.
+        Возвращает снятую очередь: при откате транзакции её нужно отдать в requeue().
+        """
+        if not self._pending:
+            return None
+        taken = self._take()
+        if not taken[0]:
+            return None
+        self._write(c, *taken)
+        return taken
+
+    def flush(self) -> int:
+        """Записать накопленное одной транзакцией. Возвращает число строк."""
+        if not self._pending:
+            return 0
+        conn = db_connect()  # держим писателя, пока очередь не записана: чтения не увидят «дыру»
+        try:
+            taken = self._take()
+            if not taken[0]:
+                return 0
+            c = conn.cursor()
+            try:
+                c.execute("BEGIN IMMEDIATE")
+                self._write(c, *taken)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                self.requeue(taken)
+                raise
+            self.flushes += 1
+            self.flushed_rows += len(taken[0])
+            return len(taken[0])
+        finally:
+            conn.close()
+
+balance_cache = BalanceWriteBehind()
+
+def flush_balances() -> int:
+    """Сбросить очередь отложенных балансов (без очереди — ничего не делает)."""
+    return balance_cache.flush() if len(balance_cache) else 0
+
+def flush_balances_into(c: sqlite3.Cursor) -> Optional[tuple[dict, list]]:
+    """Сбросить очередь внутри транзакции вызывающего; при откате — balance_cache.requeue(результат)."""
+    return balance_cache.flush_into(c) if len(balance_cache) else None
 
+_balance_flush_task: Optional[asyncio.Task] = None
+
+async def _balance_flush_loop():
+    while True:
+        await asyncio.sleep(BALANCE_FLUSH_INTERVAL_MS / 1000)
+        if len(balance_cache):
+            try:
+                await db_run(flush_balances)
+            except Exception as e:
+                print(f"[balances] не удалось сохранить балансы: {e}")
+
+def start_balance_flusher():
+    global _balance_flush_task
+    if not BALANCE_WRITE_BEHIND:
+        return
+    if _balance_flush_task is None or _balance_flush_task.done():
+        _balance_flush_task = asyncio.get_running_loop().create_task(_balance_flush_loop())
+
+# при остановке процесса — дописать всё, что осталось в памяти
+atexit.register(flush_balances)
 
 def get_balance(guild_id: int, user_id: int) -> int:
-    conn = sqlite3.connect(get_db_path())
-    cursor = conn.cursor()
-    cursor.execute("SELECT balance FROM balances WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
-    result = cursor.fetchone()
-    if result:
-        balance = result[0]
-    else:
-        cursor.execute("INSERT INTO balances (guild_id, user_id, balance) VALUES (?, ?, ?)", (guild_id, user_id, 0))
+    conn = db_connect()
+    try:
+        pending = balance_cache.get(guild_id, user_id)
+        if pending is not None and pending[0] is not None:
+            return pending[0] + pending[1]
+        cursor = conn.cursor()
+        cursor.execute("SELECT balance FROM balances WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
+        result = cursor.fetchone()
+        if result:
+            balance = result[0]
+        else:
+            cursor.execute("INSERT INTO balances (guild_id, user_id, balance) VALUES (?, ?, ?)", (guild_id, user_id, 0))
+            conn.commit()
+            balance = 0
+        return balance + (pending[1] if pending else 0)
+    finally:
+        conn.close()
+
+def update_balance(guild_id: int, user_id: int, amount: int, reason: Optional[str] = None):
+    if BALANCE_WRITE_BEHIND:
+        balance_cache.add(guild_id, user_id, amount, reason)
+        return
+    with db_writer() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO balances (guild_id, user_id, balance) VALUES (?, ?, ?)
+            ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = balance + ?
+        """, (guild_id, user_id, amount, amount))
+        _journal(cursor, [journal_row(guild_id, user_id, JOURNAL_MONEY, amount, reason=reason)])
+        conn.commit()
+
+def set_balance(guild_id: int, user_id: int, new_balance: int, reason: Optional[str] = None):
+    if BALANCE_WRITE_BEHIND:
+        balance_cache.set(guild_id, user_id, new_balance, reason)
+        return
+    with db_writer() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO balances (guild_id, user_id, balance) VALUES (?, ?, ?)
+            ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = excluded.balance
+        """, (guild_id, user_id, new_balance))
+        _journal(cursor, [journal_row(guild_id, user_id, JOURNAL_MONEY_SET, new_balance, reason=reason)])
+        conn.commit()
+
+# ======== Массовые операции с балансами (по роли) ========
+BULK_CHUNK_SIZE = 1000          # строк на один executemany (между вызовами — отчёт о прогрессе)
+BULK_PROGRESS_THRESHOLD = 2000  # с какого числа участников показывать прогресс в чате
+
+def _bulk_balances(guild_id: int, user_ids: list[int], sql: str, value: int, kind: str,
+                   reason: Optional[str], progress=None) -> int:
+    flush_balances()
+    conn = db_connect()
+    c = conn.cursor()
+    done = 0
+    now = int(time.time())
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        for i in range(0, len(user_ids), BULK_CHUNK_SIZE):
+            chunk = user_ids[i:i + BULK_CHUNK_SIZE]
+            c.executemany(sql, [(guild_id, uid, value) for uid in chunk])
+            _journal(c, [(guild_id, uid, now, kind, None, value, reason) for uid in chunk])
+            done += len(chunk)
+            if progress:
+                progress(done, len(user_ids))
         conn.commit()
-        balance = 0
-    conn.close()
-    return balance
-
-def update_balance(guild_id: int, user_id: int, amount: int):
-    conn = sqlite3.connect(get_db_path())
-    cursor = conn.cursor()
-    cursor.execute("""
+        invalidate_leaderboard(guild_id)
+    finally:
+        with contextlib.suppress(Exception):
+            if conn.in_transaction:
+                conn.rollback()
+        conn.close()
+    return done
+
+def db_bulk_update_balance(guild_id: int, user_ids: list[int], amount: int, progress=None,
+                           reason: Optional[str] = "role") -> int:
+    """update_balance для многих пользователей одной транзакцией. progress(done, total) — по чанкам."""
+    return _bulk_balances(guild_id, list(user_ids), """
         INSERT INTO balances (guild_id, user_id, balance) VALUES (?, ?, ?)
-        ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = balance + ?
-    """, (guild_id, user_id, amount, amount))
-    conn.commit()
-    conn.close()
-
-def set_balance(guild_id: int, user_id: int, new_balance: int):
-    conn = sqlite3.connect(get_db_path())
-    cursor = conn.cursor()
-    cursor.execute("""
+        ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = balance + excluded.balance
+    """, int(amount), JOURNAL_MONEY, reason, progress)
+
+def db_bulk_set_balance(guild_id: int, user_ids: list[int], new_balance: int, progress=None,
+                        reason: Optional[str] = "role") -> int:
+    """set_balance для многих пользователей одной транзакцией."""
+    return _bulk_balances(guild_id, list(user_ids), """
         INSERT INTO balances (guild_id, user_id, balance) VALUES (?, ?, ?)
         ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = excluded.balance
-    """, (guild_id, user_id, new_balance))
-    conn.commit()
-    conn.close()
+    """, int(new_balance), JOURNAL_MONEY_SET, reason, progress)
 
 # >>> ВСТАВИТЬ В БЛОК DB-ХЕЛПЕРОВ (рядом с другими функциями для sqlite)
 
@@ -404,13 +1394,13 @@ def admin_reset_inventories(guild_id: int) -> tuple[int, int]:
     Сбрасывает инвентари всех пользователей: DELETE FROM inventories WHERE guild_id=?
     Возвращает (deleted_rows, users_affected)
     """
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*), COUNT(DISTINCT user_id) FROM inventories WHERE guild_id = ?", (guild_id,))
-    total_rows, users = c.fetchone() or (0, 0)
-    c.execute("DELETE FROM inventories WHERE guild_id = ?", (guild_id,))
-    conn.commit()
-    conn.close()
+    with db_writer() as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*), COUNT(DISTINCT user_id) FROM inventories WHERE guild_id = ?", (guild_id,))
+        total_rows, users = c.fetchone() or (0, 0)
+        _journal_inventory_removal(c, "guild_id = ?", (guild_id,), "admin_reset")
+        c.execute("DELETE FROM inventories WHERE guild_id = ?", (guild_id,))
+        conn.commit()
     return int(total_rows or 0), int(users or 0)
 
 def admin_reset_balances(guild_id: int) -> tuple[int, int, int]:
@@ -418,14 +1408,20 @@ def admin_reset_balances(guild_id: int) -> tuple[int, int, int]:
     Сбрасывает балансы всех пользователей до 0.
     Возвращает (affected_rows, total_rows, sum_before)
     """
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*), COALESCE(SUM(balance),0) FROM balances WHERE guild_id = ?", (guild_id,))
-    total_rows, sum_before = c.fetchone() or (0, 0)
-    c.execute("UPDATE balances SET balance = 0 WHERE guild_id = ? AND balance != 0", (guild_id,))
-    affected = c.rowcount or 0
-    conn.commit()
-    conn.close()
+    flush_balances()
+    with db_writer() as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*), COALESCE(SUM(balance),0) FROM balances WHERE guild_id = ?", (guild_id,))
+        total_rows, sum_before = c.fetchone() or (0, 0)
+        c.execute("""
+            INSERT INTO economy_journal (guild_id, user_id, ts, kind, item_id, amount, reason)
+            SELECT guild_id, user_id, ?, ?, NULL, -balance, 'admin_reset'
+            FROM balances WHERE guild_id = ? AND balance != 0
+        """, (int(time.time()), JOURNAL_MONEY, guild_id))
+        c.execute("UPDATE balances SET balance = 0 WHERE guild_id = ? AND balance != 0", (guild_id,))
+        affected = c.rowcount or 0
+        conn.commit()
+    invalidate_leaderboard(guild_id)
     return int(affected), int(total_rows or 0), int(sum_before or 0)
 
 def admin_reset_worldbank(guild_id: int) -> tuple[int, int]:
@@ -433,15 +1429,16 @@ def admin_reset_worldbank(guild_id: int) -> tuple[int, int]:
     Сбрасывает бюджет Всемирного банка до 0. Комиссию не трогаем.
     Возвращает (before, after)
     """
-    conn = sqlite3.connect(get_db_path())
-    _ensure_worldbank_row(conn, guild_id)
-    c = conn.cursor()
-    c.execute("SELECT bank_balance FROM worldbank WHERE guild_id = ?", (guild_id,))
-    row = c.fetchone()
-    before = int(row[0]) if row else 0
-    c.execute("UPDATE worldbank SET bank_balance = 0 WHERE guild_id = ?", (guild_id,))
-    conn.commit()
-    conn.close()
+    with db_writer() as conn:
+        _ensure_worldbank_row(conn, guild_id)
+        c = conn.cursor()
+        c.execute("SELECT bank_balance FROM worldbank WHERE guild_id = ?", (guild_id,))
+        row = c.fetchone()
+        before = int(row[0]) if row else 0
+        c.execute("UPDATE worldbank SET bank_balance = 0 WHERE guild_id = ?", (guild_id,))
+        if before:
+            _journal(c, [journal_row(guild_id, JOURNAL_BANK_USER_ID, JOURNAL_BANK, -before, reason="admin_reset")])
+        conn.commit()
     return before, 0
 
 def admin_clear_shop(guild_id: int) -> dict:
@@ -453,44 +1450,45 @@ def admin_clear_shop(guild_id: int) -> dict:
       - удаляем сами items.
     Возвращает словарь с подсчитанной статистикой.
     """
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
+    with db_writer() as conn:
+        c = conn.cursor()
 
-    # Сбор статистики до удаления
-    c.execute("SELECT id FROM items WHERE guild_id = ?", (guild_id,))
-    item_ids = [int(r[0]) for r in c.fetchall()]
+        # Сбор статистики до удаления
+        c.execute("SELECT id FROM items WHERE guild_id = ?", (guild_id,))
+        item_ids = [int(r[0]) for r in c.fetchall()]
 
-    stats = {
-        "items": len(item_ids),
-        "inv_rows": 0,
-        "shop_state": 0,
-        "user_daily": 0,
-    }
+        stats = {
+            "items": len(item_ids),
+            "inv_rows": 0,
+            "shop_state": 0,
+            "user_daily": 0,
+        }
 
-    if item_ids:
-        # Сколько записей инвентарей будет удалено
-        placeholders = ",".join("?" for _ in item_ids)
-        c.execute(f"SELECT COUNT(*) FROM inventories WHERE guild_id = ? AND item_id IN ({placeholders})", (guild_id, *item_ids))
-        stats["inv_rows"] = int(c.fetchone()[0] or 0)
+        if item_ids:
+            # Сколько записей инвентарей будет удалено
+            placeholders = ",".join("?" for _ in item_ids)
+            c.execute(f"SELECT COUNT(*) FROM inventories WHERE guild_id = ? AND item_id IN ({placeholders})", (guild_id, *item_ids))
+            stats["inv_rows"] = int(c.fetchone()[0] or 0)
 
-        # Удалить инвентари по этим предметам
-        c.execute(f"DELETE FROM inventories WHERE guild_id = ? AND item_id IN ({placeholders})", (guild_id, *item_ids))
+            # Удалить инвентари по этим предметам
+            _journal_inventory_removal(c, f"guild_id = ? AND item_id IN ({placeholders})", (guild_id, *item_ids), "clear_shop")
+            c.execute(f"DELETE FROM inventories WHERE guild_id = ? AND item_id IN ({placeholders})", (guild_id, *item_ids))
 
-    # Состояние магазина
-    c.execute("SELECT COUNT(*) FROM item_shop_state WHERE guild_id = ?", (guild_id,))
-    stats["shop_state"] = int(c.fetchone()[0] or 0)
-    c.execute("DELETE FROM item_shop_state WHERE guild_id = ?", (guild_id,))
+        # Состояние магазина
+        c.execute("SELECT COUNT(*) FROM item_shop_state WHERE guild_id = ?", (guild_id,))
+        stats["shop_state"] = int(c.fetchone()[0] or 0)
+        c.execute("DELETE FROM item_shop_state WHERE guild_id = ?", (guild_id,))
 
-    # Дневные лимиты
-    c.execute("SELECT COUNT(*) FROM item_user_daily WHERE guild_id = ?", (guild_id,))
-    stats["user_daily"] = int(c.fetchone()[0] or 0)
-    c.execute("DELETE FROM item_user_daily WHERE guild_id = ?", (guild_id,))
+        # Дневные лимиты
+        c.execute("SELECT COUNT(*) FROM item_user_daily WHERE guild_id = ?", (guild_id,))
+        stats["user_daily"] = int(c.fetchone()[0] or 0)
+        c.execute("DELETE FROM item_user_daily WHERE guild_id = ?", (guild_id,))
 
-    # Удалить сами предметы
-    c.execute("DELETE FROM items WHERE guild_id = ?", (guild_id,))
+        # Удалить сами предметы
+        c.execute("DELETE FROM items WHERE guild_id = ?", (guild_id,))
 
-    conn.commit()
-    conn.close()
+        conn.commit()
+    invalidate_item_catalog(guild_id)
     return stats
 
 def admin_clear_role_incomes(guild_id: int) -> tuple[int, int]:
@@ -498,18 +1496,17 @@ def admin_clear_role_incomes(guild_id: int) -> tuple[int, int]:
     Удаляет все доходные роли и их кулдауны для гильдии.
     Возвращает (roles_deleted, cooldown_rows_deleted)
     """
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("SELECT COUNT(*) FROM role_incomes WHERE guild_id = ?", (guild_id,))
-    roles_deleted = int(c.fetchone()[0] or 0)
-    c.execute("DELETE FROM role_incomes WHERE guild_id = ?", (guild_id,))
+    with db_writer() as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM role_incomes WHERE guild_id = ?", (guild_id,))
+        roles_deleted = int(c.fetchone()[0] or 0)
+        c.execute("DELETE FROM role_incomes WHERE guild_id = ?", (guild_id,))
 
-    c.execute("SELECT COUNT(*) FROM role_income_cooldowns WHERE guild_id = ?", (guild_id,))
-    cds_deleted = int(c.fetchone()[0] or 0)
-    c.execute("DELETE FROM role_income_cooldowns WHERE guild_id = ?", (guild_id,))
+        c.execute("SELECT COUNT(*) FROM role_income_cooldowns WHERE guild_id = ?", (guild_id,))
+        cds_deleted = int(c.fetchone()[0] or 0)
+        c.execute("DELETE FROM role_income_cooldowns WHERE guild_id = ?", (guild_id,))
 
-    conn.commit()
-    conn.close()
+        conn.commit()
     return roles_deleted, cds_deleted
 
 # ======== Всемирный банк: функции БД ========
@@ -523,93 +1520,149 @@ def _ensure_worldbank_row(conn, guild_id: int):
         conn.commit()
 
 def get_worldbank(guild_id: int) -> tuple[int, int]:
-    conn = sqlite3.connect(get_db_path())
-    _ensure_worldbank_row(conn, guild_id)
-    c = conn.cursor()
-    c.execute("SELECT commission_percent, bank_balance FROM worldbank WHERE guild_id = ?", (guild_id,))
-    row = c.fetchone()
-    conn.close()
+    with db_writer() as conn:
+        _ensure_worldbank_row(conn, guild_id)
+        c = conn.cursor()
+        c.execute("SELECT commission_percent, bank_balance FROM worldbank WHERE guild_id = ?", (guild_id,))
+        row = c.fetchone()
     if not row:
         return DEFAULT_COMMISSION_PERCENT, 0
     return int(row[0]), int(row[1])
 
 def set_commission_percent(guild_id: int, percent: int):
-    conn = sqlite3.connect(get_db_path())
-    _ensure_worldbank_row(conn, guild_id)
-    c = conn.cursor()
-    c.execute("UPDATE worldbank SET commission_percent = ? WHERE guild_id = ?", (percent, guild_id))
-    conn.commit()
-    conn.close()
+    with db_writer() as conn:
+        _ensure_worldbank_row(conn, guild_id)
+        c = conn.cursor()
+        c.execute("UPDATE worldbank SET commission_percent = ? WHERE guild_id = ?", (percent, guild_id))
+        conn.commit()
 
-def change_worldbank_balance(guild_id: int, delta: int) -> bool:
-    conn = sqlite3.connect(get_db_path())
-    _ensure_worldbank_row(conn, guild_id)
-    c = conn.cursor()
-    c.execute("SELECT bank_balance FROM worldbank WHERE guild_id = ?", (guild_id,))
-    row = c.fetchone()
-    cur = int(row[0]) if row else 0
-    new_val = cur + int(delta)
-    if new_val < 0:
-        conn.close()
-        return False
-    c.execute("UPDATE worldbank SET bank_balance = ? WHERE guild_id = ?", (new_val, guild_id))
-    conn.commit()
-    conn.close()
+def change_worldbank_balance(guild_id: int, delta: int, reason: Optional[str] = None) -> bool:
+    with db_writer() as conn:
+        _ensure_worldbank_row(conn, guild_id)
+        c = conn.cursor()
+        c.execute("SELECT bank_balance FROM worldbank WHERE guild_id = ?", (guild_id,))
+        row = c.fetchone()
+        cur = int(row[0]) if row else 0
+        new_val = cur + int(delta)
+        if new_val < 0:
+            return False
+        c.execute("UPDATE worldbank SET bank_balance = ? WHERE guild_id = ?", (new_val, guild_id))
+        _journal(c, [journal_row(guild_id, JOURNAL_BANK_USER_ID, JOURNAL_BANK, delta, reason=reason)])
+        conn.commit()
     return True
 
 def get_worldbank_balance(guild_id: int) -> int:
     return get_worldbank(guild_id)[1]
 
+# ======== Переводы: атомарная проводка ========
+@dataclass
+class TransferResult:
+    ok: bool
+    reason: Optional[str] = None                          # 'funds' | 'items' при ok=False
+    balances: dict[int, int] = field(default_factory=dict)  # user_id -> баланс после проводки
+    lacking: Optional[dict] = None                        # {"user_id", "item_id", "qty", "have"} при reason='items'
 
-def setup_country_tables():
-    conn = sqlite3.connect(get_db_path())
+def db_ledger_transfer(
+    guild_id: int,
+    debit_user_id: int,
+    debit_amount: int,
+    credits: list[tuple[int, int]] = (),
+    *,
+    to_worldbank: int = 0,
+    item_moves: list[tuple[int, int, int, int]] = (),
+    reason: Optional[str] = "transfer",
+) -> TransferResult:
+    """
+    Денежная проводка одной транзакцией:
+      - списание debit_amount с debit_user_id (условие balance >= сумма прямо в UPDATE);
+      - зачисления credits [(user_id, amount)];
+      - комиссия to_worldbank в бюджет Всемирного банка;
+      - перемещения предметов item_moves [(from_user_id, to_user_id, item_id, qty)].
+    Либо применяется всё (один commit), либо ничего; строки журнала — в той же транзакции.
+    """
+    res = TransferResult(ok=False)
+    now = int(time.time())
+    jrows: list[JournalRow] = []
+    pending = None
+    conn = db_connect()
     c = conn.cursor()
-    # Базовое создание
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS countries (
-            guild_id INTEGER,
-            code TEXT,
-            name TEXT NOT NULL,
-            flag TEXT,
-            ruler TEXT,
-            continent TEXT,
-            territory_km2 INTEGER,
-            population INTEGER,
-            sea_access INTEGER,
-            created_by INTEGER,
-            created_ts INTEGER,
-            updated_ts INTEGER,
-            license_role_id INTEGER,
-            PRIMARY KEY (guild_id, code)
-        )
-    """)
-    # Регистрации
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS country_registrations (
-            guild_id INTEGER,
-            code TEXT,
-            user_id INTEGER,
-            registered_ts INTEGER,
-            PRIMARY KEY (guild_id, code),
-            UNIQUE (guild_id, user_id)
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        # отложенные балансы — в этой же транзакции, до условных UPDATE
+        pending = flush_balances_into(c)
+
+        for from_uid, to_uid, iid, qty in item_moves:
+            c.execute("""
+                UPDATE inventories SET quantity = quantity - ?
+                WHERE guild_id = ? AND user_id = ? AND item_id = ? AND quantity >= ?
+            """, (qty, guild_id, from_uid, iid, qty))
+            if c.rowcount == 0:
+                c.execute("SELECT quantity FROM inventories WHERE guild_id = ? AND user_id = ? AND item_id = ?",
+                          (guild_id, from_uid, iid))
+                row = c.fetchone()
+                res.reason = "items"
+                res.lacking = {"user_id": from_uid, "item_id": iid, "qty": qty, "have": int(row[0]) if row else 0}
+                return res
+            c.execute("DELETE FROM inventories WHERE guild_id = ? AND user_id = ? AND item_id = ? AND quantity <= 0",
+                      (guild_id, from_uid, iid))
+            c.execute("""
+                INSERT INTO inventories (guild_id, user_id, item_id, quantity)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(guild_id, user_id, item_id) DO UPDATE SET
+                    quantity = inventories.quantity + excluded.quantity
+            """, (guild_id, to_uid, iid, qty))
+            jrows.append((guild_id, from_uid, now, JOURNAL_ITEM, iid, -qty, reason))
+            jrows.append((guild_id, to_uid, now, JOURNAL_ITEM, iid, qty, reason))
+
+        if debit_amount > 0:
+            c.execute("""
+                UPDATE balances SET balance = balance - ?
+                WHERE guild_id = ? AND user_id = ? AND balance >= ?
+            """, (debit_amount, guild_id, debit_user_id, debit_amount))
+            if c.rowcount == 0:
+                c.execute("SELECT balance FROM balances WHERE guild_id = ? AND user_id = ?", (guild_id, debit_user_id))
+                row = c.fetchone()
+                res.reason = "funds"
+                res.balances[debit_user_id] = int(row[0]) if row else 0
+                return res
+            jrows.append((guild_id, debit_user_id, now, JOURNAL_MONEY, None, -debit_amount, reason))
+
+        for uid, amount in credits:
+            if amount == 0:
+                continue
+            c.execute("""
+                INSERT INTO balances (guild_id, user_id, balance) VALUES (?, ?, ?)
+                ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = balance + excluded.balance
+            """, (guild_id, uid, amount))
+            jrows.append((guild_id, uid, now, JOURNAL_MONEY, None, amount, reason))
+
+        if to_worldbank > 0:
+            c.execute("INSERT OR IGNORE INTO worldbank (guild_id, commission_percent, bank_balance) VALUES (?, ?, 0)",
+                      (guild_id, DEFAULT_COMMISSION_PERCENT))
+            c.execute("UPDATE worldbank SET bank_balance = bank_balance + ? WHERE guild_id = ?", (to_worldbank, guild_id))
+            jrows.append((guild_id, JOURNAL_BANK_USER_ID, now, JOURNAL_BANK, None, to_worldbank, reason))
+        _journal(c, jrows)
+
+        uids = list(dict.fromkeys([debit_user_id, *(uid for uid, _ in credits)]))
+        c.execute(
+            f"SELECT user_id, balance FROM balances WHERE guild_id = ? AND user_id IN ({','.join('?' * len(uids))})",
+            (guild_id, *uids)
         )
-    """)
-    c.execute("CREATE INDEX IF NOT EXISTS idx_countries_name ON countries (guild_id, name)")
-    # Миграция license_role_id
-    c.execute("PRAGMA table_info(countries)")
-    cols = {row[1] for row in c.fetchall()}
-    if "license_role_id" not in cols:
-        c.execute("ALTER TABLE countries ADD COLUMN license_role_id INTEGER")
-    conn.commit()
-    conn.close()
+        res.balances = {uid: 0 for uid in uids}
+        res.balances.update({int(uid): int(bal) for uid, bal in c.fetchall()})
+
+        conn.commit()
+        res.ok = True
+        return res
+    finally:
+        if not res.ok:
+            with contextlib.suppress(Exception):
+                conn.rollback()
+            if pending:
+                balance_cache.requeue(pending)
+        conn.close()
 
 
-@bot.listen("on_ready")
-async def _countries_reviews_on_ready():
-    setup_country_tables()
-    print("Таблицы стран и отзывов готовы.")
-    
-    
 CONTINENTS = [
     "Африка",
     "Антарктида",
@@ -623,29 +1676,119 @@ CONTINENTS = [
 def _now_ts() -> int:
     return int(time.time())
 
+# ======== Нечёткий поиск («возможно, вы имели в виду») ========
+# Триграммы с отступами по краям дают кандидатов даже для коротких слов и опечаток
+# в начале/конце ("мечь" ~ "меч"). SequenceMatcher считается только для короткого списка
+# лучших кандидатов и с ограничением по времени на запрос.
+FUZZY_SHORTLIST = 40       # сколько кандидатов из триграмм проверять SequenceMatcher-ом
+FUZZY_MIN_RATIO = 0.6      # порог похожести
+FUZZY_BUDGET_MS = 5.0      # лимит CPU на один запрос
+
+def _fuzzy_grams(s: str) -> set[str]:
+    s = f"  {s} "
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+class FuzzyMatcher:
+    """Подбор похожих строк: [(ключ, payload)] -> suggest(query)."""
+
+    def __init__(self, entries: list[tuple[str, object]]):
+        self._keys: list[str] = []
+        self._payloads: list[object] = []
+        self._grams: dict[str, list[int]] = {}
+        for key, payload in entries:
+            k = (key or "").strip().lower()
+            if not k:
+                continue
+            idx = len(self._keys)
+            self._keys.append(k)
+            self._payloads.append(payload)
+            for g in _fuzzy_grams(k):
+                self._grams.setdefault(g, []).append(idx)
+
+    def suggest(self, query: str, limit: int = 3, min_ratio: float = FUZZY_MIN_RATIO) -> list:
+        q = (query or "").strip().lower()
+        if not q or not self._keys:
+            return []
+        deadline = time.perf_counter() + FUZZY_BUDGET_MS / 1000
+
+        # 1) кандидаты: больше общих триграмм — раньше в очереди
+        counts: dict[int, int] = {}
+        for g in _fuzzy_grams(q):
+            for idx in self._grams.get(g, ()):
+                counts[idx] = counts.get(idx, 0) + 1
+        shortlist = sorted(counts, key=counts.__getitem__, reverse=True)[:FUZZY_SHORTLIST]
+
+        # 2) точная оценка; дешёвые верхние границы отсекают заведомо далёкие
+        sm = SequenceMatcher(autojunk=False)
+        sm.set_seq2(q)
+        scored: list[tuple[float, int]] = []
+        for idx in shortlist:
+            sm.set_seq1(self._keys[idx])
+            if sm.real_quick_ratio() < min_ratio or sm.quick_ratio() < min_ratio:
+                continue
+            r = sm.ratio()
+            if r >= min_ratio:
+                scored.append((r, idx))
+            if time.perf_counter() > deadline:
+                break
+
+        scored.sort(key=lambda x: (-x[0], self._keys[x[1]]))
+        out, seen = [], set()
+        for _r, idx in scored:
+            p = self._payloads[idx]
+            if id(p) in seen:
+                continue
+            seen.add(id(p))
+            out.append(p)
+            if len(out) >= limit:
+                break
+        return out
+
+_country_fuzzy: dict[int, FuzzyMatcher] = {}
+
+def invalidate_country_fuzzy(guild_id: int):
+    _country_fuzzy.pop(guild_id, None)
+
+def country_suggest(guild_id: int, query: str, limit: int = 3) -> list[dict]:
+    """Похожие страны по названию или коду (для подсказки при опечатке)."""
+    fm = _country_fuzzy.get(guild_id)
+    if fm is None:
+        entries = []
+        for row in countries_list_all(guild_id):
+            entries.append((row.get("name"), row))
+            entries.append((row.get("code"), row))
+        fm = _country_fuzzy[guild_id] = FuzzyMatcher(entries)
+    return fm.suggest(query, limit=limit)
+
+def country_not_found_text(guild_id: int, query: str, base: str) -> str:
+    """Текст ошибки «не найдено» + «возможно, вы имели в виду …», если есть похожие."""
+    sugg = country_suggest(guild_id, query)
+    if not sugg:
+        return base
+    opts = ", ".join(f"{(r.get('flag') or '').strip()} {r['name']} ({r['code']})".strip() for r in sugg)
+    return f"{base}\nВозможно, вы имели в виду: {opts}"
+
 def country_get_by_code_or_name(guild_id: int, code_or_name: str) -> Optional[dict]:
     if not code_or_name:
         return None
     q = code_or_name.strip()
-    conn = sqlite3.connect(get_db_path())
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    # Сначала точный код (верхний регистр)
-    c.execute("SELECT * FROM countries WHERE guild_id=? AND upper(code)=upper(?)", (guild_id, q))
-    row = c.fetchone()
-    if not row:
-        # По имени (LIKE, без учета регистра)
-        c.execute("SELECT * FROM countries WHERE guild_id=? AND lower(name)=lower(?)", (guild_id, q))
+    with db_reader() as conn:
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        # Сначала точный код (верхний регистр)
+        c.execute("SELECT * FROM countries WHERE guild_id=? AND upper(code)=upper(?)", (guild_id, q))
         row = c.fetchone()
-    conn.close()
+        if not row:
+            # По имени (LIKE, без учета регистра)
+            c.execute("SELECT * FROM countries WHERE guild_id=? AND lower(name)=lower(?)", (guild_id, q))
+            row = c.fetchone()
     return dict(row) if row else None
 
 def country_exists_code(guild_id: int, code: str) -> bool:
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("SELECT 1 FROM countries WHERE guild_id=? AND upper(code)=upper(?)", (guild_id, code.strip()))
-    ok = c.fetchone() is not None
-    conn.close()
+    with db_reader() as conn:
+        c = conn.cursor()
+        c.execute("SELECT 1 FROM countries WHERE guild_id=? AND upper(code)=upper(?)", (guild_id, code.strip()))
+        ok = c.fetchone() is not None
     return ok
 
 def country_insert_or_update(
@@ -663,49 +1806,45 @@ def country_insert_or_update(
     license_role_id: Optional[int] = None
 ) -> tuple[bool, str | None]:
     code = code.strip().upper()
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    ts = _now_ts()
-    try:
-        if old_code is None:
-            if country_exists_code(guild_id, code):
-                conn.close()
-                return False, "Страна с таким кодом уже существует."
-            c.execute("""
-                INSERT INTO countries
-                (guild_id, code, name, flag, ruler, continent, territory_km2, population, sea_access,
-                 created_by, created_ts, updated_ts, license_role_id)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (guild_id, code, name, flag, ruler, continent, territory_km2, population, 1 if sea_access else 0,
-                  actor_id, ts, ts, license_role_id))
-            conn.commit()
-        else:
-            # проверка смены кода
-            if old_code.strip().upper() != code and country_exists_code(guild_id, code):
-                conn.close()
-                return False, "Новый код уже занят другой страной."
-            c.execute("""
-                UPDATE countries
-                   SET code=?, name=?, flag=?, ruler=?, continent=?, territory_km2=?, population=?,
-                       sea_access=?, updated_ts=?, license_role_id=?
-                 WHERE guild_id=? AND upper(code)=upper(?)
-            """, (code, name, flag, ruler, continent, territory_km2, population,
-                  1 if sea_access else 0, ts, license_role_id, guild_id, old_code.strip().upper()))
-            if c.rowcount == 0:
-                conn.close()
-                return False, "Страна для редактирования не найдена."
-            if old_code.strip().upper() != code:
+    with db_writer() as conn:
+        c = conn.cursor()
+        ts = _now_ts()
+        try:
+            if old_code is None:
+                if country_exists_code(guild_id, code):
+                    return False, "Страна с таким кодом уже существует."
                 c.execute("""
-                    UPDATE country_registrations
-                       SET code=?
+                    INSERT INTO countries
+                    (guild_id, code, name, flag, ruler, continent, territory_km2, population, sea_access,
+                     created_by, created_ts, updated_ts, license_role_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """, (guild_id, code, name, flag, ruler, continent, territory_km2, population, 1 if sea_access else 0,
+                      actor_id, ts, ts, license_role_id))
+                conn.commit()
+            else:
+                # проверка смены кода
+                if old_code.strip().upper() != code and country_exists_code(guild_id, code):
+                    return False, "Новый код уже занят другой страной."
+                c.execute("""
+                    UPDATE countries
+                       SET code=?, name=?, flag=?, ruler=?, continent=?, territory_km2=?, population=?,
+                           sea_access=?, updated_ts=?, license_role_id=?
                      WHERE guild_id=? AND upper(code)=upper(?)
-                """, (code, guild_id, old_code.strip().upper()))
-            conn.commit()
-    except Exception as e:
-        conn.rollback()
-        conn.close()
-        return False, f"Ошибка базы данных: {e}"
-    conn.close()
+                """, (code, name, flag, ruler, continent, territory_km2, population,
+                      1 if sea_access else 0, ts, license_role_id, guild_id, old_code.strip().upper()))
+                if c.rowcount == 0:
+                    return False, "Страна для редактирования не найдена."
+                if old_code.strip().upper() != code:
+                    c.execute("""
+                        UPDATE country_registrations
+                           SET code=?
+                         WHERE guild_id=? AND upper(code)=upper(?)
+                    """, (code, guild_id, old_code.strip().upper()))
+                conn.commit()
+        except Exception as e:
+            conn.rollback()
+            return False, f"Ошибка базы данных: {e}"
+    invalidate_country_fuzzy(guild_id)
     return True, None
 
 # === НОРМАЛИЗАЦИЯ ФЛАГОВ ===
@@ -738,19 +1877,17 @@ def normalize_flag_emoji(flag_raw: str, code_hint: Optional[str] = None) -> str:
     return s
 
 def country_get_registration_for_user(guild_id: int, user_id: int) -> Optional[str]:
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("SELECT code FROM country_registrations WHERE guild_id=? AND user_id=?", (guild_id, user_id))
-    row = c.fetchone()
-    conn.close()
+    with db_reader() as conn:
+        c = conn.cursor()
+        c.execute("SELECT code FROM country_registrations WHERE guild_id=? AND user_id=?", (guild_id, user_id))
+        row = c.fetchone()
     return row[0] if row else None
 
 def country_get_occupant(guild_id: int, code: str) -> Optional[int]:
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("SELECT user_id FROM country_registrations WHERE guild_id=? AND upper(code)=upper(?)", (guild_id, code.strip().upper()))
-    row = c.fetchone()
-    conn.close()
+    with db_reader() as conn:
+        c = conn.cursor()
+        c.execute("SELECT user_id FROM country_registrations WHERE guild_id=? AND upper(code)=upper(?)", (guild_id, code.strip().upper()))
+        row = c.fetchone()
     return int(row[0]) if row else None
 
 def country_delete(guild_id: int, code_or_name: str) -> tuple[bool, str | None, Optional[str]]:
@@ -761,29 +1898,27 @@ def country_delete(guild_id: int, code_or_name: str) -> tuple[bool, str | None,
     if not info:
         return False, "Страна не найдена.", None
     code = info["code"]
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    try:
-        c.execute("DELETE FROM country_registrations WHERE guild_id=? AND upper(code)=upper(?)", (guild_id, code))
-        c.execute("DELETE FROM countries WHERE guild_id=? AND upper(code)=upper(?)", (guild_id, code))
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        conn.close()
-        return False, f"Ошибка удаления: {e}", None
-    conn.close()
+    with db_writer() as conn:
+        c = conn.cursor()
+        try:
+            c.execute("DELETE FROM country_registrations WHERE guild_id=? AND upper(code)=upper(?)", (guild_id, code))
+            c.execute("DELETE FROM countries WHERE guild_id=? AND upper(code)=upper(?)", (guild_id, code))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            return False, f"Ошибка удаления: {e}", None
+    invalidate_country_fuzzy(guild_id)
     return True, None, code
 
 def countries_list_all(guild_id: int) -> list[dict]:
-    conn = sqlite3.connect(get_db_path())
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute("SELECT * FROM countries WHERE guild_id=? ORDER BY name COLLATE NOCASE", (guild_id,))
-    rows = [dict(r) for r in c.fetchall()]
-    # Подтянем регистрации
-    c.execute("SELECT code, user_id FROM country_registrations WHERE guild_id=?", (guild_id,))
-    reg = {(r[0] or "").upper(): int(r[1]) for r in c.fetchall()}
-    conn.close()
+    with db_reader() as conn:
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        c.execute("SELECT * FROM countries WHERE guild_id=? ORDER BY name COLLATE NOCASE", (guild_id,))
+        rows = [dict(r) for r in c.fetchall()]
+        # Подтянем регистрации
+        c.execute("SELECT code, user_id FROM country_registrations WHERE guild_id=?", (guild_id,))
+        reg = {(r[0] or "").upper(): int(r[1]) for r in c.fetchall()}
     for r in rows:
         r["registered_user_id"] = reg.get((r["code"] or "").upper())
     return rows
@@ -793,48 +1928,41 @@ def country_register_user(guild_id: int, code: str, user_id: int) -> tuple[bool,
     # Проверим, что страна есть
     if not country_exists_code(guild_id, code):
         return False, "Страна с таким кодом не найдена."
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    try:
-        # Пользователь не должен быть уже зарегистрирован на другую страну
-        c.execute("SELECT code FROM country_registrations WHERE guild_id=? AND user_id=?", (guild_id, user_id))
-        row = c.fetchone()
-        if row:
-            conn.close()
-            return False, f"Пользователь уже зарегистрирован на страну с кодом {row[0]}."
-        # Страна не должна быть занята
-        c.execute("SELECT user_id FROM country_registrations WHERE guild_id=? AND upper(code)=upper(?)", (guild_id, code))
-        row = c.fetchone()
-        if row:
-            conn.close()
-            return False, "Эта страна уже занята другим пользователем."
-        c.execute("INSERT INTO country_registrations (guild_id, code, user_id, registered_ts) VALUES (?, ?, ?, ?)",
-                  (guild_id, code, user_id, _now_ts()))
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        conn.close()
-        return False, f"Ошибка базы данных: {e}"
-    conn.close()
+    with db_writer() as conn:
+        c = conn.cursor()
+        try:
+            # Пользователь не должен быть уже зарегистрирован на другую страну
+            c.execute("SELECT code FROM country_registrations WHERE guild_id=? AND user_id=?", (guild_id, user_id))
+            row = c.fetchone()
+            if row:
+                return False, f"Пользователь уже зарегистрирован на страну с кодом {row[0]}."
+            # Страна не должна быть занята
+            c.execute("SELECT user_id FROM country_registrations WHERE guild_id=? AND upper(code)=upper(?)", (guild_id, code))
+            row = c.fetchone()
+            if row:
+                return False, "Эта страна уже занята другим пользователем."
+            c.execute("INSERT INTO country_registrations (guild_id, code, user_id, registered_ts) VALUES (?, ?, ?, ?)",
+                      (guild_id, code, user_id, _now_ts()))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            return False, f"Ошибка базы данных: {e}"
     return True, None
 
 def country_unregister_user(guild_id: int, user_id: int) -> tuple[bool, str | None, Optional[str]]:
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("SELECT code FROM country_registrations WHERE guild_id=? AND user_id=?", (guild_id, user_id))
-    row = c.fetchone()
-    if not row:
-        conn.close()
-        return False, "Этот пользователь не зарегистрирован ни на одну страну.", None
-    code = row[0]
-    try:
-        c.execute("DELETE FROM country_registrations WHERE guild_id=? AND user_id=?", (guild_id, user_id))
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        conn.close()
-        return False, f"Ошибка базы данных: {e}", None
-    conn.close()
+    with db_writer() as conn:
+        c = conn.cursor()
+        c.execute("SELECT code FROM country_registrations WHERE guild_id=? AND user_id=?", (guild_id, user_id))
+        row = c.fetchone()
+        if not row:
+            return False, "Этот пользователь не зарегистрирован ни на одну страну.", None
+        code = row[0]
+        try:
+            c.execute("DELETE FROM country_registrations WHERE guild_id=? AND user_id=?", (guild_id, user_id))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            return False, f"Ошибка базы данных: {e}", None
     return True, None, code
 
 from dataclasses import dataclass
@@ -902,7 +2030,7 @@ class CountryCodeModal(disnake.ui.Modal):
         if not re.fullmatch(r"[A-ZА-ЯЁ]{2,8}", code):
             return await inter.response.send_message(embed=error_embed("Ошибка", "Код должен состоять из 2–8 букв."), ephemeral=True)
         # Если создаём новую — проверим уникальность сразу
-        if self.view_ref.draft.editing_code is None and country_exists_code(inter.guild.id, code):
+        if self.view_ref.draft.editing_code is None and await db_run(country_exists_code, inter.guild.id, code):
             return await inter.response.send_message(embed=error_embed("Ошибка", "Страна с таким кодом уже существует."), ephemeral=True)
         self.view_ref.draft.code = code
         await inter.response.edit_message(embed=self.view_ref.build_embed(), view=self.view_ref)
@@ -1137,11 +2265,10 @@ class CountryWizard(disnake.ui.View):
         # Если уже есть регистрация — покажем, кто привязан
         if self.draft.editing_code:
             # Найдем пользователя, зарегистрированного на эту страну
-            conn = sqlite3.connect(get_db_path())
-            c = conn.cursor()
-            c.execute("SELECT user_id FROM country_registrations WHERE guild_id=? AND upper(code)=upper(?)", (self.ctx.guild.id, self.draft.editing_code))
-            row = c.fetchone()
-            conn.close()
+            with db_reader() as conn:
+                c = conn.cursor()
+                c.execute("SELECT user_id FROM country_registrations WHERE guild_id=? AND upper(code)=upper(?)", (self.ctx.guild.id, self.draft.editing_code))
+                row = c.fetchone()
             if row:
                 user = self.ctx.guild.get_member(int(row[0]))
                 e.add_field(name="Пользователь", value=(user.mention if user else f"<@{row[0]}>"), inline=False)
@@ -1218,7 +2345,8 @@ class CountryWizard(disnake.ui.View):
         ]):
             return await inter.response.send_message(embed=error_embed("Ошибка", "Заполните все параметры перед сохранением."), ephemeral=True)
 
-        ok, err = country_insert_or_update(
+        ok, err = await db_run(
+            country_insert_or_update,
             guild_id=inter.guild.id,
             old_code=d.editing_code,
             code=d.code,
@@ -1361,9 +2489,9 @@ async def edit_country_cmd(ctx: commands.Context, *, code_or_name: str):
         return
     if not ctx.guild:
         return await ctx.send("Команда доступна только на сервере.")
-    info = country_get_by_code_or_name(ctx.guild.id, code_or_name)
+    info = await db_run(country_get_by_code_or_name, ctx.guild.id, code_or_name)
     if not info:
-        return await ctx.send(embed=error_embed("Не найдено", f"Страна «{code_or_name}» не найдена."))
+        return await ctx.send(embed=error_embed("Не найдено", await db_run(country_not_found_text, ctx.guild.id, code_or_name, f"Страна «{code_or_name}» не найдена.")))
     view = CountryWizard(ctx, existing=info)
     emb = view.build_embed()
     msg = await ctx.send(embed=emb, view=view)
@@ -1375,9 +2503,9 @@ async def delete_country_cmd(ctx: commands.Context, *, code_or_name: str):
         return
     if not ctx.guild:
         return await ctx.send("Команда доступна только на сервере.")
-    info = country_get_by_code_or_name(ctx.guild.id, code_or_name)
+    info = await db_run(country_get_by_code_or_name, ctx.guild.id, code_or_name)
     if not info:
-        return await ctx.send(embed=error_embed("Не найдено", f"Страна «{code_or_name}» не найдена."))
+        return await ctx.send(embed=error_embed("Не найдено", await db_run(country_not_found_text, ctx.guild.id, code_or_name, f"Страна «{code_or_name}» не найдена.")))
     warn = disnake.Embed(
         title="Удаление страны",
         description=f"Вы уверены, что хотите удалить {info.get('flag') or ''} {info['name']} ({info['code']})?\nВведите в чат: удалить",
@@ -1398,7 +2526,7 @@ async def delete_country_cmd(ctx: commands.Context, *, code_or_name: str):
         with contextlib.suppress(Exception):
             await prompt.delete()
         return await ctx.send("Время на подтверждение истекло.", delete_after=10)
-    ok, err, del_code = country_delete(ctx.guild.id, code_or_name)
+    ok, err, del_code = await db_run(country_delete, ctx.guild.id, code_or_name)
     if not ok:
         return await ctx.send(embed=error_embed("Ошибка", err or "Не удалось удалить."))
     done = disnake.Embed(title="✅ Удалено", description=f"Страна ({info['flag']}) {info['name']} ({info['code']}) удалена.", color=disnake.Color.green())
@@ -1473,7 +2601,7 @@ async def country_list_cmd(ctx: commands.Context):
         return
     if not ctx.guild:
         return await ctx.send("Команда доступна только на сервере.")
-    data = countries_list_all(ctx.guild.id)
+    data = await db_run(countries_list_all, ctx.guild.id)
     view = CountryListView(ctx, data)
     emb = view.build_embed()
     msg = await ctx.send(embed=emb, view=view)
@@ -1486,14 +2614,14 @@ async def reg_country_cmd(ctx: commands.Context, member: disnake.Member, code: s
     if not ctx.guild:
         return await ctx.send("Команда доступна только на сервере.")
 
-    info = country_get_by_code_or_name(ctx.guild.id, code)
+    info = await db_run(country_get_by_code_or_name, ctx.guild.id, code)
     if not info:
-        return await ctx.send(embed=error_embed("Ошибка", "Страна с таким кодом не найдена."))
+        return await ctx.send(embed=error_embed("Ошибка", await db_run(country_not_found_text, ctx.guild.id, code, "Страна с таким кодом не найдена.")))
 
     # Проверка: пользователь уже зарегистрирован?
-    existing_code = country_get_registration_for_user(ctx.guild.id, member.id)
+    existing_code = await db_run(country_get_registration_for_user, ctx.guild.id, member.id)
     if existing_code:
-        ex = country_get_by_code_or_name(ctx.guild.id, existing_code)
+        ex = await db_run(country_get_by_code_or_name, ctx.guild.id, existing_code)
         flag = ex.get("flag") or ""
         name = ex.get("name") or existing_code
         code_up = ex.get("code") or existing_code
@@ -1505,7 +2633,7 @@ async def reg_country_cmd(ctx: commands.Context, member: disnake.Member, code: s
         )
 
     # Проверка: страна занята?
-    occupant_id = country_get_occupant(ctx.guild.id, info["code"])
+    occupant_id = await db_run(country_get_occupant, ctx.guild.id, info["code"])
     if occupant_id:
         occ_member = ctx.guild.get_member(int(occupant_id))
         flag = info.get("flag") or ""
@@ -1519,7 +2647,7 @@ async def reg_country_cmd(ctx: commands.Context, member: disnake.Member, code: s
         )
 
     # Регистрируем
-    ok, err = country_register_user(ctx.guild.id, info["code"], member.id)
+    ok, err = await db_run(country_register_user, ctx.guild.id, info["code"], member.id)
     if not ok:
         return await ctx.send(embed=error_embed("Регистрация не выполнена", err or "Ошибка"))
 
@@ -1568,7 +2696,7 @@ async def unreg_country_cmd(ctx: commands.Context, member: disnake.Member):
         return
     if not ctx.guild:
         return await ctx.send("Команда доступна только на сервере.")
-    ok, err, code = country_unregister_user(ctx.guild.id, member.id)
+    ok, err, code = await db_run(country_unregister_user, ctx.guild.id, member.id)
     if not ok:
         return await ctx.send(embed=error_embed("Снятие не выполнено", err or "Ошибка"))
     e = disnake.Embed(title="✅ Снятие с страны", description=f"{member.mention} снят(а) с регистрации.", color=disnake.Color.green())
@@ -1580,7 +2708,7 @@ async def unreg_country_cmd(ctx: commands.Context, member: disnake.Member):
 async def country_user_cmd(ctx: commands.Context, member: disnake.Member):
     if not ctx.guild:
         return await ctx.send("Команда доступна только на сервере.")
-    code = country_get_registration_for_user(ctx.guild.id, member.id)
+    code = await db_run(country_get_registration_for_user, ctx.guild.id, member.id)
     if not code:
         e = disnake.Embed(
             title="Информация о стране пользователя",
@@ -1589,7 +2717,7 @@ async def country_user_cmd(ctx: commands.Context, member: disnake.Member):
         )
         e.set_author(name=ctx.guild.name, icon_url=getattr(ctx.guild.icon, "url", None))
         return await ctx.send(embed=e)
-    info = country_get_by_code_or_name(ctx.guild.id, code)
+    info = await db_run(country_get_by_code_or_name, ctx.guild.id, code)
     if not info:
         return await ctx.send(embed=error_embed("Ошибка", "Данные страны не найдены."))
     sea = _fmt_bool(bool(info.get("sea_access"))) if info.get("sea_access") is not None else "—"
@@ -1612,82 +2740,6 @@ async def country_user_cmd(ctx: commands.Context, member: disnake.Member):
 # ============================================
 
 
-def setup_shop_tables():
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS export_deals (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            guild_id INTEGER NOT NULL,
-            seller_id INTEGER NOT NULL,
-            buyer_id INTEGER NOT NULL,
-            item_id INTEGER NOT NULL,
-            quantity INTEGER NOT NULL,
-            price INTEGER NOT NULL,           -- сумма продажи БЕЗ доставки (то, что получает продавец)
-            delivery INTEGER NOT NULL,        -- 5% от суммы продажи
-            total_paid INTEGER NOT NULL,      -- price + delivery (списать с покупателя)
-            status TEXT NOT NULL,             -- 'pending' | 'accepted' | 'rejected' | 'expired'
-            created_at INTEGER NOT NULL,      -- unix time
-            decided_at INTEGER                -- unix time
-        )
-    """)
-
-    c.execute("PRAGMA table_info(items)")
-    cols = {row[1] for row in c.fetchall()}
-
-    def addcol(name, sql):
-        if name not in cols:
-            c.execute(f"ALTER TABLE items ADD COLUMN {sql}")
-
-    addcol("name_lower", "name_lower TEXT")
-    addcol("sell_price", "sell_price INTEGER")
-    addcol("buy_price_type", "buy_price_type TEXT DEFAULT 'currency'")
-    addcol("cost_items", "cost_items TEXT")
-    addcol("is_listed", "is_listed INTEGER DEFAULT 1")
-    addcol("stock_total", "stock_total INTEGER")
-    addcol("restock_per_day", "restock_per_day INTEGER DEFAULT 0")
-    addcol("per_user_daily_limit", "per_user_daily_limit INTEGER DEFAULT 0")
-    addcol("roles_required_buy", "roles_required_buy TEXT")
-    addcol("roles_required_sell", "roles_required_sell TEXT")
-    addcol("roles_granted_on_buy", "roles_granted_on_buy TEXT")
-    addcol("roles_removed_on_buy", "roles_removed_on_buy TEXT")
-    addcol("disallow_sell", "disallow_sell INTEGER DEFAULT 0")
-    addcol("license_role_id", "license_role_id INTEGER")  # <<< НОВОЕ
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS item_shop_state (
-            guild_id INTEGER,
-            item_id INTEGER,
-            current_stock INTEGER,
-            last_restock_ymd TEXT,
-            PRIMARY KEY (guild_id, item_id)
-        )
-    """)
-
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS item_user_daily (
-            guild_id INTEGER,
-            item_id INTEGER,
-            user_id INTEGER,
-            ymd TEXT,
-            used INTEGER DEFAULT 0,
-            PRIMARY KEY (guild_id, item_id, user_id, ymd)
-        )
-    """)
-
-    c.execute("UPDATE items SET name_lower = lower(name) WHERE name_lower IS NULL")
-
-    conn.commit()
-    conn.close()
-
-
-@bot.listen("on_ready")
-async def _shop_on_ready():
-    setup_shop_tables()
-    print("Таблицы магазина готовы.")
-
-
 def _item_row_to_dict(row) -> Optional[dict]:
     if not row:
         return None
@@ -1817,140 +2869,236 @@ def ensure_item_normalized(item: dict) -> dict:
     return item
 
 def get_item_by_name(guild_id: int, name: str) -> Optional[dict]:
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute(f"""
-        SELECT
-            id, guild_id, name, name_lower, price, sell_price, description,
-            buy_price_type, cost_items, is_listed, stock_total, restock_per_day,
-            per_user_daily_limit, roles_required_buy, roles_required_sell,
-            roles_granted_on_buy, roles_removed_on_buy, disallow_sell, license_role_id
-        FROM items
-        WHERE guild_id = ? AND name_lower = ?
-    """, (guild_id, (name or "").strip().lower()))
-    row = c.fetchone()
-    conn.close()
+    with db_reader() as conn:
+        c = conn.cursor()
+        c.execute(f"""
+            SELECT
+                id, guild_id, name, name_lower, price, sell_price, description,
+                buy_price_type, cost_items, is_listed, stock_total, restock_per_day,
+                per_user_daily_limit, roles_required_buy, roles_required_sell,
+                roles_granted_on_buy, roles_removed_on_buy, disallow_sell, license_role_id
+            FROM items
+            WHERE guild_id = ? AND name_lower = ?
+        """, (guild_id, (name or "").strip().lower()))
+        row = c.fetchone()
     return _item_row_to_dict(row)
 
 def suggest_items(guild_id: int, query: str, limit: int = 5) -> list[str]:
-    """Простые подсказки по подстроке (регистронезависимо)."""
-    q = f"%{(query or '').strip().lower()}%"
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""
-        SELECT name FROM items
-        WHERE guild_id = ? AND name_lower LIKE ?
-        ORDER BY name LIMIT ?
-    """, (guild_id, q, limit))
-    result = [r[0] for r in c.fetchall()]
-    conn.close()
-    return result
+    """Подсказки: совпадения по имени/подстроке, затем похожие (с опечатками)."""
+    found = [it["name"] for it in search_items_by_name_or_id(guild_id, query)[:limit]]
+    if len(found) < limit:
+        for it in get_item_fuzzy(guild_id).suggest(query, limit=limit):
+            if it["name"] not in found:
+                found.append(it["name"])
+    return found[:limit]
+
+# ======== Кэш каталога предметов ========
+# Нормализованные предметы гильдии + карта id -> name. Сбрасывается при любом изменении
+# таблицы items (мастер создания/редактирования, удаление, очистка магазина).
+# Словари предметов из кэша общие — их нельзя менять на месте (ensure_item_normalized делает копию).
+_item_catalog: dict[int, dict] = {}
+_item_catalog_versions: dict[int, int] = {}
+ITEM_CATALOG_STATS = {"hits": 0, "misses": 0, "invalidations": 0}
+
+def item_catalog_version(guild_id: int) -> int:
+    return _item_catalog_versions.get(guild_id, 0)
+
+def invalidate_item_catalog(guild_id: Optional[int] = None):
+    """Сбросить кэш каталога гильдии (или всех гильдий, если guild_id=None)."""
+    ITEM_CATALOG_STATS["invalidations"] += 1
+    gids = list(_item_catalog) if guild_id is None else [guild_id]
+    if guild_id is None:
+        gids += list(_item_catalog_versions)
+    for gid in set(gids):
+        _item_catalog_versions[gid] = _item_catalog_versions.get(gid, 0) + 1
+        _item_catalog.pop(gid, None)
+
+def get_item_catalog(guild_id: int) -> dict:
+    """{"items": [нормализованные dict по name_lower], "by_id": {id: item}, "id2name": {id: name}}"""
+    cat = _item_catalog.get(guild_id)
+    if cat is not None:
+        ITEM_CATALOG_STATS["hits"] += 1
+        return cat
+    ITEM_CATALOG_STATS["misses"] += 1
+    version = item_catalog_version(guild_id)
+    items = _load_items_db(guild_id)
+    cat = {
+        "items": items,
+        "by_id": {it["id"]: it for it in items},
+        "id2name": {it["id"]: it["name"] for it in items},
+    }
+    # если пока читали, каталог успели изменить — не кладём устаревшее
+    if item_catalog_version(guild_id) == version:
+        _item_catalog[guild_id] = cat
+    return cat
 
 def list_items_db(guild_id: int) -> list[dict]:
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""
-        SELECT
-            id, guild_id, name, name_lower, price, sell_price, description,
-            buy_price_type, cost_items, is_listed, stock_total, restock_per_day,
-            per_user_daily_limit, roles_required_buy, roles_required_sell,
-            roles_granted_on_buy, roles_removed_on_buy, disallow_sell, license_role_id
-        FROM items
-        WHERE guild_id = ?
-        ORDER BY name_lower
-    """, (guild_id,))
-    rows = c.fetchall()
-    conn.close()
+    return list(get_item_catalog(guild_id)["items"])
+
+def item_names_map(guild_id: int) -> dict[int, str]:
+    return get_item_catalog(guild_id)["id2name"]
+
+def _load_items_db(guild_id: int) -> list[dict]:
+    with db_reader() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT
+                id, guild_id, name, name_lower, price, sell_price, description,
+                buy_price_type, cost_items, is_listed, stock_total, restock_per_day,
+                per_user_daily_limit, roles_required_buy, roles_required_sell,
+                roles_granted_on_buy, roles_removed_on_buy, disallow_sell, license_role_id
+            FROM items
+            WHERE guild_id = ?
+            ORDER BY name_lower
+        """, (guild_id,))
+        rows = c.fetchall()
     return [_item_row_to_dict(r) for r in rows]
 
 def get_user_item_qty(guild_id: int, user_id: int, item_id: int) -> int:
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""
-        SELECT quantity FROM inventories
-        WHERE guild_id = ? AND user_id = ? AND item_id = ?
-    """, (guild_id, user_id, item_id))
-    row = c.fetchone()
-    conn.close()
+    with db_reader() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT quantity FROM inventories
+            WHERE guild_id = ? AND user_id = ? AND item_id = ?
+        """, (guild_id, user_id, item_id))
+        row = c.fetchone()
     return int(row[0]) if row else 0
 
-def add_items_to_user(guild_id: int, user_id: int, item_id: int, amount: int):
+def add_items_to_user(guild_id: int, user_id: int, item_id: int, amount: int, reason: Optional[str] = None):
     if amount == 0:
         return
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO inventories (guild_id, user_id, item_id, quantity)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(guild_id, user_id, item_id) DO UPDATE SET
-            quantity = inventories.quantity + excluded.quantity
-    """, (guild_id, user_id, item_id, amount))
-    conn.commit()
-    conn.close()
+    with db_writer() as conn:
+        c = conn.cursor()
+        c.execute("""
+            INSERT INTO inventories (guild_id, user_id, item_id, quantity)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(guild_id, user_id, item_id) DO UPDATE SET
+                quantity = inventories.quantity + excluded.quantity
+        """, (guild_id, user_id, item_id, amount))
+        _journal(c, [journal_row(guild_id, user_id, JOURNAL_ITEM, amount, item_id, reason)])
+        conn.commit()
 
-def remove_items_from_user(guild_id: int, user_id: int, item_id: int, amount: int) -> bool:
+def remove_items_from_user(guild_id: int, user_id: int, item_id: int, amount: int, reason: Optional[str] = None) -> bool:
     if amount <= 0:
         return False
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""
-        SELECT quantity FROM inventories
-        WHERE guild_id = ? AND user_id = ? AND item_id = ?
-    """, (guild_id, user_id, item_id))
-    row = c.fetchone()
-    if not row or row[0] < amount:
-        conn.close()
-        return False
-    new_q = row[0] - amount
-    if new_q == 0:
-        c.execute("DELETE FROM inventories WHERE guild_id = ? AND user_id = ? AND item_id = ?",
-                  (guild_id, user_id, item_id))
-    else:
+    with db_writer() as conn:
+        c = conn.cursor()
         c.execute("""
-            UPDATE inventories
-            SET quantity = ?
+            SELECT quantity FROM inventories
             WHERE guild_id = ? AND user_id = ? AND item_id = ?
-        """, (new_q, guild_id, user_id, item_id))
-    conn.commit()
-    conn.close()
+        """, (guild_id, user_id, item_id))
+        row = c.fetchone()
+        if not row or row[0] < amount:
+            return False
+        new_q = row[0] - amount
+        if new_q == 0:
+            c.execute("DELETE FROM inventories WHERE guild_id = ? AND user_id = ? AND item_id = ?",
+                      (guild_id, user_id, item_id))
+        else:
+            c.execute("""
+                UPDATE inventories
+                SET quantity = ?
+                WHERE guild_id = ? AND user_id = ? AND item_id = ?
+            """, (new_q, guild_id, user_id, item_id))
+        _journal(c, [journal_row(guild_id, user_id, JOURNAL_ITEM, -amount, item_id, reason)])
+        conn.commit()
     return True
 
-# общий список колонок как в get_item_by_name / list_items_db
-ITEMS_COLUMNS = (
-    "id, guild_id, name, name_lower, price, sell_price, description, "
-    "buy_price_type, cost_items, is_listed, stock_total, restock_per_day, "
-    "per_user_daily_limit, roles_required_buy, roles_required_sell, "
-    "roles_granted_on_buy, roles_removed_on_buy, disallow_sell, license_role_id"
-)
+# ======== Поисковый индекс предметов ========
+# Строится из кэша каталога (get_item_catalog) и сбрасывается вместе с ним,
+# поэтому всегда соответствует таблице items.
+ITEM_SEARCH_LIMIT = 10
+
+def _trigrams(s: str) -> set[str]:
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+class ItemSearchIndex:
+    """
+    Индекс по предметам гильдии:
+      - точное имя и ID — словари;
+      - префикс — отсортированный список имён + bisect;
+      - подстрока — триграммы (для запросов от 3 символов), короткие — перебором.
+    """
+
+    def __init__(self, items: list[dict]):
+        self.by_id: dict[int, dict] = {}
+        self.by_name: dict[str, dict] = {}
+        self._names: list[tuple[str, int]] = []
+        self._trigram_ids: dict[str, set[int]] = {}
+        for it in items:
+            iid = int(it["id"])
+            nl = (it.get("name") or "").lower()
+            self.by_id[iid] = it
+            self.by_name.setdefault(nl, it)
+            self._names.append((nl, iid))
+            for tg in _trigrams(nl):
+                self._trigram_ids.setdefault(tg, set()).add(iid)
+        self._names.sort()
+        self._name_of = {iid: nl for nl, iid in self._names}
+
+    def prefix_ids(self, prefix: str, limit: int) -> list[int]:
+        out = []
+        i = bisect.bisect_left(self._names, (prefix, -1))
+        while i < len(self._names) and len(out) < limit and self._names[i][0].startswith(prefix):
+            out.append(self._names[i][1])
+            i += 1
+        return out
+
+    def substring_ids(self, q: str) -> list[int]:
+        if len(q) >= 3:
+            sets = sorted((self._trigram_ids.get(tg, set()) for tg in _trigrams(q)), key=len)
+            cand = set(sets[0]).intersection(*sets[1:]) if sets else set()
+        else:
+            cand = self._name_of.keys()
+        return [iid for iid in cand if q in self._name_of[iid]]
+
+    def search(self, query: str, limit: int = ITEM_SEARCH_LIMIT) -> list[dict]:
+        """Точное совпадение ID → [item]; иначе имена: точное, по префиксу, по подстроке."""
+        q = (query or "").strip()
+        if q.isdigit() and int(q) in self.by_id:
+            return [self.by_id[int(q)]]
+        ql = q.lower()
+        if not ql:
+            return []
+
+        ranked: list[int] = []
+        exact = self.by_name.get(ql)
+        if exact is not None:
+            ranked.append(int(exact["id"]))
+        ranked.extend(self.prefix_ids(ql, limit + 1))
+        if len(set(ranked)) < limit:
+            # подстрока: короче имя — выше (ближе к запросу), затем по алфавиту
+            ranked.extend(sorted(self.substring_ids(ql), key=lambda i: (len(self._name_of[i]), self._name_of[i])))
+
+        return [self.by_id[i] for i in list(dict.fromkeys(ranked))[:limit]]
+
+def get_item_search_index(guild_id: int) -> ItemSearchIndex:
+    cat = get_item_catalog(guild_id)
+    index = cat.get("index")
+    if index is None:
+        index = cat["index"] = ItemSearchIndex(cat["items"])
+    return index
+
+def get_item_fuzzy(guild_id: int) -> FuzzyMatcher:
+    cat = get_item_catalog(guild_id)
+    fm = cat.get("fuzzy")
+    if fm is None:
+        fm = cat["fuzzy"] = FuzzyMatcher([(it["name"], it) for it in cat["items"]])
+    return fm
 
 def search_items_by_name_or_id(guild_id: int, query: str) -> list[dict]:
     """
-    Ищет и ВОЗВРАЩАЕТ НОРМАЛИЗОВАННЫЕ предметы (как _item_row_to_dict).
+    Ищет предметы по точному ID или имени (точное → префикс → подстрока).
+    Возвращает НОРМАЛИЗОВАННЫЕ предметы из кэша каталога (не менять на месте).
     """
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-
-    # 1) точное совпадение по ID
-    q = (query or "").strip()
-    if q.isdigit():
-        c.execute(f"SELECT {ITEMS_COLUMNS} FROM items WHERE guild_id = ? AND id = ?", (guild_id, int(q)))
-        row = c.fetchone()
-        conn.close()
-        return [_item_row_to_dict(row)] if row else []
-
-    # 2) поиск по имени (LIKE по name_lower)
-    like = f"%{q.lower()}%"
-    c.execute(f"SELECT {ITEMS_COLUMNS} FROM items WHERE guild_id = ? AND name_lower LIKE ? LIMIT 10", (guild_id, like))
-    rows = c.fetchall()
-    conn.close()
-    return [_item_row_to_dict(r) for r in rows]
+    return get_item_search_index(guild_id).search(query)
 
 def db_reset_user_inventory(guild_id: int, user_id: int) -> tuple[int, int]:
     """
     Полностью очищает инвентарь пользователя на сервере.
     Возвращает кортеж: (кол-во разных позиций, общее кол-во предметов).
     """
-    conn = sqlite3.connect(get_db_path())
+    conn = db_connect()
     c = conn.cursor()
     try:
         # Считаем, чтобы вернуть статистику
@@ -1964,6 +3112,7 @@ def db_reset_user_inventory(guild_id: int, user_id: int) -> tuple[int, int]:
         total_qty = int(row[1] or 0)
 
         # Удаляем
+        _journal_inventory_removal(c, "guild_id = ? AND user_id = ?", (guild_id, user_id), "reset_inventory")
         c.execute("DELETE FROM inventories WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
         conn.commit()
         return distinct_items, total_qty
@@ -1974,15 +3123,14 @@ def db_get_user_inventory_stats(guild_id: int, user_id: int) -> tuple[int, int]:
     """
     Возвращает (кол-во разных позиций, общее кол-во предметов) в инвентаре пользователя.
     """
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""
-        SELECT COUNT(*), COALESCE(SUM(quantity), 0)
-        FROM inventories
-        WHERE guild_id = ? AND user_id = ?
-    """, (guild_id, user_id))
-    row = c.fetchone()
-    conn.close()
+    with db_reader() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT COUNT(*), COALESCE(SUM(quantity), 0)
+            FROM inventories
+            WHERE guild_id = ? AND user_id = ?
+        """, (guild_id, user_id))
+        row = c.fetchone()
     return int(row[0] or 0), int(row[1] or 0)
 
 EXPORT_DELIVERY_RATE = 0.05  # 5%
@@ -2006,29 +3154,27 @@ def db_create_export_deal(
     total_paid = safe_int(total_paid, name="Итого", min_v=0)
     quantity = safe_int(quantity, name="Кол-во", min_v=1)
 
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    created_at = int(datetime.utcnow().timestamp())  # секунды — точно в пределах int64
-    c.execute("""
-        INSERT INTO export_deals (
-            guild_id, seller_id, buyer_id, item_id, quantity, price, delivery, total_paid, status, created_at
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'pending', ?)
-    """, (guild_id, seller_id, buyer_id, item_id, quantity, price, delivery, total_paid, created_at))
-    deal_id = c.lastrowid or 0
-    conn.commit()
-    conn.close()
+    with db_writer() as conn:
+        c = conn.cursor()
+        created_at = int(datetime.utcnow().timestamp())  # секунды — точно в пределах int64
+        c.execute("""
+            INSERT INTO export_deals (
+                guild_id, seller_id, buyer_id, item_id, quantity, price, delivery, total_paid, status, created_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'pending', ?)
+        """, (guild_id, seller_id, buyer_id, item_id, quantity, price, delivery, total_paid, created_at))
+        deal_id = c.lastrowid or 0
+        conn.commit()
     return int(deal_id)
 
 def db_update_export_status(deal_id: int, status: str):
     """
     Обновляет статус ('accepted'|'rejected'|'expired') и фиксирует время решения.
     """
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    decided_at = int(datetime.utcnow().timestamp())
-    c.execute("UPDATE export_deals SET status = ?, decided_at = ? WHERE id = ?", (status, decided_at, deal_id))
-    conn.commit()
-    conn.close()
+    with db_writer() as conn:
+        c = conn.cursor()
+        decided_at = int(datetime.utcnow().timestamp())
+        c.execute("UPDATE export_deals SET status = ?, decided_at = ? WHERE id = ?", (status, decided_at, deal_id))
+        conn.commit()
 
 def format_price(n: int) -> str:
     return f"{format_number(n)} {MONEY_EMOJI}"
@@ -2042,74 +3188,557 @@ def effective_sell_price(item: dict) -> int:
 def ymd_utc() -> str:
     return datetime.utcnow().strftime("%Y%m%d")
 
+def _ensure_item_state_in(c: sqlite3.Cursor, guild_id: int, item: dict):
+    """
+    Автопополнение склада одним UPSERT на курсоре вызывающего (без commit):
+    новой строке — полный склад, существующей — +restock_per_day (не выше stock_total),
+    если сегодня ещё не пополняли. Для неограниченного склада строка не меняется.
+    """
+    c.execute("""
+        INSERT INTO item_shop_state (guild_id, item_id, current_stock, last_restock_ymd)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT(guild_id, item_id) DO UPDATE SET
+            current_stock = MIN(excluded.current_stock, COALESCE(item_shop_state.current_stock, 0) + ?),
+            last_restock_ymd = excluded.last_restock_ymd
+        WHERE excluded.current_stock IS NOT NULL
+          AND item_shop_state.last_restock_ymd IS NOT excluded.last_restock_ymd
+    """, (guild_id, item["id"], item["stock_total"], ymd_utc(), int(item["restock_per_day"] or 0)))
+
 def ensure_item_state(guild_id: int, item: dict):
     """Создаёт/обновляет состояние склада (автопополнение по дню)."""
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("SELECT current_stock, last_restock_ymd FROM item_shop_state WHERE guild_id = ? AND item_id = ?",
-              (guild_id, item["id"]))
-    row = c.fetchone()
-    today = ymd_utc()
+    with db_writer() as conn:
+        c = conn.cursor()
+        _ensure_item_state_in(c, guild_id, item)
+        conn.commit()
+
+def get_effective_stock(guild_id: int, item: dict) -> Optional[int]:
+    """
+    Остаток с учётом ещё не применённого сегодняшнего пополнения — одно чтение, без записи.
+    None — склад не ограничен.
+    """
+    if item["stock_total"] is None:
+        return None
+    conn = db_connect(readonly=True)
+    try:
+        row = conn.execute("""
+            SELECT CASE
+                WHEN last_restock_ymd IS NOT ? THEN MIN(?, COALESCE(current_stock, 0) + ?)
+                ELSE current_stock
+            END
+            FROM item_shop_state WHERE guild_id = ? AND item_id = ?
+        """, (ymd_utc(), item["stock_total"], int(item["restock_per_day"] or 0), guild_id, item["id"])).fetchone()
+    finally:
+        conn.close()
     if row is None:
-        start_stock = item["stock_total"] if item["stock_total"] is not None else None
-        c.execute("INSERT INTO item_shop_state (guild_id, item_id, current_stock, last_restock_ymd) VALUES (?, ?, ?, ?)",
-                  (guild_id, item["id"], start_stock, today))
-    else:
-        cur, last = row[0], row[1]
-        if item["stock_total"] is not None and last != today:
-            cur_val = int(cur) if cur is not None else 0
-            replenished = min(item["stock_total"], cur_val + int(item["restock_per_day"] or 0))
-            c.execute("UPDATE item_shop_state SET current_stock = ?, last_restock_ymd = ? WHERE guild_id = ? AND item_id = ?",
-                      (replenished, today, guild_id, item["id"]))
-    conn.commit()
-    conn.close()
+        return int(item["stock_total"])
+    return None if row[0] is None else int(row[0])
 
-def get_current_stock(guild_id: int, item_id: int) -> Optional[int]:
-    conn = sqlite3.connect(get_db_path())
+# ======== Ежедневное пополнение складов ========
+# В полночь UTC все склады пополняются одним UPDATE, так что покупка почти никогда
+# не застаёт «вчерашний» склад; UPSERT в покупке остаётся страховкой на случай простоя.
+def db_restock_all() -> int:
+    """Пополнить склады всех предметов всех серверов. Возвращает число обновлённых строк."""
+    today = ymd_utc()
+    conn = db_connect()
+    try:
+        c = conn.cursor()
+        c.execute("""
+            UPDATE item_shop_state SET
+                current_stock = (
+                    SELECT MIN(i.stock_total, COALESCE(item_shop_state.current_stock, 0) + COALESCE(i.restock_per_day, 0))
+                    FROM items i
+                    WHERE i.guild_id = item_shop_state.guild_id AND i.id = item_shop_state.item_id
+                ),
+                last_restock_ymd = ?
+            WHERE last_restock_ymd IS NOT ?
+              AND EXISTS (
+                SELECT 1 FROM items i
+                WHERE i.guild_id = item_shop_state.guild_id AND i.id = item_shop_state.item_id
+                  AND i.stock_total IS NOT NULL
+              )
+        """, (today, today))
+        updated = c.rowcount or 0
+        conn.commit()
+        return updated
+    finally:
+        conn.close()
+
+_restock_task: Optional[asyncio.Task] = None
+
+async def _restock_loop():
+    while True:
+        now = datetime.utcnow()
+        next_midnight = datetime(now.year, now.month, now.day) + timedelta(days=1)
+        await asyncio.sleep((next_midnight - now).total_seconds() + 1)
+        try:
+            start = time.perf_counter()
+            n = await db_run(db_restock_all)
+            print(f"[restock] пополнено складов: {n}, {(time.perf_counter() - start) * 1000:.0f} мс")
+        except Exception as e:
+            print(f"[restock] ошибка пополнения: {e}")
+
+def start_restock_scheduler():
+    global _restock_task
+    if _restock_task is None or _restock_task.done():
+        _restock_task = asyncio.get_running_loop().create_task(_restock_loop())
+
+# ======== Обслуживание БД: очистка устаревших строк и VACUUM ========
+# Дневные лимиты нужны только за сегодня, сделки и награды за бамп — только недавние;
+# без очистки файл базы и глубина индексов растут линейно со временем работы.
+MAINTENANCE_INTERVAL_HOURS = 6
+MAINTENANCE_FIRST_DELAY_SECONDS = 300
+EXPORT_DEALS_RETENTION_DAYS = 30     # только решённые сделки; pending не трогаем — их ждёт ExportDealView
+# bump_reward_awards — защита от повторной награды по message_id. Сообщения старше
+# BUMP_AWARD_MAX_AGE_SECONDS слушатель не награждает вовсе, поэтому строки старше
+# этого окна (с большим запасом) уже ничего не защищают и их можно удалять.
+BUMP_AWARD_MAX_AGE_SECONDS = 24 * 3600
+BUMP_AWARDS_RETENTION_DAYS = 30
+INCREMENTAL_VACUUM_PAGES = 0      # 0 — вернуть все свободные страницы
+
+MAINTENANCE_STATS = {"runs": 0, "last_ts": None, "last_deleted": 0, "last_reclaimed_bytes": 0, "total_reclaimed_bytes": 0}
+
+def db_maintenance() -> dict:
+    """
+    Удаляет устаревшие строки, затем incremental_vacuum и PRAGMA optimize.
+    Возвращает {"daily", "deals", "bump_awards", "reclaimed_bytes", "ms"}.
+    """
+    start = time.perf_counter()
+    now = int(time.time())
+    flush_balances()
+    conn = db_connect()
+    try:
+        c = conn.cursor()
+        page_size = c.execute("PRAGMA page_size").fetchone()[0]
+        pages_before = c.execute("PRAGMA page_count").fetchone()[0]
+
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("DELETE FROM item_user_daily WHERE ymd < ?", (ymd_utc(),))
+        daily = c.rowcount or 0
+        c.execute("""
+            DELETE FROM export_deals
+            WHERE status IN ('accepted', 'rejected', 'expired') AND created_at < ?
+        """, (now - EXPORT_DEALS_RETENTION_DAYS * 86400,))
+        deals = c.rowcount or 0
+        awards_cutoff = now - max(BUMP_AWARDS_RETENTION_DAYS * 86400, 2 * BUMP_AWARD_MAX_AGE_SECONDS)
+        c.execute("DELETE FROM bump_reward_awards WHERE awarded_ts < ?", (awards_cutoff,))
+        awards = c.rowcount or 0
+        conn.commit()
+
+        # incremental_vacuum работает только в режиме auto_vacuum=INCREMENTAL;
+        # старую базу переводим в него один раз полным VACUUM
+        if c.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            c.execute("VACUUM")
+            print("[maintenance] база переведена в auto_vacuum=INCREMENTAL")
+        else:
+            # executescript доводит прагму до конца (execute освобождает лишь одну страницу за шаг)
+            pages = f"({int(INCREMENTAL_VACUUM_PAGES)})" if INCREMENTAL_VACUUM_PAGES > 0 else ""
+            c.executescript(f"PRAGMA incremental_vacuum{pages};")
+        c.execute("PRAGMA optimize")
+
+        pages_after = c.execute("PRAGMA page_count").fetchone()[0]
+    finally:
+        conn.close()
+
+    reclaimed = max(0, pages_before - pages_after) * page_size
+    MAINTENANCE_STATS["runs"] += 1
+    MAINTENANCE_STATS["last_ts"] = now
+    MAINTENANCE_STATS["last_deleted"] = daily + deals + awards
+    MAINTENANCE_STATS["last_reclaimed_bytes"] = reclaimed
+    MAINTENANCE_STATS["total_reclaimed_bytes"] += reclaimed
+    return {"daily": daily, "deals": deals, "bump_awards": awards, "reclaimed_bytes": reclaimed,
+            "ms": (time.perf_counter() - start) * 1000}
+
+_maintenance_task: Optional[asyncio.Task] = None
+
+async def _maintenance_loop():
+    await asyncio.sleep(MAINTENANCE_FIRST_DELAY_SECONDS)
+    while True:
+        try:
+            r = await db_run(db_maintenance)
+            print(f"[maintenance] удалено: лимиты {r['daily']}, сделки {r['deals']}, бампы {r['bump_awards']}; "
+                  f"освобождено {r['reclaimed_bytes'] / 1024:.0f} КБ за {r['ms']:.0f} мс")
+        except Exception as e:
+            print(f"[maintenance] ошибка обслуживания: {e}")
+        await asyncio.sleep(MAINTENANCE_INTERVAL_HOURS * 3600)
+
+def start_maintenance():
+    global _maintenance_task
+    if _maintenance_task is None or _maintenance_task.done():
+        _maintenance_task = asyncio.get_running_loop().create_task(_maintenance_loop())
+
+# ======== Снимки экономики и восстановление сервера ========
+# Снимок — полная копия базы через online backup API SQLite в папку snapshots/ рядом с базой.
+# Копия снимается отдельным соединением за один шаг: в WAL это одна читающая транзакция,
+# писатели её не ждут, а снимок согласован на момент начала. Снимки делаются перед каждым
+# опасным действием админ-панели и по расписанию. Хранение — по метке снимка: частые
+# before-* одного сервера не вытесняют плановые снимки и снимки других действий.
+SNAPSHOT_INTERVAL_HOURS = 24
+SNAPSHOT_SCHEDULED_LABEL = "scheduled"
+SNAPSHOT_KEEP_SCHEDULED = 14      # плановых снимков
+SNAPSHOT_KEEP = 10                # снимков каждой другой метки (before-reset_balances, manual, ...)
+# economy-<дата>-<время>-<мс>-<метка>.db
+_SNAPSHOT_NAME_RE = re.compile(r"^economy-\d{8}-\d{6}-\d{3}-(?P<label>[a-z0-9_-]+)\.db$")
+# Таблицы с состоянием сервера, которые возвращаются из снимка (журнал не трогаем — он только дописывается)
+SNAPSHOT_GUILD_TABLES = (
+    "balances", "inventories", "worldbank",
+    "items", "item_shop_state", "item_user_daily",
+    "role_incomes", "role_income_cooldowns",
+)
+
+SNAPSHOT_STATS = {"taken": 0, "last_name": None, "last_ms": 0.0, "last_bytes": 0, "restores": 0}
+
+def get_snapshot_dir() -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(get_db_pool().path)), "snapshots")
+
+def list_snapshots() -> list[tuple[str, int, float]]:
+    """[(имя файла, размер, mtime)] — новые первыми."""
+    folder = get_snapshot_dir()
+    if not os.path.isdir(folder):
+        return []
+    out = []
+    for name in os.listdir(folder):
+        if _SNAPSHOT_NAME_RE.match(name):
+            st = os.stat(os.path.join(folder, name))
+            out.append((name, st.st_size, st.st_mtime))
+    out.sort(key=lambda x: x[0], reverse=True)
+    return out
+
+def resolve_snapshot(ref: str) -> Optional[str]:
+    """Путь к снимку по имени файла или номеру из !snapshots (1 — самый свежий)."""
+    snaps = list_snapshots()
+    ref = ref.strip()
+    if ref.isdigit() and 1 <= int(ref) <= len(snaps):
+        ref = snaps[int(ref) - 1][0]
+    if ref in {name for name, _, _ in snaps}:
+        return os.path.join(get_snapshot_dir(), ref)
+    return None
+
+def snapshot_database(label: str = "manual") -> str:
+    """Снять снимок базы. Возвращает имя файла. Не использует соединения пула."""
+    start = time.perf_counter()
+    folder = get_snapshot_dir()
+    os.makedirs(folder, exist_ok=True)
+    safe_label = re.sub(r"[^a-z0-9_-]+", "-", label.lower()).strip("-") or "manual"
+    fd, tmp_path = tempfile.mkstemp(prefix="economy-", suffix=".tmp", dir=folder)
+    os.close(fd)
+    try:
+        src = sqlite3.connect(get_db_pool().path, timeout=DB_BUSY_TIMEOUT_MS / 1000)
+        dst = sqlite3.connect(tmp_path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+        # os.link не перезаписывает существующий файл: снимки, снятые в одну миллисекунду, получат разные имена
+        while True:
+            now = datetime.utcnow()
+            name = f"economy-{now.strftime('%Y%m%d-%H%M%S')}-{now.microsecond // 1000:03d}-{safe_label}.db"
+            path = os.path.join(folder, name)
+            try:
+                os.link(tmp_path, path)
+                break
+            except FileExistsError:
+                time.sleep(0.001)
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(tmp_path)
+
+    _prune_snapshots()
+
+    SNAPSHOT_STATS["taken"] += 1
+    SNAPSHOT_STATS["last_name"] = name
+    SNAPSHOT_STATS["last_ms"] = (time.perf_counter() - start) * 1000
+    SNAPSHOT_STATS["last_bytes"] = os.path.getsize(path)
+    return name
+
+def _prune_snapshots():
+    """Оставить SNAPSHOT_KEEP_SCHEDULED плановых и по SNAPSHOT_KEEP снимков каждой другой метки."""
+    kept: dict[str, int] = {}
+    for name, _, _ in list_snapshots():
+        label = _SNAPSHOT_NAME_RE.match(name).group("label")
+        kept[label] = kept.get(label, 0) + 1
+        limit = SNAPSHOT_KEEP_SCHEDULED if label == SNAPSHOT_SCHEDULED_LABEL else SNAPSHOT_KEEP
+        if kept[label] > limit:
+            with contextlib.suppress(OSError):
+                os.remove(os.path.join(get_snapshot_dir(), name))
+
+async def take_snapshot(label: str) -> str:
+    """Снимок из async-кода: очередь балансов сбрасывается в БД, копия — в отдельном потоке."""
+    await db_run(flush_balances)
+    return await asyncio.to_thread(snapshot_database, label)
+
+def _snapshot_columns(c: sqlite3.Cursor, schema: str, table: str) -> list[str]:
+    c.execute(f"PRAGMA {schema}.table_info({table})")
+    return [row[1] for row in c.fetchall()]
+
+def db_restore_guild_from_snapshot(path: str, guild_id: int) -> dict[str, int]:
+    """
+    Вернуть состояние сервера из снимка одной транзакцией: для каждой таблицы
+    SNAPSHOT_GUILD_TABLES строки сервера удаляются и копируются из снимка (INSERT ... SELECT).
+    Разница балансов, инвентарей и казны пишется в журнал с reason='restore'.
+    Возвращает {таблица: восстановлено строк}.
+    """
+    flush_balances()
+    conn = db_connect()
     c = conn.cursor()
-    c.execute("SELECT current_stock FROM item_shop_state WHERE guild_id = ? AND item_id = ?", (guild_id, item_id))
-    row = c.fetchone()
-    conn.close()
+    restored: dict[str, int] = {}
+    try:
+        c.execute("ATTACH DATABASE ? AS snap", (path,))
+        c.execute("BEGIN IMMEDIATE")
+        now = int(time.time())
+        c.execute("""
+            INSERT INTO economy_journal (guild_id, user_id, ts, kind, item_id, amount, reason)
+            SELECT ?, user_id, ?, ?, NULL, SUM(d), 'restore' FROM (
+                SELECT user_id, balance AS d FROM snap.balances WHERE guild_id = ?
+                UNION ALL
+                SELECT user_id, -balance FROM main.balances WHERE guild_id = ?
+            ) GROUP BY user_id HAVING SUM(d) != 0
+        """, (guild_id, now, JOURNAL_MONEY, guild_id, guild_id))
+        c.execute("""
+            INSERT INTO economy_journal (guild_id, user_id, ts, kind, item_id, amount, reason)
+            SELECT ?, user_id, ?, ?, item_id, SUM(d), 'restore' FROM (
+                SELECT user_id, item_id, quantity AS d FROM snap.inventories WHERE guild_id = ?
+                UNION ALL
+                SELECT user_id, item_id, -quantity FROM main.inventories WHERE guild_id = ?
+            ) GROUP BY user_id, item_id HAVING SUM(d) != 0
+        """, (guild_id, now, JOURNAL_ITEM, guild_id, guild_id))
+        c.execute("""
+            INSERT INTO economy_journal (guild_id, user_id, ts, kind, item_id, amount, reason)
+            SELECT ?, ?, ?, ?, NULL, SUM(d), 'restore' FROM (
+                SELECT bank_balance AS d FROM snap.worldbank WHERE guild_id = ?
+                UNION ALL
+                SELECT -bank_balance FROM main.worldbank WHERE guild_id = ?
+            ) HAVING SUM(d) != 0
+        """, (guild_id, JOURNAL_BANK_USER_ID, now, JOURNAL_BANK, guild_id, guild_id))
+
+        for table in SNAPSHOT_GUILD_TABLES:
+            snap_cols = set(_snapshot_columns(c, "snap", table))
+            if not snap_cols:
+                continue  # в старом снимке таблицы ещё не было
+            cols = ", ".join(col for col in _snapshot_columns(c, "main", table) if col in snap_cols)
+            c.execute(f"DELETE FROM main.{table} WHERE guild_id = ?", (guild_id,))
+            c.execute(f"INSERT INTO main.{table} ({cols}) SELECT {cols} FROM snap.{table} WHERE guild_id = ?",
+                      (guild_id,))
+            restored[table] = c.rowcount or 0
+        conn.commit()
+    except Exception:
+        with contextlib.suppress(Exception):
+            conn.rollback()
+        raise
+    finally:
+        with contextlib.suppress(Exception):
+            c.execute("DETACH DATABASE snap")
+        conn.close()
+
+    invalidate_item_catalog(guild_id)
+    invalidate_leaderboard(guild_id)
+    SNAPSHOT_STATS["restores"] += 1
+    return restored
+
+_snapshot_task: Optional[asyncio.Task] = None
+
+def _next_scheduled_snapshot_delay() -> float:
+    """Секунд до следующего планового снимка — от времени последнего планового, а не от запуска бота."""
+    for name, _, mtime in list_snapshots():
+        if _SNAPSHOT_NAME_RE.match(name).group("label") == SNAPSHOT_SCHEDULED_LABEL:
+            return max(0.0, mtime + SNAPSHOT_INTERVAL_HOURS * 3600 - time.time())
+    return 0.0
+
+async def _snapshot_loop():
+    while True:
+        try:
+            delay = await asyncio.to_thread(_next_scheduled_snapshot_delay)
+        except Exception:
+            delay = SNAPSHOT_INTERVAL_HOURS * 3600
+        await asyncio.sleep(delay)
+        try:
+            name = await take_snapshot(SNAPSHOT_SCHEDULED_LABEL)
+            print(f"[snapshot] {name}: {SNAPSHOT_STATS['last_bytes'] / 1024:.0f} КБ за {SNAPSHOT_STATS['last_ms']:.0f} мс")
+        except Exception as e:
+            print(f"[snapshot] не удалось снять снимок: {e}")
+            await asyncio.sleep(SNAPSHOT_INTERVAL_HOURS * 3600)
+
+def start_snapshots():
+    global _snapshot_task
+    if _snapshot_task is None or _snapshot_task.done():
+        _snapshot_task = asyncio.get_running_loop().create_task(_snapshot_loop())
+
+def get_current_stock(guild_id: int, item_id: int) -> Optional[int]:
+    with db_reader() as conn:
+        c = conn.cursor()
+        c.execute("SELECT current_stock FROM item_shop_state WHERE guild_id = ? AND item_id = ?", (guild_id, item_id))
+        row = c.fetchone()
     if row is None:
         return None
     return None if row[0] is None else int(row[0])
 
-def change_stock(guild_id: int, item_id: int, delta: int):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""
-        UPDATE item_shop_state
-        SET current_stock = CASE
-            WHEN current_stock IS NULL THEN NULL
-            ELSE current_stock + ?
-        END
-        WHERE guild_id = ? AND item_id = ?
-    """, (delta, guild_id, item_id))
-    conn.commit()
-    conn.close()
+def change_stock(guild_id: int, item_id: int, delta: int):
+    with db_writer() as conn:
+        c = conn.cursor()
+        c.execute("""
+            UPDATE item_shop_state
+            SET current_stock = CASE
+                WHEN current_stock IS NULL THEN NULL
+                ELSE current_stock + ?
+            END
+            WHERE guild_id = ? AND item_id = ?
+        """, (delta, guild_id, item_id))
+        conn.commit()
+
+def get_user_daily_used(guild_id: int, item_id: int, user_id: int) -> int:
+    with db_reader() as conn:
+        c = conn.cursor()
+        day = ymd_utc()
+        c.execute("SELECT used FROM item_user_daily WHERE guild_id = ? AND item_id = ? AND user_id = ? AND ymd = ?",
+                  (guild_id, item_id, user_id, day))
+        row = c.fetchone()
+    return int(row[0]) if row else 0
+
+def add_user_daily_used(guild_id: int, item_id: int, user_id: int, amount: int):
+    with db_writer() as conn:
+        c = conn.cursor()
+        day = ymd_utc()
+        c.execute("""
+            INSERT INTO item_user_daily (guild_id, item_id, user_id, ymd, used)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(guild_id, item_id, user_id, ymd) DO UPDATE SET
+                used = item_user_daily.used + excluded.used
+        """, (guild_id, item_id, user_id, day, amount))
+        conn.commit()
+
+# ======== Покупка: атомарный движок ========
+@dataclass
+class PurchaseResult:
+    ok: bool
+    reason: Optional[str] = None      # 'stock' | 'daily_limit' | 'money' | 'items' при ok=False
+    stock: Optional[int] = None       # остаток на складе (None — склад не ограничен)
+    daily_remain: Optional[int] = None
+    balance: int = 0                  # баланс покупателя (после покупки, если ok)
+    cost_money: int = 0
+    cost_items: list[dict] = field(default_factory=list)  # [{"item_id", "qty"}] — списанные/требуемые
+    lacking: list[dict] = field(default_factory=list)     # [{"item_id", "qty", "have"}]
+
+def db_buy_item(guild_id: int, user_id: int, item: dict, amount: int) -> PurchaseResult:
+    """
+    Покупка одной транзакцией (BEGIN IMMEDIATE): автопополнение склада, проверки склада
+    и дневного лимита, списание денег/предметов условными UPDATE, выдача предмета.
+    Либо всё применяется одним commit, либо ничего.
+    """
+    iid = int(item["id"])
+    day = ymd_utc()
+
+    cost_money = 0
+    need: dict[int, int] = {}
+    if item["buy_price_type"] == "currency":
+        cost_money = int(item["price"]) * amount
+    else:
+        for r in item["cost_items"]:
+            need[int(r["item_id"])] = need.get(int(r["item_id"]), 0) + int(r["qty"]) * amount
+    res = PurchaseResult(ok=False, cost_money=cost_money,
+                         cost_items=[{"item_id": k, "qty": v} for k, v in need.items()])
+
+    pending = None
+    conn = db_connect()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        # отложенные балансы — в этой же транзакции, до условного списания
+        pending = flush_balances_into(c)
+        _ensure_item_state_in(c, guild_id, item)
+
+        c.execute("SELECT current_stock FROM item_shop_state WHERE guild_id = ? AND item_id = ?", (guild_id, iid))
+        row = c.fetchone()
+        res.stock = None if row is None or row[0] is None else int(row[0])
+        if res.stock is not None and res.stock < amount:
+            res.reason = "stock"
+            return res
+
+        limit = int(item["per_user_daily_limit"] or 0)
+        if limit > 0:
+            c.execute("SELECT used FROM item_user_daily WHERE guild_id = ? AND item_id = ? AND user_id = ? AND ymd = ?",
+                      (guild_id, iid, user_id, day))
+            row = c.fetchone()
+            res.daily_remain = limit - (int(row[0]) if row else 0)
+            if res.daily_remain <= 0 or amount > res.daily_remain:
+                res.reason = "daily_limit"
+                return res
+
+        if cost_money > 0:
+            c.execute("""
+                UPDATE balances SET balance = balance - ?
+                WHERE guild_id = ? AND user_id = ? AND balance >= ?
+            """, (cost_money, guild_id, user_id, cost_money))
+            if c.rowcount == 0:
+                c.execute("SELECT balance FROM balances WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
+                row = c.fetchone()
+                res.balance = int(row[0]) if row else 0
+                res.reason = "money"
+                return res
+
+        for cid, qty in need.items():
+            c.execute("""
+                UPDATE inventories SET quantity = quantity - ?
+                WHERE guild_id = ? AND user_id = ? AND item_id = ? AND quantity >= ?
+            """, (qty, guild_id, user_id, cid, qty))
+            if c.rowcount == 0:
+                c.execute("SELECT quantity FROM inventories WHERE guild_id = ? AND user_id = ? AND item_id = ?",
+                          (guild_id, user_id, cid))
+                row = c.fetchone()
+                res.lacking.append({"item_id": cid, "qty": qty, "have": int(row[0]) if row else 0})
+        if res.lacking:
+            res.reason = "items"
+            return res
+        if need:
+            c.execute(f"""
+                DELETE FROM inventories
+                WHERE guild_id = ? AND user_id = ? AND quantity <= 0
+                  AND item_id IN ({",".join("?" * len(need))})
+            """, (guild_id, user_id, *need.keys()))
 
-def get_user_daily_used(guild_id: int, item_id: int, user_id: int) -> int:
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    day = ymd_utc()
-    c.execute("SELECT used FROM item_user_daily WHERE guild_id = ? AND item_id = ? AND user_id = ? AND ymd = ?",
-              (guild_id, item_id, user_id, day))
-    row = c.fetchone()
-    conn.close()
-    return int(row[0]) if row else 0
+        c.execute("""
+            INSERT INTO inventories (guild_id, user_id, item_id, quantity)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(guild_id, user_id, item_id) DO UPDATE SET
+                quantity = inventories.quantity + excluded.quantity
+        """, (guild_id, user_id, iid, amount))
+
+        now = int(time.time())
+        jrows = [(guild_id, user_id, now, JOURNAL_ITEM, iid, amount, "buy")]
+        if cost_money > 0:
+            jrows.append((guild_id, user_id, now, JOURNAL_MONEY, None, -cost_money, "buy"))
+        jrows += [(guild_id, user_id, now, JOURNAL_ITEM, cid, -qty, "buy") for cid, qty in need.items()]
+        _journal(c, jrows)
+
+        if res.stock is not None:
+            c.execute("""
+                UPDATE item_shop_state SET current_stock = current_stock - ?
+                WHERE guild_id = ? AND item_id = ? AND current_stock >= ?
+            """, (amount, guild_id, iid, amount))
+            res.stock -= amount
+        if limit > 0:
+            c.execute("""
+                INSERT INTO item_user_daily (guild_id, item_id, user_id, ymd, used)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(guild_id, item_id, user_id, ymd) DO UPDATE SET
+                    used = item_user_daily.used + excluded.used
+            """, (guild_id, iid, user_id, day, amount))
+            res.daily_remain -= amount
+
+        c.execute("SELECT balance FROM balances WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
+        row = c.fetchone()
+        res.balance = int(row[0]) if row else 0
 
-def add_user_daily_used(guild_id: int, item_id: int, user_id: int, amount: int):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    day = ymd_utc()
-    c.execute("""
-        INSERT INTO item_user_daily (guild_id, item_id, user_id, ymd, used)
-        VALUES (?, ?, ?, ?, ?)
-        ON CONFLICT(guild_id, item_id, user_id, ymd) DO UPDATE SET
-            used = item_user_daily.used + excluded.used
-    """, (guild_id, item_id, user_id, day, amount))
-    conn.commit()
-    conn.close()
+        conn.commit()
+        res.ok = True
+        return res
+    finally:
+        if not res.ok:
+            with contextlib.suppress(Exception):
+                conn.rollback()
+            if pending:
+                balance_cache.requeue(pending)
+        conn.close()
 
 def csv_from_ids(ids) -> str:
     """
@@ -2293,49 +3922,140 @@ def user_has_item_license(member: disnake.Member, item: dict) -> bool:
         return True  # некорректная настройка, не блокируем
     return any(r.id == lic_id for r in member.roles)
 
+# ======== Страницы магазина: готовые сортировки и отрисованные страницы ========
+SHOP_SORT_MODES: list[tuple[str, str]] = [
+    ("price_asc", "Цена ↑"),
+    ("price_desc", "Цена ↓"),
+    ("name", "Название"),
+    ("id", "ID"),
+]
+SHOP_PAGE_CACHE_SIZE = 2000  # отрисованных страниц (LRU)
+
+# (guild_id, версия каталога, только выставленные, сортировка, страница) -> (описание, max_page)
+_shop_pages: "OrderedDict[tuple[int, int, bool, str, int], tuple[str, int]]" = OrderedDict()
+
+def _shop_price_val(it: dict) -> int:
+    try:
+        return int(it.get("price") or 0)
+    except Exception:
+        return 0
+
+def _shop_sort_key(mode: str):
+    def is_resources(it: dict) -> bool:
+        return (it.get("buy_price_type") or "currency") != "currency"
+    if mode == "price_asc":
+        return lambda it: (is_resources(it), _shop_price_val(it), (it.get("name") or "").casefold(), int(it.get("id") or 0))
+    if mode == "price_desc":
+        return lambda it: (is_resources(it), -_shop_price_val(it), (it.get("name") or "").casefold(), int(it.get("id") or 0))
+    if mode == "name":
+        return lambda it: ((it.get("name") or "").casefold(), int(it.get("id") or 0))
+    return lambda it: int(it.get("id") or 0)
+
+def shop_sorted_items(guild_id: int, listed_only: bool, mode: str) -> list[dict]:
+    """Отсортированный список предметов; считается один раз на версию каталога."""
+    cat = get_item_catalog(guild_id)
+    orders = cat.setdefault("shop_orders", {})
+    key = (listed_only, mode)
+    items = orders.get(key)
+    if items is None:
+        src = [it for it in cat["items"] if it["is_listed"]] if listed_only else cat["items"]
+        items = orders[key] = sorted(src, key=_shop_sort_key(mode))
+    return items
+
+def _render_shop_lines(page_items: list[dict], id2name: dict[int, str]) -> list[str]:
+    lines = []
+    for idx, it in enumerate(page_items):
+        name = it.get("name", "Без названия")
+
+        # Описание — на следующей строке после цены/последнего ресурса
+        desc = (it.get("description") or "").strip() or "Без описания."
+        if len(desc) > 300:
+            desc = desc[:297] + "..."
+
+        # Заголовок предмета: крупным жирным
+        title_line = f"**__{name}__**"
+
+        # Формируем блок строк для одного предмета
+        block = []
+
+        if (it.get("buy_price_type") or "currency") == "currency":
+            price_str = format_price(it.get("price", 0))
+            block.append(f"{title_line} — {price_str}")
+            # Описание на следующей строке
+            block.append(desc)
+        else:
+            block.append(f"{title_line} — Цена (в ресурсах):")
+            cost_items = it.get("cost_items") or []
+            if not cost_items:
+                block.append("   • ❌ Требования не заданы.")
+            else:
+                for r in cost_items:
+                    try:
+                        item_id = int(r.get("item_id"))
+                        qty = int(r.get("qty"))
+                    except Exception:
+                        continue
+                    res_name = id2name.get(item_id, f"ID {item_id}")
+                    block.append(f"   • {res_name} — {qty} шт.")
+            # Описание после списка требований
+            block.append(desc)
+
+        # Добавляем блок в общие строки, с пустой строкой-отступом между предметами
+        lines.extend(block)
+        if idx < len(page_items) - 1:
+            lines.append("")
+    return lines
+
+def shop_page(guild_id: int, listed_only: bool, mode: str, page: int) -> tuple[str, int]:
+    """Описание страницы магазина и номер последней страницы. Повторный показ — просто поиск в словаре."""
+    version = item_catalog_version(guild_id)
+    key = (guild_id, version, listed_only, mode, page)
+    hit = _shop_pages.get(key)
+    if hit is not None:
+        _shop_pages.move_to_end(key)
+        return hit
+
+    items = shop_sorted_items(guild_id, listed_only, mode)
+    max_page = max(0, (len(items) - 1) // SHOP_ITEMS_PER_PAGE)
+    page = min(max(0, page), max_page)
+    page_items = items[page * SHOP_ITEMS_PER_PAGE:(page + 1) * SHOP_ITEMS_PER_PAGE]
+
+    header_lines = [
+        "🔸 Покупка: !buy [кол-во] <название>",
+        "🔸 Инфо о предмете: !item-info <название>",
+        ""
+    ]
+    if not page_items:
+        lines = ["Пока нет предметов в магазине."]
+    else:
+        lines = _render_shop_lines(page_items, item_names_map(guild_id))
+    result = ("\n".join(header_lines + lines).rstrip(), max_page)
+
+    _shop_pages[key] = result
+    while len(_shop_pages) > SHOP_PAGE_CACHE_SIZE:
+        _shop_pages.popitem(last=False)
+    return result
+
 class ShopView(disnake.ui.View):
-    def __init__(self, ctx: commands.Context, items: list[dict]):
+    def __init__(self, ctx: commands.Context, *, listed_only: bool = True):
         super().__init__(timeout=SHOP_VIEW_TIMEOUT)
         self.ctx = ctx
-        self.items = list(items)
+        self.guild_id = ctx.guild.id
+        self.listed_only = listed_only
         self.page = 0
-        self.max_page = max(0, (len(self.items) - 1) // SHOP_ITEMS_PER_PAGE)
         self.author_id = ctx.author.id
 
-        self._sort_modes: list[tuple[str, str]] = [
-            ("price_asc", "Цена ↑"),
-            ("price_desc", "Цена ↓"),
-            ("name", "Название"),
-            ("id", "ID"),
-        ]
+        self._sort_modes = SHOP_SORT_MODES
         self._sort_idx = 0
-        self._apply_sort()
+        self.max_page = shop_page(self.guild_id, self.listed_only, self._sort_mode(), 0)[1]
         self._sync_buttons_state()
         self._update_sort_label()
 
     def _current_sort_label(self) -> str:
         return self._sort_modes[self._sort_idx][1]
 
-    def _is_currency(self, it: dict) -> bool:
-        return (it.get("buy_price_type") or "currency") == "currency"
-
-    def _price_val(self, it: dict) -> int:
-        try:
-            return int(it.get("price") or 0)
-        except Exception:
-            return 0
-
-    def _apply_sort(self):
-        mode = self._sort_modes[self._sort_idx][0]
-        if mode == "price_asc":
-            self.items.sort(key=lambda it: (not self._is_currency(it), self._price_val(it), (it.get("name") or "").casefold(), int(it.get("id") or 0)))
-        elif mode == "price_desc":
-            self.items.sort(key=lambda it: (not self._is_currency(it), -self._price_val(it), (it.get("name") or "").casefold(), int(it.get("id") or 0)))
-        elif mode == "name":
-            self.items.sort(key=lambda it: ((it.get("name") or "").casefold(), int(it.get("id") or 0)))
-        elif mode == "id":
-            self.items.sort(key=lambda it: int(it.get("id") or 0))
-        self.max_page = max(0, (len(self.items) - 1) // SHOP_ITEMS_PER_PAGE)
+    def _sort_mode(self) -> str:
+        return self._sort_modes[self._sort_idx][0]
 
     async def interaction_check(self, interaction: disnake.MessageInteraction) -> bool:
         if interaction.user.id != self.author_id:
@@ -2357,78 +4077,15 @@ class ShopView(disnake.ui.View):
                 child.label = f"Сортировка: {self._current_sort_label()}"
                 break
 
-    def _page_slice(self) -> list[dict]:
-        start = self.page * SHOP_ITEMS_PER_PAGE
-        end = start + SHOP_ITEMS_PER_PAGE
-        return self.items[start:end]
-
     def _build_embed(self) -> disnake.Embed:
         embed = disnake.Embed(
             title="🛒 Магазин предметов",
             color=disnake.Color.blurple()
         )
-
-        header_lines = [
-            "🔸 Покупка: !buy [кол-во] <название>",
-            "🔸 Инфо о предмете: !item-info <название>",
-            ""
-        ]
-
-        page_items = self._page_slice()
-
-        all_items = list_items_db(self.ctx.guild.id)
-        id2name = {i["id"]: i["name"] for i in all_items}
-
-        lines = []
-
-        if not page_items:
-            lines.append("Пока нет предметов в магазине.")
-        else:
-            start_idx = self.page * SHOP_ITEMS_PER_PAGE
-
-            for idx, it in enumerate(page_items):
-                name = it.get("name", "Без названия")
-
-                # Описание — на следующей строке после цены/последнего ресурса
-                desc = (it.get("description") or "").strip() or "Без описания."
-                if len(desc) > 300:
-                    desc = desc[:297] + "..."
-
-                # Заголовок предмета: крупным жирным
-                title_line = f"**__{name}__**"
-
-                # Формируем блок строк для одного предмета
-                block = []
-
-                if (it.get("buy_price_type") or "currency") == "currency":
-                    price_str = format_price(it.get("price", 0))
-                    block.append(f"{title_line} — {price_str}")
-                    # Описание на следующей строке
-                    block.append(desc)
-                else:
-                    block.append(f"{title_line} — Цена (в ресурсах):")
-                    cost_items = it.get("cost_items") or []
-                    if not cost_items:
-                        block.append("   • ❌ Требования не заданы.")
-                    else:
-                        for r in cost_items:
-                            try:
-                                item_id = int(r.get("item_id"))
-                                qty = int(r.get("qty"))
-                            except Exception:
-                                continue
-                            res_name = id2name.get(item_id, f"ID {item_id}")
-                            block.append(f"   • {res_name} — {qty} шт.")
-                    # Описание после списка требований
-                    block.append(desc)
-
-                # Добавляем блок в общие строки, с пустой строкой-отступом между предметами
-                lines.extend(block)
-                if idx < len(page_items) - 1:
-                    lines.append("")
-
-        embed.description = "\n".join(header_lines + lines).rstrip()
-
+        embed.description, self.max_page = shop_page(self.guild_id, self.listed_only, self._sort_mode(), self.page)
+        # каталог мог измениться, пока панель была открыта
+        self.page = min(self.page, self.max_page)
+        self._sync_buttons_state()
         embed.set_footer(text=f"Страница {self.page + 1} / {self.max_page + 1} • Сортировка: {self._current_sort_label()}")
         
         return embed
@@ -2444,7 +4101,6 @@ class ShopView(disnake.ui.View):
     @disnake.ui.button(label="Сортировка", style=disnake.ButtonStyle.primary, custom_id="shop_sort", row=0)
     async def sort_toggle(self, button: disnake.ui.Button, inter: disnake.MessageInteraction):
         self._sort_idx = (self._sort_idx + 1) % len(self._sort_modes)
-        self._apply_sort()
         self.page = 0
         self._sync_buttons_state()
         self._update_sort_label()
@@ -2476,9 +4132,7 @@ async def shop_cmd(ctx: commands.Context, page: int = 1):
         return
     if not ctx.guild:
         return await ctx.send("Команда доступна только на сервере.")
-    all_items = list_items_db(ctx.guild.id)
-    items = [it for it in all_items if it["is_listed"]]
-    view = ShopView(ctx, items)
+    view = ShopView(ctx)
     if page > 0:
         view.page = min(max(0, page - 1), view.max_page)
         view._sync_buttons_state()
@@ -2514,32 +4168,6 @@ class ItemDraft:
     license_role_id: Optional[int] = None   # <<< НОВОЕ
 
 
-# Предполагается, что у тебя есть эти функции для работы с БД
-# Если их нет, используй примеры ниже как шаблон
-def search_items_by_name_or_id(guild_id: int, query: str) -> list[dict]:
-    """
-    Ищет предметы в БД по имени (частичное совпадение) или точному ID.
-    Это ПРИМЕР, адаптируй его под свою структуру БД.
-    """
-    conn = sqlite3.connect(get_db_path())
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    
-    # Сначала пробуем найти по ID, если query - это число
-    if query.isdigit():
-        c.execute("SELECT * FROM items WHERE guild_id = ? AND id = ?", (guild_id, int(query)))
-        item = c.fetchone()
-        if item:
-            conn.close()
-            return [dict(item)] # Возвращаем в виде списка из одного элемента
-
-    # Если по ID не нашли или query не число, ищем по имени
-    search_query = f"%{query.lower()}%"
-    c.execute("SELECT * FROM items WHERE guild_id = ? AND name_lower LIKE ? LIMIT 10", (guild_id, search_query))
-    items = [dict(row) for row in c.fetchall()]
-    conn.close()
-    return items
-
 async def resolve_item_by_user_input(
     ctx: commands.Context,
     query: str,
@@ -2547,18 +4175,26 @@ async def resolve_item_by_user_input(
     attempts: int = 3
 ) -> tuple[dict | None, str | None]:
     bot = ctx.bot
-    results = search_items_by_name_or_id(ctx.guild.id, query)
+    results = await db_run(search_items_by_name_or_id, ctx.guild.id, query)
+    fuzzy = False
 
     if not results:
-        return None, "Предмет с таким названием или ID не найден."
+        # Опечатка? Предложим похожие — выбор номером, как при нескольких совпадениях
+        results = (await db_run(get_item_fuzzy, ctx.guild.id)).suggest(query, limit=5)
+        fuzzy = True
+        if not results:
+            return None, "Предмет с таким названием или ID не найден."
 
     # ВАЖНО: нормализуем все результаты
     results = [ensure_item_normalized(it) for it in results]
 
-    if len(results) == 1:
+    if len(results) == 1 and not fuzzy:
         return results[0], None
 
-    description = "Найдено несколько предметов. Введите номер нужного вам предмета в чат.\n\n"
+    if fuzzy:
+        description = f"Предмет «{query}» не найден. Возможно, вы имели в виду — введите номер в чат:\n\n"
+    else:
+        description = "Найдено несколько предметов. Введите номер нужного вам предмета в чат.\n\n"
     for i, item in enumerate(results, 1):
         description += f"**{i}.** {item['name']} (ID: {item['id']})\n"
     
@@ -2642,7 +4278,7 @@ class BasicInfoModal(disnake.ui.Modal):
         if not name:
             return await inter.response.send_message(embed=error_embed("Ошибка", "Название не может быть пустым."), ephemeral=True)
 
-        exists = get_item_by_name(inter.guild.id, name)
+        exists = await db_run(get_item_by_name, inter.guild.id, name)
         # Если предмет с таким именем существует, И это НЕ тот предмет, который мы редактируем
         if exists and exists['id'] != self.view_ref.draft.editing_item_id:
             return await inter.response.send_message(embed=error_embed("Ошибка", "Предмет с таким именем уже существует."), ephemeral=True)
@@ -3061,8 +4697,7 @@ class CreateItemWizard(disnake.ui.View):
             if not self.draft.cost_items:
                 cost_desc = "🧱 Предметы: — не выбрано"
             else:
-                all_items = list_items_db(self.ctx.guild.id)
-                id2name = {i["id"]: i["name"] for i in all_items}
+                id2name = item_names_map(self.ctx.guild.id)
                 parts = []
                 for r in self.draft.cost_items:
                     nm = id2name.get(r['item_id'], 'ID ' + str(r['item_id']))
@@ -3197,7 +4832,7 @@ class CreateItemWizard(disnake.ui.View):
             if not self.draft.cost_items:
                 return await inter.response.send_message(embed=error_embed("Ошибка", "Добавьте хотя бы один предмет-стоимость (шаг 2)."), ephemeral=True)
 
-        exists = get_item_by_name(inter.guild.id, self.draft.name)
+        exists = await db_run(get_item_by_name, inter.guild.id, self.draft.name)
         if exists and exists['id'] != self.draft.editing_item_id:
             return await inter.response.send_message(embed=error_embed("Ошибка", "Предмет с таким именем уже существует."), ephemeral=True)
 
@@ -3244,69 +4879,73 @@ class CreateItemWizard(disnake.ui.View):
         except OverflowError:
             return await inter.response.send_message(embed=error_embed("Ошибка", "Одно из числовых значений слишком велико для хранения в базе."), ephemeral=True)
 
-        conn = sqlite3.connect(get_db_path())
-        c = conn.cursor()
-        try:
-            # --- Редактирование существующего ---
-            if editing_item_id_val:
-                c.execute("""
-                    UPDATE items SET
-                        name = ?, name_lower = ?, price = ?, sell_price = ?, description = ?,
-                        buy_price_type = ?, cost_items = ?, is_listed = ?, stock_total = ?, 
-                        restock_per_day = ?, per_user_daily_limit = ?, roles_required_buy = ?, 
-                        roles_required_sell = ?, roles_granted_on_buy = ?, roles_removed_on_buy = ?, 
-                        disallow_sell = ?, license_role_id = ?
-                    WHERE id = ? AND guild_id = ?
-                """, (
-                    self.draft.name, self.draft.name.lower(), price_val, sell_price_val, self.draft.description,
-                    self.draft.buy_price_type, json.dumps(self.draft.cost_items) if self.draft.cost_items else None,
-                    is_listed_val, stock_total_val, restock_per_day_val, per_user_daily_limit_val,
-                    csv_from_ids(self.draft.roles_required_buy) or None,
-                    csv_from_ids(self.draft.roles_required_sell) or None,
-                    csv_from_ids(self.draft.roles_granted_on_buy) or None,
-                    csv_from_ids(self.draft.roles_removed_on_buy) or None,
-                    disallow_sell_val, license_role_id_val,
-                    editing_item_id_val, guild_id_val
-                ))
-                conn.commit()
-                # Сбросим состояние склада, чтобы оно пересоздалось с новыми параметрами
-                c.execute("DELETE FROM item_shop_state WHERE guild_id = ? AND item_id = ?", (guild_id_val, editing_item_id_val))
-                conn.commit()
+        # Запись — в потоке БД: писатель не должен блокировать event loop
+        def _write():
+            conn = db_connect()
+            c = conn.cursor()
+            try:
+                # --- Редактирование существующего ---
+                if editing_item_id_val:
+                    c.execute("""
+                        UPDATE items SET
+                            name = ?, name_lower = ?, price = ?, sell_price = ?, description = ?,
+                            buy_price_type = ?, cost_items = ?, is_listed = ?, stock_total = ?, 
+                            restock_per_day = ?, per_user_daily_limit = ?, roles_required_buy = ?, 
+                            roles_required_sell = ?, roles_granted_on_buy = ?, roles_removed_on_buy = ?, 
+                            disallow_sell = ?, license_role_id = ?
+                        WHERE id = ? AND guild_id = ?
+                    """, (
+                        self.draft.name, self.draft.name.lower(), price_val, sell_price_val, self.draft.description,
+                        self.draft.buy_price_type, json.dumps(self.draft.cost_items) if self.draft.cost_items else None,
+                        is_listed_val, stock_total_val, restock_per_day_val, per_user_daily_limit_val,
+                        csv_from_ids(self.draft.roles_required_buy) or None,
+                        csv_from_ids(self.draft.roles_required_sell) or None,
+                        csv_from_ids(self.draft.roles_granted_on_buy) or None,
+                        csv_from_ids(self.draft.roles_removed_on_buy) or None,
+                        disallow_sell_val, license_role_id_val,
+                        editing_item_id_val, guild_id_val
+                    ))
+                    conn.commit()
+                    # Сбросим состояние склада, чтобы оно пересоздалось с новыми параметрами
+                    c.execute("DELETE FROM item_shop_state WHERE guild_id = ? AND item_id = ?", (guild_id_val, editing_item_id_val))
+                    conn.commit()
                 
-            # --- Создание нового ---
-            else:
-                c.execute("""
-                    INSERT INTO items (
-                        guild_id, name, name_lower, price, sell_price, description,
-                        buy_price_type, cost_items, is_listed, stock_total, restock_per_day,
-                        per_user_daily_limit, roles_required_buy, roles_required_sell,
-                        roles_granted_on_buy, roles_removed_on_buy, disallow_sell, license_role_id
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    guild_id_val, self.draft.name, self.draft.name.lower(), price_val, sell_price_val, self.draft.description,
-                    self.draft.buy_price_type, json.dumps(self.draft.cost_items) if self.draft.cost_items else None,
-                    is_listed_val, stock_total_val, restock_per_day_val, per_user_daily_limit_val,
-                    csv_from_ids(self.draft.roles_required_buy) or None,
-                    csv_from_ids(self.draft.roles_required_sell) or None,
-                    csv_from_ids(self.draft.roles_granted_on_buy) or None,
-                    csv_from_ids(self.draft.roles_removed_on_buy) or None,
-                    disallow_sell_val, license_role_id_val
-                ))
-                conn.commit()
-                item_id = c.lastrowid
-                if item_id:
+                # --- Создание нового ---
+                else:
                     c.execute("""
-                        INSERT OR IGNORE INTO item_shop_state (guild_id, item_id, current_stock, last_restock_ymd)
-                        VALUES (?, ?, ?, ?)
-                    """, (guild_id_val, item_id, stock_total_val, ymd_utc()))
+                        INSERT INTO items (
+                            guild_id, name, name_lower, price, sell_price, description,
+                            buy_price_type, cost_items, is_listed, stock_total, restock_per_day,
+                            per_user_daily_limit, roles_required_buy, roles_required_sell,
+                            roles_granted_on_buy, roles_removed_on_buy, disallow_sell, license_role_id
+                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """, (
+                        guild_id_val, self.draft.name, self.draft.name.lower(), price_val, sell_price_val, self.draft.description,
+                        self.draft.buy_price_type, json.dumps(self.draft.cost_items) if self.draft.cost_items else None,
+                        is_listed_val, stock_total_val, restock_per_day_val, per_user_daily_limit_val,
+                        csv_from_ids(self.draft.roles_required_buy) or None,
+                        csv_from_ids(self.draft.roles_required_sell) or None,
+                        csv_from_ids(self.draft.roles_granted_on_buy) or None,
+                        csv_from_ids(self.draft.roles_removed_on_buy) or None,
+                        disallow_sell_val, license_role_id_val
+                    ))
                     conn.commit()
+                    item_id = c.lastrowid
+                    if item_id:
+                        c.execute("""
+                            INSERT OR IGNORE INTO item_shop_state (guild_id, item_id, current_stock, last_restock_ymd)
+                            VALUES (?, ?, ?, ?)
+                        """, (guild_id_val, item_id, stock_total_val, ymd_utc()))
+                        conn.commit()
+            finally:
+                conn.close()
+                invalidate_item_catalog(guild_id_val)
 
+        try:
+            await db_run(_write)
         except sqlite3.IntegrityError as e:
-            conn.close()
             print(f"Ошибка сохранения предмета: {e}")
             return await inter.response.send_message(embed=error_embed("Ошибка", "Предмет с таким именем уже существует (ошибка базы данных)."), ephemeral=True)
-        finally:
-            conn.close()
 
         # --- Логирование ---
         is_editing = self.draft.editing_item_id is not None
@@ -3436,6 +5075,7 @@ ADMIN_COMMANDS_WITH_FLAGS: list[tuple[str, str, str]] = [
     ("!add-money-role", "выдать деньги", "ALLOWED_ADD_MONEY_ROLE"),
     ("!remove-money-role", "забрать деньги", "ALLOWED_REMOVE_MONEY_ROLE"),
     ("!reset-money-role", "обнулить баланс", "ALLOWED_RESET_MONEY_ROLE"),
+    ("!history", "история операций участника", "ALLOWED_HISTORY"),
     ("!role-income", "добавить доходные роли", "ALLOWED_ROLE_INCOME"),
     ("!edit-item", "изменить предмет", "ALLOWED_EDIT_ITEM"),
     ("!delete-item", "удалить предмет", "ALLOWED_DELETE_ITEM"),
@@ -3610,7 +5250,8 @@ async def ping_cmd(ctx: commands.Context):
         color=disnake.Color.green(),
         description=(
             f"• WS-пинг: **{ws_ms:.0f} мс**\n"
-            f"• REST-пинг: **{rest_ms:.0f} мс**"
+            f"• REST-пинг: **{rest_ms:.0f} мс**\n"
+            f"• Задержка event loop: **{LOOP_LAG_STATS['avg_ms']:.1f} мс** (макс. {LOOP_LAG_STATS['max_ms']:.0f} мс)"
         )
     )
 
@@ -3618,6 +5259,126 @@ async def ping_cmd(ctx: commands.Context):
     await msg.edit(content=None, embed=embed)
 
 
+@bot.command(name="db-stats", aliases=["dbstats"])
+@commands.has_permissions(administrator=True)
+async def db_stats_cmd(ctx: commands.Context):
+    """
+    Счётчики пула соединений SQLite:
+      !db-stats
+    """
+    st = db_stats()
+    embed = disnake.Embed(
+        title="🗄️ База данных",
+        color=disnake.Color.blurple(),
+        description=(
+            f"• Открыто соединений: **{format_number(st['connections_opened'])}**\n"
+            f"• Выполнено SQL-выражений: **{format_number(st['statements_executed'])}**, коммитов {format_number(st['commits'])}\n"
+            f"• Выдач соединений из пула: **{format_number(st['checkouts'])}**\n"
+            f"• Читателей: **{st['readers_open']}** (свободно {st['readers_idle']})\n"
+            f"• Задержка event loop: **{LOOP_LAG_STATS['avg_ms']:.1f} мс** (макс. {LOOP_LAG_STATS['max_ms']:.0f} мс)\n"
+            f"• Кэш каталога предметов: попаданий **{format_number(ITEM_CATALOG_STATS['hits'])}**, "
+            f"промахов **{format_number(ITEM_CATALOG_STATS['misses'])}**, сбросов {format_number(ITEM_CATALOG_STATS['invalidations'])}\n"
+            f"• Отложенная запись балансов: {'вкл.' if BALANCE_WRITE_BEHIND else 'выкл.'}, "
+            f"в очереди **{len(balance_cache)}**, записей пачкой {format_number(balance_cache.flushes)}\n"
+            f"• Автовыплата дохода ролей: {'вкл.' if ROLE_INCOME_AUTO else 'выкл.'}, "
+            f"выплат **{format_number(ROLE_INCOME_AUTO_STATS['paid'])}**, "
+            f"последний тик {ROLE_INCOME_AUTO_STATS['last_tick_ms']:.0f} мс\n"
+            f"• Обслуживание: запусков {MAINTENANCE_STATS['runs']}, "
+            f"удалено строк в последний раз **{format_number(MAINTENANCE_STATS['last_deleted'])}**, "
+            f"освобождено всего {MAINTENANCE_STATS['total_reclaimed_bytes'] / 1024:.0f} КБ\n"
+            f"• Логи: в очереди **{_log_queue.qsize() if _log_queue else 0}**, "
+            f"отправлено {format_number(LOG_DISPATCH_STATS['embeds'])} эмбедов в {format_number(LOG_DISPATCH_STATS['messages'])} сообщениях, "
+            f"каналов в отправке {len(_log_senders)}, отброшено {LOG_DISPATCH_STATS['dropped']}\n"
+            f"• Снимки: снято {SNAPSHOT_STATS['taken']}, последний {SNAPSHOT_STATS['last_name'] or '—'} "
+            f"({SNAPSHOT_STATS['last_ms']:.0f} мс), восстановлений {SNAPSHOT_STATS['restores']}"
+        )
+    )
+    await ctx.send(embed=embed)
+
+
+# ======== Аудит планов запросов ========
+_SQL_START_RE = re.compile(r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\s+\S", re.IGNORECASE)
+
+def collect_sql_statements() -> list[str]:
+    """
+    Все SQL-литералы из исходника бота (SELECT/INSERT/UPDATE/DELETE/WITH).
+    Запросы, собираемые f-строкой (IN (?, ?, ...) и т. п.), сюда не попадают.
+    """
+    import ast
+    with open(__file__, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    fstring_parts = {id(v) for node in ast.walk(tree) if isinstance(node, ast.JoinedStr) for v in node.values}
+    seen: dict[str, None] = {}
+    for node in ast.walk(tree):
+        if id(node) in fstring_parts:
+            continue
+        if isinstance(node, ast.Constant) and isinstance(node.value, str) and _SQL_START_RE.match(node.value):
+            sql = " ".join(node.value.split())
+            if " FROM " in sql.upper() or sql.upper().startswith(("INSERT", "UPDATE", "DELETE")):
+                seen.setdefault(sql, None)
+    return list(seen)
+
+def explain_query_plans() -> list[dict]:
+    """
+    EXPLAIN QUERY PLAN для каждого запроса (параметры — NULL).
+    full_scan=True, если в плане есть «SCAN <таблица>» без индекса.
+    """
+    result = []
+    conn = db_connect(readonly=True)
+    try:
+        c = conn.cursor()
+        for sql in collect_sql_statements():
+            # Запросы к подключаемому снимку (ATTACH ... AS snap) без него не разобрать
+            if re.search(r"\bsnap\.", sql):
+                continue
+            entry = {"sql": sql, "plan": [], "full_scan": False, "error": None}
+            try:
+                c.execute("EXPLAIN QUERY PLAN " + sql, (None,) * sql.count("?"))
+                entry["plan"] = [row[3] for row in c.fetchall()]
+            except sqlite3.Error as e:
+                entry["error"] = str(e)
+            entry["full_scan"] = any(
+                d.startswith("SCAN ") and " USING " not in d and not d.startswith("SCAN CONSTANT")
+                for d in entry["plan"]
+            )
+            result.append(entry)
+    finally:
+        conn.close()
+    return result
+
+@bot.command(name="explain-queries", aliases=["eqp"])
+@commands.is_owner()
+async def explain_queries_cmd(ctx: commands.Context):
+    """
+    Для разработчика: планы всех запросов бота, полные сканы таблиц — отдельно.
+      !explain-queries
+    """
+    plans = await db_run(explain_query_plans)
+    scans = [p for p in plans if p["full_scan"]]
+    errors = [p for p in plans if p["error"]]
+
+    lines = []
+    for p in scans:
+        sql = p["sql"] if len(p["sql"]) <= 160 else p["sql"][:157] + "..."
+        lines.append(f"⚠️ `{sql}`\n   → {'; '.join(p['plan'])}")
+    for p in errors:
+        sql = p["sql"] if len(p["sql"]) <= 120 else p["sql"][:117] + "..."
+        lines.append(f"❌ `{sql}`\n   → {p['error']}")
+
+    description = "\n".join(lines) or "Полных сканов таблиц не найдено."
+    if len(description) > 4000:
+        description = description[:3990] + "\n…"
+    embed = disnake.Embed(
+        title="🔎 Планы запросов",
+        color=disnake.Color.orange() if scans else disnake.Color.green(),
+        description=description,
+    )
+    embed.set_footer(text=f"Запросов: {len(plans)} • полных сканов: {len(scans)} • ошибок: {len(errors)}")
+    await ctx.send(embed=embed)
+    for p in scans:
+        print(f"[explain] SCAN: {p['sql']}\n          {' | '.join(p['plan'])}")
+
+
 ALL_ADMIN_COMMANDS: list[tuple[str, str]] = [
     (cmd, desc) for cmd, desc, _ in ADMIN_COMMANDS_WITH_FLAGS
 ]
@@ -3715,6 +5476,50 @@ async def edit_item_cmd(ctx: commands.Context, *, item_name: str):
     view.message = msg
 
 # ====================== DELETE ITEM ======================
+def db_delete_item(guild_id: int, item_id: int) -> int:
+    """
+    Удаляет предмет и связанные данные одной транзакцией (в потоке БД).
+    Возвращает число вычищенных ссылок на предмет из стоимостей других предметов.
+    """
+    conn = db_connect()
+    c = conn.cursor()
+    cleaned_refs = 0
+    try:
+        # Чистим ссылки в других предметах (cost_items), чтобы не оставались «битые» ссылки
+        c.execute("SELECT id, cost_items FROM items WHERE guild_id = ? AND id != ?", (guild_id, item_id))
+        for other_id, rcost in c.fetchall():
+            changed = False
+            if rcost:
+                try:
+                    arr = json.loads(rcost)
+                    new_arr = [r for r in (arr or []) if str(r.get("item_id")) != str(item_id)]
+                    if len(new_arr) != len(arr):
+                        changed = True
+                        cleaned_refs += (len(arr) - len(new_arr))
+                        # Если оплата предметами, но список пуст — можно оставить пустой JSON или NULL
+                        # В остальном коде пустота обрабатывается как []
+                        new_val = json.dumps(new_arr) if new_arr else None
+                        c.execute("UPDATE items SET cost_items = ? WHERE guild_id = ? AND id = ?", (new_val, guild_id, other_id))
+                except Exception:
+                    pass
+
+        # Удаляем записи инвентарей
+        _journal_inventory_removal(c, "guild_id = ? AND item_id = ?", (guild_id, item_id), "item_delete")
+        c.execute("DELETE FROM inventories WHERE guild_id = ? AND item_id = ?", (guild_id, item_id))
+        # Удаляем состояние склада и дневные лимиты
+        c.execute("DELETE FROM item_shop_state WHERE guild_id = ? AND item_id = ?", (guild_id, item_id))
+        c.execute("DELETE FROM item_user_daily WHERE guild_id = ? AND item_id = ?", (guild_id, item_id))
+        # Удаляем сам предмет
+        c.execute("DELETE FROM items WHERE guild_id = ? AND id = ?", (guild_id, item_id))
+        conn.commit()
+        return cleaned_refs
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+        invalidate_item_catalog(guild_id)
+
 @bot.command(name="delete-item", aliases=["Delete-item", "DELETE-ITEM"])
 async def delete_item_cmd(ctx: commands.Context, *, item_query: str = ""):
     """
@@ -3739,30 +5544,29 @@ async def delete_item_cmd(ctx: commands.Context, *, item_query: str = ""):
     item_name = item["name"]
 
     # Подсчёт зависимостей (инвентари, ссылки в других предметах и пр.) — чтобы предупредить перед удалением
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
+    with db_reader() as conn:
+        c = conn.cursor()
 
-    # Сколько всего экземпляров предмета у пользователей и у скольких пользователей он есть
-    c.execute("SELECT COALESCE(SUM(quantity), 0) FROM inventories WHERE guild_id = ? AND item_id = ?", (guild_id, item_id))
-    total_qty = int(c.fetchone()[0] or 0)
-    c.execute("SELECT COUNT(*) FROM inventories WHERE guild_id = ? AND item_id = ? AND quantity > 0", (guild_id, item_id))
-    holders = int(c.fetchone()[0] or 0)
-
-    # Сколько ссылок на этот предмет в стоимостях других предметов
-    c.execute("SELECT id, name, cost_items FROM items WHERE guild_id = ? AND id != ?", (guild_id, item_id))
-    rows = c.fetchall()
-    ref_count = 0
-    for iid, iname, rcost in rows:
-        if rcost:
-            try:
-                arr = json.loads(rcost)
-                for r in arr or []:
-                    if str(r.get("item_id")) == str(item_id):
-                        ref_count += 1
-            except Exception:
-                pass
+        # Сколько всего экземпляров предмета у пользователей и у скольких пользователей он есть
+        c.execute("SELECT COALESCE(SUM(quantity), 0) FROM inventories WHERE guild_id = ? AND item_id = ?", (guild_id, item_id))
+        total_qty = int(c.fetchone()[0] or 0)
+        c.execute("SELECT COUNT(*) FROM inventories WHERE guild_id = ? AND item_id = ? AND quantity > 0", (guild_id, item_id))
+        holders = int(c.fetchone()[0] or 0)
+
+        # Сколько ссылок на этот предмет в стоимостях других предметов
+        c.execute("SELECT id, name, cost_items FROM items WHERE guild_id = ? AND id != ?", (guild_id, item_id))
+        rows = c.fetchall()
+        ref_count = 0
+        for iid, iname, rcost in rows:
+            if rcost:
+                try:
+                    arr = json.loads(rcost)
+                    for r in arr or []:
+                        if str(r.get("item_id")) == str(item_id):
+                            ref_count += 1
+                except Exception:
+                    pass
 
-    conn.close()
 
     # Подтверждение удаления
     warn_lines = [
@@ -3799,42 +5603,10 @@ async def delete_item_cmd(ctx: commands.Context, *, item_query: str = ""):
         return await ctx.send("Время на подтверждение истекло. Удаление отменено.", delete_after=10)
 
     # Удаляем предмет и связанные данные
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    cleaned_refs = 0
     try:
-        # Чистим ссылки в других предметах (cost_items), чтобы не оставались «битые» ссылки
-        c.execute("SELECT id, cost_items FROM items WHERE guild_id = ? AND id != ?", (guild_id, item_id))
-        for other_id, rcost in c.fetchall():
-            changed = False
-            if rcost:
-                try:
-                    arr = json.loads(rcost)
-                    new_arr = [r for r in (arr or []) if str(r.get("item_id")) != str(item_id)]
-                    if len(new_arr) != len(arr):
-                        changed = True
-                        cleaned_refs += (len(arr) - len(new_arr))
-                        # Если оплата предметами, но список пуст — можно оставить пустой JSON или NULL
-                        # В остальном коде пустота обрабатывается как []
-                        new_val = json.dumps(new_arr) if new_arr else None
-                        c.execute("UPDATE items SET cost_items = ? WHERE guild_id = ? AND id = ?", (new_val, guild_id, other_id))
-                except Exception:
-                    pass
-
-        # Удаляем записи инвентарей
-        c.execute("DELETE FROM inventories WHERE guild_id = ? AND item_id = ?", (guild_id, item_id))
-        # Удаляем состояние склада и дневные лимиты
-        c.execute("DELETE FROM item_shop_state WHERE guild_id = ? AND item_id = ?", (guild_id, item_id))
-        c.execute("DELETE FROM item_user_daily WHERE guild_id = ? AND item_id = ?", (guild_id, item_id))
-        # Удаляем сам предмет
-        c.execute("DELETE FROM items WHERE guild_id = ? AND id = ?", (guild_id, item_id))
-        conn.commit()
+        cleaned_refs = await db_run(db_delete_item, guild_id, item_id)
     except Exception as e:
-        conn.rollback()
-        conn.close()
         return await ctx.send(embed=error_embed("Ошибка удаления", f"Не удалось удалить предмет: {e}"))
-    finally:
-        conn.close()
 
     # Логи (если у вас есть send_shop_item_action_log)
     try:
@@ -3872,8 +5644,7 @@ async def item_list_cmd(ctx: commands.Context, page: int = 1):
     if not ctx.guild:
         return await ctx.send("Команда доступна только на сервере.")
 
-    all_items = list_items_db(ctx.guild.id)  # берём все, без фильтра is_listed
-    view = ShopView(ctx, all_items)
+    view = ShopView(ctx, listed_only=False)  # все предметы, без фильтра is_listed
     if page > 0:
         view.page = min(max(0, page - 1), view.max_page)
         view._sync_buttons_state()
@@ -3939,52 +5710,23 @@ async def buy_cmd(ctx: commands.Context, *, raw: str):
             return await ctx.send(embed=emb)
     # ——— конец проверки лицензии ———
 
-    ensure_item_state(ctx.guild.id, item)
-    stock = get_current_stock(ctx.guild.id, item["id"])
-    if stock is not None and stock < amount:
-        return await ctx.send(embed=error_embed("Недостаточно на складе", f"Доступно только {stock} шт."))
-
-    if item["per_user_daily_limit"] > 0:
-        used = get_user_daily_used(ctx.guild.id, item["id"], ctx.author.id)
-        remain = item["per_user_daily_limit"] - used
-        if remain <= 0 or amount > remain:
-            return await ctx.send(embed=error_embed("Превышен дневной лимит", f"Доступно к покупке сегодня: {max(remain,0)} шт."))
-
-    total_cost_money = 0
-    need_items = []
-
-    if item["buy_price_type"] == "currency":
-        total_cost_money = item["price"] * amount
-        bal = get_balance(ctx.guild.id, ctx.author.id)
-        if bal < total_cost_money:
-            return await ctx.send(embed=error_embed("Недостаточно средств", f"Нужно {format_price(total_cost_money)}, у вас {format_number(bal)} {MONEY_EMOJI}."))
-    else:
-        # cost_items гарантированно list[dict] после ensure_item_normalized
-        for r in item["cost_items"]:
-            need_items.append({"item_id": int(r["item_id"]), "qty": int(r["qty"]) * amount})
-        lacking = []
-        all_items_map = {it["id"]: it for it in list_items_db(ctx.guild.id)}
-        for r in need_items:
-            have = get_user_item_qty(ctx.guild.id, ctx.author.id, r["item_id"])
-            if have < r["qty"]:
-                lacking.append(f"{all_items_map.get(r['item_id'], {'name': 'ID '+str(r['item_id'])})['name']} {r['qty']} шт. ( у вас {have} шт. )")
-        if lacking:
-            return await ctx.send(embed=error_embed(":no_entry_sign: Нехватка предметов:", "**Нехватает:**\n- " + "\n- ".join(lacking)))
-
-    if total_cost_money > 0:
-        update_balance(ctx.guild.id, ctx.author.id, -total_cost_money)
-    if need_items:
-        for r in need_items:
-            ok = remove_items_from_user(ctx.guild.id, ctx.author.id, r["item_id"], r["qty"])
-            if not ok:
-                return await ctx.send(embed=error_embed("Ошибка", "Не удалось списать требуемые предметы. Попробуйте снова."))
-
-    add_items_to_user(ctx.guild.id, ctx.author.id, item["id"], amount)
+    res = await db_run(db_buy_item, ctx.guild.id, ctx.author.id, item, amount)
+    if not res.ok:
+        if res.reason == "stock":
+            return await ctx.send(embed=error_embed("Недостаточно на складе", f"Доступно только {res.stock} шт."))
+        if res.reason == "daily_limit":
+            return await ctx.send(embed=error_embed("Превышен дневной лимит", f"Доступно к покупке сегодня: {max(res.daily_remain, 0)} шт."))
+        if res.reason == "money":
+            return await ctx.send(embed=error_embed("Недостаточно средств", f"Нужно {format_price(res.cost_money)}, у вас {format_number(res.balance)} {MONEY_EMOJI}."))
+        id2name = await db_run(item_names_map, ctx.guild.id)
+        lacking = [
+            f"{id2name.get(r['item_id'], 'ID ' + str(r['item_id']))} {r['qty']} шт. ( у вас {r['have']} шт. )"
+            for r in res.lacking
+        ]
+        return await ctx.send(embed=error_embed(":no_entry_sign: Нехватка предметов:", "**Нехватает:**\n- " + "\n- ".join(lacking)))
 
-    if stock is not None:
-        change_stock(ctx.guild.id, item["id"], -amount)
-    if item["per_user_daily_limit"] > 0:
-        add_user_daily_used(ctx.guild.id, item["id"], ctx.author.id, amount)
+    total_cost_money = res.cost_money
+    need_items = res.cost_items
 
     if item["roles_removed_on_buy"]:
         roles_to_remove = [ctx.guild.get_role(r) for r in item["roles_removed_on_buy"] if ctx.guild.get_role(r)]
@@ -3997,13 +5739,12 @@ async def buy_cmd(ctx: commands.Context, *, raw: str):
             with contextlib.suppress(Exception):
                 await ctx.author.add_roles(*roles_to_add, reason=f"Покупка предмета: {item['name']}")
 
-    new_bal = get_balance(ctx.guild.id, ctx.author.id)
     desc = f"**Вы купили:** {amount} шт. *{item['name']}*!"
     if total_cost_money > 0:
         desc += f"\n**Списано:** {format_price(total_cost_money)}."
     elif need_items:
         # Вывести списанные предметы в столбик
-        id2name = {it["id"]: it["name"] for it in list_items_db(ctx.guild.id)}
+        id2name = await db_run(item_names_map, ctx.guild.id)
         lines = []
         for r in need_items:
             nm = id2name.get(r["item_id"], f"ID {r['item_id']}")
@@ -4041,16 +5782,16 @@ async def sell_cmd(ctx: commands.Context, *, raw: str):
     if item["disallow_sell"]:
         return await ctx.send(embed=error_embed("Продажа запрещена", "Этот предмет нельзя продать системе."))
 
-    have = get_user_item_qty(ctx.guild.id, ctx.author.id, item["id"])
+    have = await db_run(get_user_item_qty, ctx.guild.id, ctx.author.id, item["id"])
     if have < amount:
         return await ctx.send(embed=error_embed("Недостаточно предметов", f"У вас только {have}× «{item['name']}»."))
-    if not remove_items_from_user(ctx.guild.id, ctx.author.id, item["id"], amount):
+    if not await db_run(remove_items_from_user, ctx.guild.id, ctx.author.id, item["id"], amount, "sell"):
         return await ctx.send(embed=error_embed("Ошибка", "Не удалось списать предметы. Попробуйте снова."))
 
     sell_each = item["sell_price"] if item["sell_price"] is not None else effective_sell_price(item)
     total = sell_each * amount
-    update_balance(ctx.guild.id, ctx.author.id, total)
-    new_bal = get_balance(ctx.guild.id, ctx.author.id)
+    await db_run(update_balance, ctx.guild.id, ctx.author.id, total, "sell")
+    new_bal = await db_run(get_balance, ctx.guild.id, ctx.author.id)
 
     embed = disnake.Embed(
         title="Продажа успешна",
@@ -4091,13 +5832,11 @@ async def item_info_cmd(ctx: commands.Context, *, name: str):
     # ВАЖНО: нормализация
     item = ensure_item_normalized(item)
 
-    ensure_item_state(ctx.guild.id, item)
-    stock_now = get_current_stock(ctx.guild.id, item["id"])
-    user_qty = get_user_item_qty(ctx.guild.id, ctx.author.id, item["id"])
-    balance = get_balance(ctx.guild.id, ctx.author.id)
+    stock_now = await db_run(get_effective_stock, ctx.guild.id, item)
+    user_qty = await db_run(get_user_item_qty, ctx.guild.id, ctx.author.id, item["id"])
+    balance = await db_run(get_balance, ctx.guild.id, ctx.author.id)
 
-    all_items = list_items_db(ctx.guild.id)
-    id2name = {i["id"]: i["name"] for i in all_items}
+    id2name = await db_run(item_names_map, ctx.guild.id)
 
     embed = disnake.Embed(
         title=f"📦 {item['name']}",
@@ -4175,11 +5914,10 @@ async def item_info_cmd(ctx: commands.Context, *, name: str):
     lic_val = "—"
     try:
         # item тут — нормализованный dict, но license может отсутствовать; достанем сырцом
-        conn = sqlite3.connect(get_db_path())
-        c = conn.cursor()
-        c.execute("SELECT license_role_id FROM items WHERE guild_id=? AND id=?", (ctx.guild.id, item["id"]))
-        row = c.fetchone()
-        conn.close()
+        with db_reader() as conn:
+            c = conn.cursor()
+            c.execute("SELECT license_role_id FROM items WHERE guild_id=? AND id=?", (ctx.guild.id, item["id"]))
+            row = c.fetchone()
         if row and row[0]:
             lic_val = f"<@&{int(row[0])}>"
     except:
@@ -4198,18 +5936,17 @@ def list_user_inventory_db(guild_id: int, user_id: int) -> list[dict]:
     Возвращает список предметов пользователя:
     [{ item_id, name, description, quantity }]
     """
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""
-        SELECT i.id, i.name, i.description, inv.quantity
-        FROM inventories AS inv
-        JOIN items AS i
-          ON i.id = inv.item_id AND i.guild_id = inv.guild_id
-        WHERE inv.guild_id = ? AND inv.user_id = ?
-        ORDER BY i.name_lower
-    """, (guild_id, user_id))
-    rows = c.fetchall()
-    conn.close()
+    with db_reader() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT i.id, i.name, i.description, inv.quantity
+            FROM inventories AS inv
+            JOIN items AS i
+              ON i.id = inv.item_id AND i.guild_id = inv.guild_id
+            WHERE inv.guild_id = ? AND inv.user_id = ?
+            ORDER BY i.name_lower
+        """, (guild_id, user_id))
+        rows = c.fetchall()
     return [
         {
             "item_id": r[0],
@@ -4340,7 +6077,7 @@ class InventoryPermissionView(disnake.ui.View):
     async def allow(self, button: disnake.ui.Button, inter: disnake.MessageInteraction):
         await inter.response.defer()
         # Отправляем инвентарь владельца — запрашивающему
-        items = list_user_inventory_db(self.ctx.guild.id, self.owner.id)
+        items = await db_run(list_user_inventory_db, self.ctx.guild.id, self.owner.id)
         inv_view = InventoryView(self.ctx, items, owner=self.owner)
         embed = inv_view._build_embed()
         msg = await self.ctx.send(content=self.requester.mention, embed=embed, view=inv_view)
@@ -4471,7 +6208,7 @@ class ExportDealView(disnake.ui.View):
 
     async def _finish_as(self, inter: disnake.MessageInteraction, status: str, success: bool, info_ephemeral: Optional[str] = None):
         try:
-            db_update_export_status(self.deal_id, status)
+            await db_run(db_update_export_status, self.deal_id, status)
         except Exception:
             pass
 
@@ -4494,29 +6231,19 @@ class ExportDealView(disnake.ui.View):
     async def accept(self, button: disnake.ui.Button, inter: disnake.MessageInteraction):
         await inter.response.defer()
 
-        # Повторные проверки (пока шло ожидание):
-        # 1) Наличие предметов у продавца
-        have = get_user_item_qty(self.ctx.guild.id, self.seller.id, self.item["id"])
-        if have < self.quantity:
-            return await self._finish_as(inter, "rejected", False, info_ephemeral="У продавца больше нет нужного количества товара.")
-
-        # 2) Деньги у покупателя
-        buyer_bal = get_balance(self.ctx.guild.id, self.buyer.id)
-        if buyer_bal < self.total:
+        # Одна транзакция: товар продавец -> покупатель, оплата (сумма + доставка) с покупателя,
+        # продавцу — только сумма сделки без доставки. Наличие товара и денег проверяется в SQL.
+        res = await db_run(
+            db_ledger_transfer, self.ctx.guild.id, self.buyer.id, self.total,
+            [(self.seller.id, self.price)],
+            item_moves=[(self.seller.id, self.buyer.id, self.item["id"], self.quantity)],
+            reason="export"
+        )
+        if not res.ok:
+            if res.reason == "items":
+                return await self._finish_as(inter, "rejected", False, info_ephemeral="У продавца больше нет нужного количества товара.")
             return await self._finish_as(inter, "rejected", False, info_ephemeral="Недостаточно средств для оплаты сделки.")
 
-        # Проводим транзакцию шагами с доп. проверками
-        # Списание предметов у продавца
-        if not remove_items_from_user(self.ctx.guild.id, self.seller.id, self.item["id"], self.quantity):
-            return await self._finish_as(inter, "rejected", False, info_ephemeral="Не удалось списать товар у продавца.")
-
-        # Списание денег у покупателя
-        update_balance(self.ctx.guild.id, self.buyer.id, -self.total)
-        # Начисление денег продавцу (только сумма сделки без доставки)
-        update_balance(self.ctx.guild.id, self.seller.id, self.price)
-        # Выдача товара покупателю
-        add_items_to_user(self.ctx.guild.id, self.buyer.id, self.item["id"], self.quantity)
-
         # Обновляем статус и финалим
         await self._finish_as(inter, "accepted", True, info_ephemeral="Сделка успешно проведена.")
 
@@ -4527,7 +6254,7 @@ class ExportDealView(disnake.ui.View):
 
     async def on_timeout(self):
         try:
-            db_update_export_status(self.deal_id, "expired")
+            await db_run(db_update_export_status, self.deal_id, "expired")
         except Exception:
             pass
         self._disable_all()
@@ -4610,13 +6337,13 @@ async def export_cmd(ctx: commands.Context, member: disnake.Member, *, raw: str)
 
     # Предварительные проверки
     # 1) Продавец: наличие нужного количества
-    have = get_user_item_qty(ctx.guild.id, seller.id, item["id"])
+    have = await db_run(get_user_item_qty, ctx.guild.id, seller.id, item["id"])
     if have < qty:
         return await ctx.send(embed=error_embed("Недостаточно предметов", f"У вас только {have} шт. «{item['name']}»."))
     # 2) Покупатель: хватает ли денег с учётом доставки
     delivery = (price * 5 + 50) // 100  # 5% c округлением
     total = price + delivery
-    buyer_balance = get_balance(ctx.guild.id, buyer.id)
+    buyer_balance = await db_run(get_balance, ctx.guild.id, buyer.id)
     if buyer_balance < total:
         nice = disnake.Embed(
             title="Недостаточно средств",
@@ -4631,7 +6358,8 @@ async def export_cmd(ctx: commands.Context, member: disnake.Member, *, raw: str)
         return await ctx.send(embed=nice)
 
     # Создаём запись в БД (pending)
-    deal_id = db_create_export_deal(
+    deal_id = await db_run(
+        db_create_export_deal,
         guild_id=ctx.guild.id,
         seller_id=seller.id,
         buyer_id=buyer.id,
@@ -4706,7 +6434,7 @@ async def inv_cmd(ctx: commands.Context, arg: Optional[str] = None, page: int =
 
     # Если аргумент не указан — показываем свой инвентарь (как раньше, с поддержкой page)
     if arg is None:
-        items = list_user_inventory_db(ctx.guild.id, ctx.author.id)
+        items = await db_run(list_user_inventory_db, ctx.guild.id, ctx.author.id)
         view = InventoryView(ctx, items, owner=ctx.author)
         if page > 0:
             view.page = min(max(0, page - 1), view.max_page)
@@ -4733,7 +6461,7 @@ async def inv_cmd(ctx: commands.Context, arg: Optional[str] = None, page: int =
     if target_member:
         # Если запрос к себе — просто открыть как обычно
         if target_member.id == ctx.author.id:
-            items = list_user_inventory_db(ctx.guild.id, ctx.author.id)
+            items = await db_run(list_user_inventory_db, ctx.guild.id, ctx.author.id)
             view = InventoryView(ctx, items, owner=ctx.author)
             embed = view._build_embed()
             msg = await ctx.send(embed=embed, view=view)
@@ -4759,7 +6487,7 @@ async def inv_cmd(ctx: commands.Context, arg: Optional[str] = None, page: int =
         if page_num <= 0:
             return await ctx.send("Номер страницы должен быть положительным числом.")
 
-        items = list_user_inventory_db(ctx.guild.id, ctx.author.id)
+        items = await db_run(list_user_inventory_db, ctx.guild.id, ctx.author.id)
         view = InventoryView(ctx, items, owner=ctx.author)
         view.page = min(max(0, page_num - 1), view.max_page)
         view._sync_buttons_state()
@@ -4804,7 +6532,7 @@ async def reset_inventory_cmd(ctx: commands.Context, member: disnake.Member):
         return await ctx.send("Команда доступна только на сервере.")
 
     # Статистика до удаления
-    distinct_items, total_qty = db_get_user_inventory_stats(ctx.guild.id, member.id)
+    distinct_items, total_qty = await db_run(db_get_user_inventory_stats, ctx.guild.id, member.id)
     if distinct_items == 0:
         return await ctx.send(
             embed=disnake.Embed(
@@ -4851,7 +6579,7 @@ async def reset_inventory_cmd(ctx: commands.Context, member: disnake.Member):
     with contextlib.suppress(Exception):
         await prompt_msg.delete()
 
-    removed_distinct, removed_total = db_reset_user_inventory(ctx.guild.id, member.id)
+    removed_distinct, removed_total = await db_run(db_reset_user_inventory, ctx.guild.id, member.id)
 
     # Ответ в чат
     done_embed = disnake.Embed(
@@ -4898,7 +6626,7 @@ async def use_cmd(ctx: commands.Context, *, raw: str):
     if err:
         return await ctx.send(embed=error_embed("Выбор предмета", err))
 
-    have = get_user_item_qty(ctx.guild.id, ctx.author.id, item["id"])
+    have = await db_run(get_user_item_qty, ctx.guild.id, ctx.author.id, item["id"])
     if have <= 0:
         return await ctx.send(embed=disnake.Embed(
             title="Нет предмета",
@@ -4912,7 +6640,7 @@ async def use_cmd(ctx: commands.Context, *, raw: str):
             color=disnake.Color.red()
         ))
 
-    ok = remove_items_from_user(ctx.guild.id, ctx.author.id, item["id"], amount)
+    ok = await db_run(remove_items_from_user, ctx.guild.id, ctx.author.id, item["id"], amount, "use")
     if not ok:
         return await ctx.send(embed=disnake.Embed(
             title="Ошибка",
@@ -4957,7 +6685,7 @@ async def give_item_cmd(ctx: commands.Context, member: disnake.Member, *, raw: s
     if err:
         return await ctx.send(embed=error_embed("Выбор предмета", err))
 
-    add_items_to_user(ctx.guild.id, member.id, item["id"], amount)
+    await db_run(add_items_to_user, ctx.guild.id, member.id, item["id"], amount, "give_item")
     embed = disnake.Embed(
         title="Выдача предмета",
         description=f"**{item['name']}** в количестве {amount} шт. добавлен в инвентарь пользователю {member.mention}.",
@@ -4994,7 +6722,7 @@ async def take_item_cmd(ctx: commands.Context, member: disnake.Member, *, raw: s
     if err:
         return await ctx.send(embed=error_embed("Выбор предмета", err))
 
-    have = get_user_item_qty(ctx.guild.id, member.id, item["id"])
+    have = await db_run(get_user_item_qty, ctx.guild.id, member.id, item["id"])
     if have < amount:
         return await ctx.send(embed=disnake.Embed(
             title="Недостаточно предметов у пользователя",
@@ -5002,7 +6730,7 @@ async def take_item_cmd(ctx: commands.Context, member: disnake.Member, *, raw: s
             color=disnake.Color.red()
         ))
 
-    ok = remove_items_from_user(ctx.guild.id, member.id, item["id"], amount)
+    ok = await db_run(remove_items_from_user, ctx.guild.id, member.id, item["id"], amount, "take_item")
     if not ok:
         return await ctx.send(embed=disnake.Embed(
             title="Ошибка",
@@ -5027,56 +6755,52 @@ def get_work_settings(guild_id: int) -> tuple[int, int, int]:
     Возвращает (min_income, max_income, cooldown_seconds).
     Если настроек нет — создает с дефолтами.
     """
-    conn = sqlite3.connect(get_db_path())
-    cursor = conn.cursor()
-    cursor.execute("SELECT min_income, max_income, cooldown_seconds FROM work_settings WHERE guild_id = ?", (guild_id,))
-    row = cursor.fetchone()
-    if not row:
-        cursor.execute(
-            "INSERT INTO work_settings (guild_id, min_income, max_income, cooldown_seconds) VALUES (?, ?, ?, ?)",
-            (guild_id, DEFAULT_MIN_INCOME, DEFAULT_MAX_INCOME, DEFAULT_COOLDOWN)
-        )
-        conn.commit()
-        result = (DEFAULT_MIN_INCOME, DEFAULT_MAX_INCOME, DEFAULT_COOLDOWN)
-    else:
-        result = (int(row[0]), int(row[1]), int(row[2]))
-    conn.close()
+    with db_writer() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT min_income, max_income, cooldown_seconds FROM work_settings WHERE guild_id = ?", (guild_id,))
+        row = cursor.fetchone()
+        if not row:
+            cursor.execute(
+                "INSERT INTO work_settings (guild_id, min_income, max_income, cooldown_seconds) VALUES (?, ?, ?, ?)",
+                (guild_id, DEFAULT_MIN_INCOME, DEFAULT_MAX_INCOME, DEFAULT_COOLDOWN)
+            )
+            conn.commit()
+            result = (DEFAULT_MIN_INCOME, DEFAULT_MAX_INCOME, DEFAULT_COOLDOWN)
+        else:
+            result = (int(row[0]), int(row[1]), int(row[2]))
     return result
 
 def set_work_settings(guild_id: int, min_income: int, max_income: int, cooldown_seconds: int):
-    conn = sqlite3.connect(get_db_path())
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO work_settings (guild_id, min_income, max_income, cooldown_seconds)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(guild_id) DO UPDATE SET
-            min_income = excluded.min_income,
-            max_income = excluded.max_income,
-            cooldown_seconds = excluded.cooldown_seconds
-    """, (guild_id, min_income, max_income, cooldown_seconds))
-    conn.commit()
-    conn.close()
+    with db_writer() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO work_settings (guild_id, min_income, max_income, cooldown_seconds)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(guild_id) DO UPDATE SET
+                min_income = excluded.min_income,
+                max_income = excluded.max_income,
+                cooldown_seconds = excluded.cooldown_seconds
+        """, (guild_id, min_income, max_income, cooldown_seconds))
+        conn.commit()
 
 def get_last_work_ts(guild_id: int, user_id: int) -> Optional[int]:
-    conn = sqlite3.connect(get_db_path())
-    cursor = conn.cursor()
-    cursor.execute("SELECT last_ts FROM work_cooldowns WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
-    row = cursor.fetchone()
-    conn.close()
+    with db_reader() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT last_ts FROM work_cooldowns WHERE guild_id = ? AND user_id = ?", (guild_id, user_id))
+        row = cursor.fetchone()
     if row:
         return int(row[0])
     return None
 
 def set_last_work_ts(guild_id: int, user_id: int, ts: int):
-    conn = sqlite3.connect(get_db_path())
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO work_cooldowns (guild_id, user_id, last_ts)
-        VALUES (?, ?, ?)
-        ON CONFLICT(guild_id, user_id) DO UPDATE SET last_ts = excluded.last_ts
-    """, (guild_id, user_id, ts))
-    conn.commit()
-    conn.close()
+    with db_writer() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            INSERT INTO work_cooldowns (guild_id, user_id, last_ts)
+            VALUES (?, ?, ?)
+            ON CONFLICT(guild_id, user_id) DO UPDATE SET last_ts = excluded.last_ts
+        """, (guild_id, user_id, ts))
+        conn.commit()
 
 
 from datetime import datetime
@@ -5147,6 +6871,93 @@ def _ri_diff_lines(guild: disnake.Guild, before: Optional[dict], after: Optional
 
     return lines
 
+# ======== Фоновая отправка логов ========
+# Команды только кладут эмбед в очередь (enqueue_log) и не ждут Discord. Диспетчер
+# раскладывает события по каналам; у каждого канала своя задача-отправитель, которая
+# склеивает накопившееся в сообщения до 10 эмбедов и шлёт не чаще, чем раз в
+# LOG_CHANNEL_MIN_INTERVAL секунд. 429 disnake переживает сам внутри send — медленный
+# канал задерживает только свои логи.
+LOG_QUEUE_MAX = 5000              # больше — новые события отбрасываются
+LOG_CHANNEL_MIN_INTERVAL = 1.2    # Discord: ~5 сообщений за 5 с на канал
+LOG_EMBEDS_PER_MESSAGE = 10       # лимит Discord на эмбеды в одном сообщении
+LOG_CHARS_PER_MESSAGE = 6000      # лимит Discord на суммарный текст эмбедов
+LOG_DISPATCH_STATS = {"queued": 0, "dropped": 0, "messages": 0, "embeds": 0, "failed": 0}
+
+_log_queue: Optional[asyncio.Queue] = None
+_log_task: Optional[asyncio.Task] = None
+_log_pending: dict[int, deque] = {}                   # channel_id -> эмбеды в очереди канала
+_log_senders: dict[int, asyncio.Task] = {}            # channel_id -> задача-отправитель канала
+
+def enqueue_log(guild: disnake.Guild, embed: disnake.Embed):
+    """Ставит эмбед в очередь на отправку в канал логов сервера. Никогда не блокирует."""
+    start_log_dispatcher()
+    try:
+        _log_queue.put_nowait((guild, embed))
+        LOG_DISPATCH_STATS["queued"] += 1
+    except asyncio.QueueFull:
+        LOG_DISPATCH_STATS["dropped"] += 1
+
+async def _log_resolve_channel(guild: disnake.Guild):
+    channel_id = _log_channel_cache.get(guild.id, -1)
+    if channel_id == -1:
+        channel_id = await db_run(get_log_channel_cached, guild.id)
+    if not channel_id:
+        return None
+    return guild.get_channel(channel_id) or bot.get_channel(channel_id)
+
+def _log_take_batch(embeds: deque) -> list[disnake.Embed]:
+    batch, chars = [], 0
+    while embeds and len(batch) < LOG_EMBEDS_PER_MESSAGE:
+        size = len(embeds[0])
+        if batch and chars + size > LOG_CHARS_PER_MESSAGE:
+            break
+        batch.append(embeds.popleft())
+        chars += size
+    return batch
+
+async def _log_channel_sender(channel):
+    """Отправляет очередь одного канала пачками; завершается, когда очередь пуста."""
+    embeds = _log_pending[channel.id]
+    try:
+        while embeds:
+            batch = _log_take_batch(embeds)
+            try:
+                await channel.send(embeds=batch)
+                LOG_DISPATCH_STATS["messages"] += 1
+                LOG_DISPATCH_STATS["embeds"] += len(batch)
+            except Exception:
+                LOG_DISPATCH_STATS["failed"] += len(batch)
+            # пока ждём, в очередь канала докладываются новые события — уйдут следующей пачкой
+            await asyncio.sleep(LOG_CHANNEL_MIN_INTERVAL)
+    finally:
+        _log_senders.pop(channel.id, None)
+        if not embeds:
+            _log_pending.pop(channel.id, None)
+
+async def _log_dispatch_loop():
+    while True:
+        try:
+            guild, embed = await _log_queue.get()
+            channel = await _log_resolve_channel(guild)
+            if channel is None:
+                continue
+            _log_pending.setdefault(channel.id, deque()).append(embed)
+            if channel.id not in _log_senders:
+                _log_senders[channel.id] = asyncio.get_running_loop().create_task(_log_channel_sender(channel))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[logs] ошибка отправки логов: {e}")
+            await asyncio.sleep(1)
+
+def start_log_dispatcher():
+    global _log_queue, _log_task
+    if _log_queue is None:
+        _log_queue = asyncio.Queue(maxsize=LOG_QUEUE_MAX)
+    if _log_task is None or _log_task.done():
+        _log_task = asyncio.get_running_loop().create_task(_log_dispatch_loop())
+
+
 async def send_role_income_log(
     guild: disnake.Guild,
     actor: disnake.Member,
@@ -5159,11 +6970,7 @@ async def send_role_income_log(
     Шлёт лог в настроенный канал.
     """
     try:
-        channel_id = db_get_role_income_log_channel(guild.id)
-        if not channel_id:
-            return
-        channel = guild.get_channel(channel_id) or bot.get_channel(channel_id)  # bot должен быть доступен в области видимости
-        if not channel:
+        if not log_channel_configured(guild.id):
             return
 
         title_map = {
@@ -5189,18 +6996,18 @@ async def send_role_income_log(
 
         # Основная часть: параметры или изменения
         if action == "create":
-            lines = _ri_params_to_lines(guild, after or {})
+            lines = await db_run(_ri_params_to_lines, guild, after or {})
             body = "\n".join(lines)
             e.add_field(name="Параметры доходной роли", value=body or "—", inline=False)
             e.add_field(name="Пользователь", value=f"{actor.mention} добавил(а) доходную роль", inline=False)
         elif action == "update":
-            lines = _ri_diff_lines(guild, before, after)
+            lines = await db_run(_ri_diff_lines, guild, before, after)
             body = "\n".join(lines)
             e.add_field(name="Изменённые параметры", value=body or "—", inline=False)
             e.add_field(name="Пользователь", value=f"{actor.mention} внёс(ла) изменения", inline=False)
         elif action == "delete":
             # Покажем, что удалили и что было
-            lines = _ri_params_to_lines(guild, before or {})
+            lines = await db_run(_ri_params_to_lines, guild, before or {})
             body = "\n".join(lines)
             e.add_field(name="Удалённая доходная роль", value=body or "—", inline=False)
             e.add_field(name="Пользователь", value=f"{actor.mention} удалил(а) доходную роль", inline=False)
@@ -5209,7 +7016,7 @@ async def send_role_income_log(
         footer_time = datetime.now().strftime("%d.%m.%Y %H:%M")
         e.set_footer(text=f"{guild.name} • {footer_time}", icon_url=server_icon)
 
-        await channel.send(embed=e)
+        enqueue_log(guild, e)
     except Exception:
         # Логи не должны падать с ошибкой на основной поток
         pass
@@ -5226,12 +7033,7 @@ async def send_shop_item_action_log(
     Верхняя часть: аватарка и НИК актёра (display_name).
     """
     try:
-        # Определение канала по вашей системе (аналогично send_money_action_log)
-        channel_id = db_get_role_income_log_channel(guild.id)
-        if not channel_id:
-            return
-        channel = guild.get_channel(channel_id) or bot.get_channel(channel_id)
-        if not channel:
+        if not log_channel_configured(guild.id):
             return
 
         titles = {
@@ -5262,7 +7064,7 @@ async def send_shop_item_action_log(
         footer_time = datetime.now().strftime("%d.%m.%Y %H:%M")
         e.set_footer(text=f"{guild.name} • {footer_time}", icon_url=server_icon)
 
-        await channel.send(embed=e)
+        enqueue_log(guild, e)
     except Exception:
         # Не прерываем основную логику из-за проблем с логами
         pass
@@ -5285,11 +7087,7 @@ async def send_money_action_log(
     Верхняя часть: аватарка и РОЛЬ актёра (display_name).
     """
     try:
-        channel_id = db_get_role_income_log_channel(guild.id)
-        if not channel_id:
-            return
-        channel = guild.get_channel(channel_id) or bot.get_channel(channel_id)
-        if not channel:
+        if not log_channel_configured(guild.id):
             return
 
         titles = {
@@ -5327,7 +7125,7 @@ async def send_money_action_log(
         footer_time = datetime.now().strftime("%d.%m.%Y %H:%M")
         e.set_footer(text=f"{guild.name} • {footer_time}", icon_url=server_icon)
 
-        await channel.send(embed=e)
+        enqueue_log(guild, e)
     except Exception:
         # Не ломаем основной поток из-за проблем с логами
         pass
@@ -5344,11 +7142,7 @@ async def send_inventory_action_log(
     Логирует обнуление инвентаря в канал логов (используется тот же канал, что и для апанели).
     """
     try:
-        channel_id = db_get_role_income_log_channel(guild.id)
-        if not channel_id:
-            return
-        channel = guild.get_channel(channel_id) or bot.get_channel(channel_id)
-        if not channel:
+        if not log_channel_configured(guild.id):
             return
 
         title = "Обнуление инвентаря"
@@ -5373,7 +7167,7 @@ async def send_inventory_action_log(
         footer_time = datetime.now().strftime("%d.%m.%Y %H:%M")
         e.set_footer(text=f"{guild.name} • {footer_time}", icon_url=server_icon)
 
-        await channel.send(embed=e)
+        enqueue_log(guild, e)
     except Exception:
         # Не ломаем основной поток
         pass
@@ -5391,14 +7185,9 @@ async def send_role_change_log(
     Оформление — как в сообщении в чат.
     """
     try:
-        channel_id = db_get_role_income_log_channel(guild.id)
-        if not channel_id:
-            return
-        channel = guild.get_channel(channel_id) or bot.get_channel(channel_id)
-        if not channel:
+        if not log_channel_configured(guild.id):
             return
-        embed = build_role_change_embed(guild, action, target, role, actor)
-        await channel.send(embed=embed)
+        enqueue_log(guild, build_role_change_embed(guild, action, target, role, actor))
     except Exception:
         pass
 
@@ -5417,11 +7206,7 @@ async def send_admin_action_log(
       - Футер: <название сервера> • <время>
     """
     try:
-        channel_id = db_get_role_income_log_channel(guild.id)
-        if not channel_id:
-            return
-        channel = guild.get_channel(channel_id) or bot.get_channel(channel_id)
-        if not channel:
+        if not log_channel_configured(guild.id):
             return
 
         titles = {
@@ -5430,6 +7215,7 @@ async def send_admin_action_log(
             "reset_worldbank": ("Сброшен бюджет Всемирного банка", disnake.Color.red()),
             "clear_shop": ("Очищен магазин предметов", disnake.Color.red()),
             "clear_role_incomes": ("Очищены доходные роли", disnake.Color.red()),
+            "restore_snapshot": ("Сервер восстановлен из снимка", disnake.Color.orange()),
         }
         title, color = titles.get(action, ("Действие админ-панели", disnake.Color.blurple()))
         e = disnake.Embed(title=title, color=color)
@@ -5463,7 +7249,7 @@ async def send_admin_action_log(
         footer_time = datetime.now().strftime("%d.%m.%Y %H:%M")
         e.set_footer(text=f"{guild.name} • {footer_time}", icon_url=server_icon)
 
-        await channel.send(embed=e)
+        enqueue_log(guild, e)
     except Exception:
         # Не ломаем основной поток из-за проблем с логами
         pass
@@ -5471,16 +7257,15 @@ async def send_admin_action_log(
 
 # ======= Доходные роли: функции БД/утилиты =======
 def db_get_role_incomes(guild_id: int) -> list[dict]:
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""
-        SELECT role_id, income_type, money_amount, items_json, cooldown_seconds, created_by, created_ts
-        FROM role_incomes
-        WHERE guild_id = ?
-        ORDER BY role_id
-    """, (guild_id,))
-    rows = c.fetchall()
-    conn.close()
+    with db_reader() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT role_id, income_type, money_amount, items_json, cooldown_seconds, created_by, created_ts
+            FROM role_incomes
+            WHERE guild_id = ?
+            ORDER BY role_id
+        """, (guild_id,))
+        rows = c.fetchall()
     result = []
     for r in rows:
         items = []
@@ -5503,15 +7288,14 @@ def db_get_role_incomes(guild_id: int) -> list[dict]:
     return result
 
 def db_get_role_income(guild_id: int, role_id: int) -> Optional[dict]:
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""
-        SELECT income_type, money_amount, items_json, cooldown_seconds, created_by, created_ts
-        FROM role_incomes
-        WHERE guild_id = ? AND role_id = ?
-    """, (guild_id, role_id))
-    row = c.fetchone()
-    conn.close()
+    with db_reader() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT income_type, money_amount, items_json, cooldown_seconds, created_by, created_ts
+            FROM role_incomes
+            WHERE guild_id = ? AND role_id = ?
+        """, (guild_id, role_id))
+        row = c.fetchone()
     if not row:
         return None
     items = []
@@ -5542,81 +7326,307 @@ def db_upsert_role_income(
     created_by: Optional[int] = None
 ):
     import time as _time
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    items_json = json.dumps(items) if items else None
-    created_ts = int(_time.time()) if created_by else None
-
-    # сохраняем created_by/created_ts только если они ещё не установлены (COALESCE)
-    c.execute(f"""
-        INSERT INTO role_incomes (guild_id, role_id, income_type, money_amount, items_json, cooldown_seconds, created_by, created_ts)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(guild_id, role_id) DO UPDATE SET
-            income_type = excluded.income_type,
-            money_amount = excluded.money_amount,
-            items_json = excluded.items_json,
-            cooldown_seconds = excluded.cooldown_seconds,
-            created_by = COALESCE(role_incomes.created_by, excluded.created_by),
-            created_ts = COALESCE(role_incomes.created_ts, excluded.created_ts)
-    """, (guild_id, role_id, income_type, int(money_amount or 0), items_json, int(cooldown_seconds or 0), created_by, created_ts))
-    conn.commit()
-    conn.close()
+    with db_writer() as conn:
+        c = conn.cursor()
+        items_json = json.dumps(items) if items else None
+        created_ts = int(_time.time()) if created_by else None
+
+        # сохраняем created_by/created_ts только если они ещё не установлены (COALESCE)
+        c.execute(f"""
+            INSERT INTO role_incomes (guild_id, role_id, income_type, money_amount, items_json, cooldown_seconds, created_by, created_ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(guild_id, role_id) DO UPDATE SET
+                income_type = excluded.income_type,
+                money_amount = excluded.money_amount,
+                items_json = excluded.items_json,
+                cooldown_seconds = excluded.cooldown_seconds,
+                created_by = COALESCE(role_incomes.created_by, excluded.created_by),
+                created_ts = COALESCE(role_incomes.created_ts, excluded.created_ts)
+        """, (guild_id, role_id, income_type, int(money_amount or 0), items_json, int(cooldown_seconds or 0), created_by, created_ts))
+        conn.commit()
 
 def db_delete_role_income(guild_id: int, role_id: int):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("DELETE FROM role_incomes WHERE guild_id = ? AND role_id = ?", (guild_id, role_id))
-    c.execute("DELETE FROM role_income_cooldowns WHERE guild_id = ? AND role_id = ?", (guild_id, role_id))
-    conn.commit()
-    conn.close()
+    with db_writer() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM role_incomes WHERE guild_id = ? AND role_id = ?", (guild_id, role_id))
+        c.execute("DELETE FROM role_income_cooldowns WHERE guild_id = ? AND role_id = ?", (guild_id, role_id))
+        conn.commit()
+
+# guild_id -> канал логов (None — не настроен); заполняется воркером логов
+_log_channel_cache: dict[int, Optional[int]] = {}
+_log_channel_version = 0  # растёт после каждой записи канала логов
+
+def get_log_channel_cached(guild_id: int) -> Optional[int]:
+    if guild_id in _log_channel_cache:
+        return _log_channel_cache[guild_id]
+    version = _log_channel_version
+    channel_id = db_get_role_income_log_channel(guild_id)
+    # если пока читали, канал успели сменить — не кладём устаревшее
+    if _log_channel_version == version:
+        _log_channel_cache[guild_id] = channel_id
+    return channel_id
+
+def log_channel_configured(guild_id: int) -> bool:
+    """False только если точно известно, что канал логов не выбран (без обращения к БД)."""
+    return _log_channel_cache.get(guild_id, -1) is not None
 
 def db_get_role_income_log_channel(guild_id: int) -> Optional[int]:
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("SELECT role_income_log_channel_id FROM guild_logs WHERE guild_id = ?", (guild_id,))
-    row = c.fetchone()
-    conn.close()
+    with db_reader() as conn:
+        c = conn.cursor()
+        c.execute("SELECT role_income_log_channel_id FROM guild_logs WHERE guild_id = ?", (guild_id,))
+        row = c.fetchone()
     if not row:
         return None
     return int(row[0]) if row[0] is not None else None
 
 def db_set_role_income_log_channel(guild_id: int, channel_id: Optional[int]):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO guild_logs (guild_id, role_income_log_channel_id)
-        VALUES (?, ?)
-        ON CONFLICT(guild_id) DO UPDATE SET
-            role_income_log_channel_id = excluded.role_income_log_channel_id
-    """, (guild_id, channel_id))
-    conn.commit()
-    conn.close()
+    global _log_channel_version
+    with db_writer() as conn:
+        c = conn.cursor()
+        c.execute("""
+            INSERT INTO guild_logs (guild_id, role_income_log_channel_id)
+            VALUES (?, ?)
+            ON CONFLICT(guild_id) DO UPDATE SET
+                role_income_log_channel_id = excluded.role_income_log_channel_id
+        """, (guild_id, channel_id))
+        conn.commit()
+    # после commit: сначала версия, потом сброс — параллельное чтение не закэширует старое
+    _log_channel_version += 1
+    _log_channel_cache.pop(guild_id, None)
 
 def db_get_ri_last_ts(guild_id: int, role_id: int, user_id: int) -> Optional[int]:
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""
-        SELECT last_ts FROM role_income_cooldowns
-        WHERE guild_id = ? AND role_id = ? AND user_id = ?
-    """, (guild_id, role_id, user_id))
-    row = c.fetchone()
-    conn.close()
+    with db_reader() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT last_ts FROM role_income_cooldowns
+            WHERE guild_id = ? AND role_id = ? AND user_id = ?
+        """, (guild_id, role_id, user_id))
+        row = c.fetchone()
     return int(row[0]) if row else None
 
 def db_set_ri_last_ts(guild_id: int, role_id: int, user_id: int, ts: int):
-    conn = sqlite3.connect(get_db_path())
+    with db_writer() as conn:
+        c = conn.cursor()
+        c.execute("""
+            INSERT INTO role_income_cooldowns (guild_id, role_id, user_id, last_ts)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(guild_id, role_id, user_id) DO UPDATE SET
+                last_ts = excluded.last_ts
+        """, (guild_id, role_id, user_id, ts))
+        conn.commit()
+
+# ======== !collect: сбор дохода одной транзакцией ========
+@dataclass
+class CollectResult:
+    ready: list[dict] = field(default_factory=list)                    # роли, доход с которых выдан
+    cooling: list[tuple[dict, int]] = field(default_factory=list)      # (роль, осталось секунд)
+    total_money: int = 0
+    items: dict[int, int] = field(default_factory=dict)                # item_id -> выданное кол-во
+
+def db_collect_role_incomes(guild_id: int, user_id: int, eligible: list[dict], now: int) -> CollectResult:
+    """
+    Кулдауны всех ролей участника читаются одним запросом, доход считается в памяти,
+    затем предметы, кулдауны и баланс записываются в той же транзакции (один commit).
+    """
+    res = CollectResult()
+    if not eligible:
+        return res
+    pending = None
+    conn = db_connect()
     c = conn.cursor()
-    c.execute("""
-        INSERT INTO role_income_cooldowns (guild_id, role_id, user_id, last_ts)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(guild_id, role_id, user_id) DO UPDATE SET
-            last_ts = excluded.last_ts
-    """, (guild_id, role_id, user_id, ts))
-    conn.commit()
-    conn.close()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT role_id, last_ts FROM role_income_cooldowns WHERE guild_id = ? AND user_id = ?",
+                  (guild_id, user_id))
+        last_by_role = {int(rid): int(ts) for rid, ts in c.fetchall() if ts is not None}
+
+        for ri in eligible:
+            last = last_by_role.get(int(ri["role_id"]))
+            cd = int(ri["cooldown_seconds"] or 0)
+            if not last or last + cd <= now:
+                res.ready.append(ri)
+            else:
+                res.cooling.append((ri, (last + cd) - now))
+        if not res.ready:
+            conn.rollback()
+            return res
+        # отложенные балансы — в этой же транзакции, до начисления
+        pending = flush_balances_into(c)
+
+        for ri in res.ready:
+            if ri["income_type"] == "money":
+                res.total_money += max(0, int(ri["money_amount"] or 0))
+            else:
+                for it in ri["items"] or []:
+                    qty = int(it["qty"])
+                    if qty > 0:
+                        iid = int(it["item_id"])
+                        res.items[iid] = res.items.get(iid, 0) + qty
+
+        if res.items:
+            c.executemany("""
+                INSERT INTO inventories (guild_id, user_id, item_id, quantity)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(guild_id, user_id, item_id) DO UPDATE SET
+                    quantity = inventories.quantity + excluded.quantity
+            """, [(guild_id, user_id, iid, qty) for iid, qty in res.items.items()])
+        c.executemany("""
+            INSERT INTO role_income_cooldowns (guild_id, role_id, user_id, last_ts)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(guild_id, role_id, user_id) DO UPDATE SET
+                last_ts = excluded.last_ts
+        """, [(guild_id, int(ri["role_id"]), user_id, now) for ri in res.ready])
+        if res.total_money > 0:
+            c.execute("""
+                INSERT INTO balances (guild_id, user_id, balance) VALUES (?, ?, ?)
+                ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = balance + excluded.balance
+            """, (guild_id, user_id, res.total_money))
+        jrows = [(guild_id, user_id, now, JOURNAL_ITEM, iid, qty, "collect") for iid, qty in res.items.items()]
+        if res.total_money > 0:
+            jrows.append((guild_id, user_id, now, JOURNAL_MONEY, None, res.total_money, "collect"))
+        _journal(c, jrows)
+        conn.commit()
+        return res
+    except Exception:
+        with contextlib.suppress(Exception):
+            conn.rollback()
+        if pending:
+            balance_cache.requeue(pending)
+        raise
+    finally:
+        conn.close()
+
+# ======== Автовыплата дохода ролей (фоновый планировщик) ========
+# Выключено по умолчанию: доход выдаётся только по !collect.
+# Включено — раз в ROLE_INCOME_TICK_SECONDS по каждой доходной роли выплачивается
+# не более ROLE_INCOME_BATCH_SIZE участникам с истёкшим кулдауном (одна транзакция на пачку);
+# остальные получат выплату на следующих тиках — нагрузка размазывается равномерно.
+ROLE_INCOME_AUTO = False
+ROLE_INCOME_TICK_SECONDS = 60
+ROLE_INCOME_BATCH_SIZE = 500
+
+ROLE_INCOME_AUTO_STATS = {"ticks": 0, "paid": 0, "batches": 0, "last_tick_ms": 0.0}
+
+def db_autopay_role_income(guild_id: int, ri: dict, member_ids: list[int], now: int, limit: int) -> int:
+    """
+    Выплатить доход роли ri участникам member_ids с истёкшим кулдауном (не более limit).
+    Кулдауны роли читаются одним запросом; деньги/предметы и кулдауны пишутся одной транзакцией.
+    Возвращает число получивших выплату.
+    """
+    if not member_ids or limit <= 0:
+        return 0
+    role_id = int(ri["role_id"])
+    cd = int(ri["cooldown_seconds"] or 0)
+    amount = int(ri["money_amount"] or 0) if ri["income_type"] == "money" else 0
+    items: dict[int, int] = {}
+    if ri["income_type"] != "money":
+        for it in ri["items"] or []:
+            if int(it["qty"]) > 0:
+                items[int(it["item_id"])] = items.get(int(it["item_id"]), 0) + int(it["qty"])
+    if amount <= 0 and not items:
+        return 0
+
+    flush_balances()
+    conn = db_connect()
+    c = conn.cursor()
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute("SELECT user_id, last_ts FROM role_income_cooldowns WHERE guild_id = ? AND role_id = ?",
+                  (guild_id, role_id))
+        last_by_user = {int(uid): int(ts) for uid, ts in c.fetchall() if ts is not None}
+        due = []
+        for uid in member_ids:
+            last = last_by_user.get(uid)
+            if not last or last + cd <= now:
+                due.append(uid)
+                if len(due) >= limit:
+                    break
+        if not due:
+            conn.rollback()
+            return 0
+
+        if amount > 0:
+            c.executemany("""
+                INSERT INTO balances (guild_id, user_id, balance) VALUES (?, ?, ?)
+                ON CONFLICT(guild_id, user_id) DO UPDATE SET balance = balance + excluded.balance
+            """, [(guild_id, uid, amount) for uid in due])
+        if items:
+            c.executemany("""
+                INSERT INTO inventories (guild_id, user_id, item_id, quantity)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(guild_id, user_id, item_id) DO UPDATE SET
+                    quantity = inventories.quantity + excluded.quantity
+            """, [(guild_id, uid, iid, qty) for uid in due for iid, qty in items.items()])
+        c.executemany("""
+            INSERT INTO role_income_cooldowns (guild_id, role_id, user_id, last_ts)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(guild_id, role_id, user_id) DO UPDATE SET
+                last_ts = excluded.last_ts
+        """, [(guild_id, role_id, uid, now) for uid in due])
+        jrows = [(guild_id, uid, now, JOURNAL_MONEY, None, amount, "autopay") for uid in due] if amount > 0 else []
+        jrows += [(guild_id, uid, now, JOURNAL_ITEM, iid, qty, "autopay") for uid in due for iid, qty in items.items()]
+        _journal(c, jrows)
+        conn.commit()
+        return len(due)
+    except Exception:
+        with contextlib.suppress(Exception):
+            conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+async def role_income_tick() -> int:
+    """Один проход планировщика по всем серверам. Участники берутся из кэша шлюза (role.members)."""
+    start = time.perf_counter()
+    now = int(time.time())
+    paid = 0
+    for guild in list(bot.guilds):
+        try:
+            incomes = await db_run(db_get_role_incomes, guild.id)
+        except Exception as e:
+            print(f"[role-income] {guild.id}: не удалось прочитать доходные роли: {e}")
+            continue
+        for ri in incomes:
+            if int(ri["cooldown_seconds"] or 0) <= 0:
+                continue  # без кулдауна автовыплата теряет смысл — только !collect
+            role = guild.get_role(ri["role_id"])
+            if role is None:
+                continue
+            member_ids = [m.id for m in role.members if not m.bot]
+            if not member_ids:
+                continue
+            try:
+                n = await db_run(db_autopay_role_income, guild.id, ri, member_ids, now, ROLE_INCOME_BATCH_SIZE)
+            except Exception as e:
+                print(f"[role-income] {guild.id}/{ri['role_id']}: ошибка выплаты: {e}")
+                continue
+            if n:
+                paid += n
+                ROLE_INCOME_AUTO_STATS["batches"] += 1
+    ROLE_INCOME_AUTO_STATS["ticks"] += 1
+    ROLE_INCOME_AUTO_STATS["paid"] += paid
+    ROLE_INCOME_AUTO_STATS["last_tick_ms"] = (time.perf_counter() - start) * 1000
+    return paid
+
+_role_income_task: Optional[asyncio.Task] = None
+
+async def _role_income_loop():
+    while True:
+        await asyncio.sleep(ROLE_INCOME_TICK_SECONDS)
+        try:
+            await role_income_tick()
+        except Exception as e:
+            print(f"[role-income] ошибка планировщика: {e}")
+
+def start_role_income_scheduler():
+    global _role_income_task
+    if not ROLE_INCOME_AUTO:
+        return
+    if _role_income_task is None or _role_income_task.done():
+        _role_income_task = asyncio.get_running_loop().create_task(_role_income_loop())
 
 def items_id_to_name_map(guild: disnake.Guild) -> dict[int, str]:
-    return {it["id"]: it["name"] for it in list_items_db(guild.id)}
+    return item_names_map(guild.id)
 
 def parse_duration_to_seconds(text: str) -> Optional[int]:
     """
@@ -5791,9 +7801,10 @@ class RIMoneyModal(disnake.ui.Modal):
             return await inter.response.send_message(embed=error_embed("Ошибка", "Введите валидный кулдаун (> 0)."), ephemeral=True)
 
         # ДОБАВЛЕНО: снимем состояние "до"
-        before = db_get_role_income(inter.guild.id, self.role_id)
+        before = await db_run(db_get_role_income, inter.guild.id, self.role_id)
 
-        db_upsert_role_income(
+        await db_run(
+            db_upsert_role_income,
             inter.guild.id,
             self.role_id,
             "money",
@@ -5804,11 +7815,11 @@ class RIMoneyModal(disnake.ui.Modal):
         )
 
         # ДОБАВЛЕНО: снимем состояние "после" и отправим лог
-        after = db_get_role_income(inter.guild.id, self.role_id)
+        after = await db_run(db_get_role_income, inter.guild.id, self.role_id)
         action = "create" if before is None else "update"
         await send_role_income_log(inter.guild, inter.user, action, self.role_id, before, after)
 
-        await inter.response.edit_message(embed=build_role_income_embed(inter.guild, self.view_ref.ctx.author), view=self.view_ref)
+        await inter.response.edit_message(embed=await db_run(build_role_income_embed, inter.guild, self.view_ref.ctx.author), view=self.view_ref)
         await inter.followup.send("Сохранено.", ephemeral=True)
 
 class RIItemsModal(disnake.ui.Modal):
@@ -5847,8 +7858,7 @@ class RIItemsModal(disnake.ui.Modal):
             return await inter.response.send_message(embed=error_embed("Ошибка", "Укажите хотя бы один предмет."), ephemeral=True)
         items_list = []
         lines = [ln.strip() for ln in raw.splitlines() if ln.strip()]
-        all_items = list_items_db(inter.guild.id)
-        valid_ids = {int(it["id"]) for it in all_items}
+        valid_ids = set(await db_run(item_names_map, inter.guild.id))
         for ln in lines:
             parts = ln.replace("×", " ").replace("x", " ").split()
             if len(parts) < 2 or not parts[0].isdigit():
@@ -5868,9 +7878,10 @@ class RIItemsModal(disnake.ui.Modal):
             return await inter.response.send_message(embed=error_embed("Ошибка", "Введите валидный кулдаун (> 0)."), ephemeral=True)
 
         # ДОБАВЛЕНО: снимем состояние "до"
-        before = db_get_role_income(inter.guild.id, self.role_id)
+        before = await db_run(db_get_role_income, inter.guild.id, self.role_id)
 
-        db_upsert_role_income(
+        await db_run(
+            db_upsert_role_income,
             inter.guild.id,
             self.role_id,
             "items",
@@ -5881,11 +7892,11 @@ class RIItemsModal(disnake.ui.Modal):
         )
 
         # ДОБАВЛЕНО: снимем состояние "после" и отправим лог
-        after = db_get_role_income(inter.guild.id, self.role_id)
+        after = await db_run(db_get_role_income, inter.guild.id, self.role_id)
         action = "create" if before is None else "update"
         await send_role_income_log(inter.guild, inter.user, action, self.role_id, before, after)
 
-        await inter.response.edit_message(embed=build_role_income_embed(inter.guild, self.view_ref.ctx.author), view=self.view_ref)
+        await inter.response.edit_message(embed=await db_run(build_role_income_embed, inter.guild, self.view_ref.ctx.author), view=self.view_ref)
         await inter.followup.send("Сохранено.", ephemeral=True)
 
 class RISelect(disnake.ui.StringSelect):
@@ -5937,14 +7948,14 @@ class RoleIncomeView(disnake.ui.View):
     async def _refresh_main(self, inter: disnake.MessageInteraction):
         try:
             if self.message:
-                await self.message.edit(embed=build_role_income_embed(self.ctx.guild, self.ctx.author), view=self)
+                await self.message.edit(embed=await db_run(build_role_income_embed, self.ctx.guild, self.ctx.author), view=self)
         except Exception:
             pass
 
     @disnake.ui.button(label="Добавить доходную роль", style=disnake.ButtonStyle.success, custom_id="ri_add", row=0)
     async def _btn_add(self, btn: disnake.ui.Button, inter: disnake.MessageInteraction):
         # Множество уже сконфигурированных ролей, чтобы не дать добавить повторно
-        configured = {ri["role_id"] for ri in db_get_role_incomes(inter.guild.id)}
+        configured = {ri["role_id"] for ri in await db_run(db_get_role_incomes, inter.guild.id)}
 
         view = disnake.ui.View(timeout=120)
 
@@ -6013,7 +8024,7 @@ class RoleIncomeView(disnake.ui.View):
     @disnake.ui.button(label="Изменить доходную роль", style=disnake.ButtonStyle.primary, custom_id="ri_edit", row=0)
     async def _btn_edit(self, btn: disnake.ui.Button, inter: disnake.MessageInteraction):
         # Для изменения роль должна быть в БД
-        configured = {ri["role_id"] for ri in db_get_role_incomes(inter.guild.id)}
+        configured = {ri["role_id"] for ri in await db_run(db_get_role_incomes, inter.guild.id)}
         if not configured:
             return await inter.response.send_message("Нет добавленных доходных ролей для изменения.", ephemeral=True)
 
@@ -6056,7 +8067,7 @@ class RoleIncomeView(disnake.ui.View):
         async def on_proceed(i: disnake.MessageInteraction):
             if not chosen["role_id"] or not chosen["type"]:
                 return await i.response.send_message("Сначала выберите роль и новый тип дохода.", ephemeral=True)
-            current = db_get_role_income(i.guild.id, chosen["role_id"]) or {}
+            current = await db_run(db_get_role_income, i.guild.id, chosen["role_id"]) or {}
             if chosen["type"] == "money":
                 await i.response.send_modal(RIMoneyModal(
                     self, "edit", chosen["role_id"],
@@ -6085,7 +8096,7 @@ class RoleIncomeView(disnake.ui.View):
 
     @disnake.ui.button(label="Удалить доходную роль", style=disnake.ButtonStyle.danger, custom_id="ri_del", row=0)
     async def _btn_del(self, btn: disnake.ui.Button, inter: disnake.MessageInteraction):
-        configured = {ri["role_id"] for ri in db_get_role_incomes(inter.guild.id)}
+        configured = {ri["role_id"] for ri in await db_run(db_get_role_incomes, inter.guild.id)}
         if not configured:
             return await inter.response.send_message("Нет добавленных доходных ролей для удаления.", ephemeral=True)
 
@@ -6117,9 +8128,9 @@ class RoleIncomeView(disnake.ui.View):
                 return await i.response.send_message("Сначала выберите роль.", ephemeral=True)
 
             # Для лога - снимем состояние "до"
-            before = db_get_role_income(i.guild.id, chosen["role_id"])
+            before = await db_run(db_get_role_income, i.guild.id, chosen["role_id"])
 
-            db_delete_role_income(i.guild.id, chosen["role_id"])
+            await db_run(db_delete_role_income, i.guild.id, chosen["role_id"])
             await i.response.edit_message(content="Доходная роль удалена.", view=None)
             await self._refresh_main(i)
 
@@ -6182,8 +8193,13 @@ class AdminConfirmView(disnake.ui.View):
     async def _confirm(self, btn: disnake.ui.Button, inter: disnake.MessageInteraction):
         await inter.response.defer(ephemeral=True)
         try:
+            # Без снимка опасное действие не выполняем: его нельзя будет отменить
+            try:
+                snap = await take_snapshot(f"before-{self.action_code}")
+            except Exception as e:
+                return await inter.followup.send(f"Не удалось снять снимок базы, действие отменено: {e}", ephemeral=True)
             msg = await self.on_confirm(inter)
-            await inter.followup.send(msg or "Готово.", ephemeral=True)
+            await inter.followup.send(f"{msg or 'Готово.'}\nСнимок до изменения: `{snap}`", ephemeral=True)
         except Exception as e:
             await inter.followup.send(f"Ошибка: {e}", ephemeral=True)
         finally:
@@ -6224,7 +8240,7 @@ class AdminPanelView(disnake.ui.View):
     @disnake.ui.button(label="Сбросить инвентари", style=disnake.ButtonStyle.danger, custom_id="ap_reset_inv", row=0)
     async def _btn_reset_inv(self, btn: disnake.ui.Button, inter: disnake.MessageInteraction):
         async def do_confirm(_i: disnake.MessageInteraction):
-            deleted, users = admin_reset_inventories(_i.guild.id)
+            deleted, users = await db_run(admin_reset_inventories, _i.guild.id)
             details = f"Удалено {deleted} записей инвентаря у {users} пользователей."
             await send_admin_action_log(_i.guild, _i.user, "reset_inventories", details)
             return f"✅ Инвентари сброшены. {details}"
@@ -6233,7 +8249,7 @@ class AdminPanelView(disnake.ui.View):
     @disnake.ui.button(label="Сбросить балансы", style=disnake.ButtonStyle.danger, custom_id="ap_reset_bal", row=0)
     async def _btn_reset_bal(self, btn: disnake.ui.Button, inter: disnake.MessageInteraction):
         async def do_confirm(_i: disnake.MessageInteraction):
-            affected, total, sum_before = admin_reset_balances(_i.guild.id)
+            affected, total, sum_before = await db_run(admin_reset_balances, _i.guild.id)
             details = f"Обнулены балансы у {affected} записей (всего строк: {total}). Сумма до обнуления: {format_number(sum_before)} {MONEY_EMOJI}"
             await send_admin_action_log(_i.guild, _i.user, "reset_balances", details)
             return f"✅ Балансы сброшены. {details}"
@@ -6242,7 +8258,7 @@ class AdminPanelView(disnake.ui.View):
     @disnake.ui.button(label="Сбросить бюджет Всемирного банка", style=disnake.ButtonStyle.danger, custom_id="ap_reset_wb", row=1)
     async def _btn_reset_wb(self, btn: disnake.ui.Button, inter: disnake.MessageInteraction):
         async def do_confirm(_i: disnake.MessageInteraction):
-            before, after = admin_reset_worldbank(_i.guild.id)
+            before, after = await db_run(admin_reset_worldbank, _i.guild.id)
             details = f"Бюджет: {format_number(before)} → {format_number(after)} {MONEY_EMOJI}"
             await send_admin_action_log(_i.guild, _i.user, "reset_worldbank", details)
             return f"✅ Бюджет Всемирного банка сброшен. {details}"
@@ -6251,7 +8267,7 @@ class AdminPanelView(disnake.ui.View):
     @disnake.ui.button(label="Очистить магазин", style=disnake.ButtonStyle.danger, custom_id="ap_clear_shop", row=1)
     async def _btn_clear_shop(self, btn: disnake.ui.Button, inter: disnake.MessageInteraction):
         async def do_confirm(_i: disnake.MessageInteraction):
-            stats = admin_clear_shop(_i.guild.id)
+            stats = await db_run(admin_clear_shop, _i.guild.id)
             details = (
                 f"Удалено предметов: {stats['items']}; "
                 f"записей инвентаря по предметам: {stats['inv_rows']}; "
@@ -6265,7 +8281,7 @@ class AdminPanelView(disnake.ui.View):
     @disnake.ui.button(label="Очистить доходные роли", style=disnake.ButtonStyle.danger, custom_id="ap_clear_ri", row=2)
     async def _btn_clear_ri(self, btn: disnake.ui.Button, inter: disnake.MessageInteraction):
         async def do_confirm(_i: disnake.MessageInteraction):
-            roles_deleted, cds_deleted = admin_clear_role_incomes(_i.guild.id)
+            roles_deleted, cds_deleted = await db_run(admin_clear_role_incomes, _i.guild.id)
             details = f"Удалено записей доходных ролей: {roles_deleted}; кулдаунов: {cds_deleted}."
             await send_admin_action_log(_i.guild, _i.user, "clear_role_incomes", details)
             return f"✅ Доходные роли очищены. {details}"
@@ -6284,7 +8300,14 @@ class AdminPanelView(disnake.ui.View):
 
 @bot.event
 async def on_ready():
-    setup_database()
+    compile_all_allowed()
+    start_loop_lag_monitor()
+    start_balance_flusher()
+    start_role_income_scheduler()
+    start_restock_scheduler()
+    start_maintenance()
+    start_log_dispatcher()
+    start_snapshots()
     print(f'Бот {bot.user} готов к работе!')
     print(f'Подключен к {len(bot.guilds)} серверам.')
     
@@ -6293,7 +8316,7 @@ async def balance_prefix(ctx: commands.Context, user: disnake.Member = None):
     if not await ensure_allowed_ctx(ctx, ALLOWED_BALANCE):
         return
     target_user = user or ctx.author
-    balance = get_balance(ctx.guild.id, target_user.id)
+    balance = await db_run(get_balance, ctx.guild.id, target_user.id)
     embed = disnake.Embed(
         title=f":moneybag: Баланс {target_user.display_name}",
         description=f"**На счету:**\n{format_number(balance)} {MONEY_EMOJI}",
@@ -6323,25 +8346,22 @@ async def pay_prefix(ctx: commands.Context, recipient: disnake.Member, amount_ra
         await ctx.send(embed=error_embed("Ошибка", str(e)))
         return
 
-    sender_balance = get_balance(ctx.guild.id, ctx.author.id)
-    if sender_balance < amount:
-        await ctx.send(f"У вас недостаточно средств! Ваш баланс: {format_number(sender_balance)} {MONEY_EMOJI}")
-        return
-
     # Комиссия Всемирного банка
-    commission_percent, _bank_bal = get_worldbank(ctx.guild.id)
+    commission_percent, _bank_bal = await db_run(get_worldbank, ctx.guild.id)
     commission = math.floor(amount * commission_percent / 100)
     received = max(0, amount - commission)
 
-    # Транзакции
-    update_balance(ctx.guild.id, ctx.author.id, -amount)
-    if received > 0:
-        update_balance(ctx.guild.id, recipient.id, received)
-    if commission > 0:
-        change_worldbank_balance(ctx.guild.id, commission)
+    # Одна транзакция: списание (с проверкой баланса в SQL), зачисление, комиссия
+    res = await db_run(
+        db_ledger_transfer, ctx.guild.id, ctx.author.id, amount,
+        [(recipient.id, received)], to_worldbank=commission, reason="pay"
+    )
+    if not res.ok:
+        await ctx.send(f"У вас недостаточно средств! Ваш баланс: {format_number(res.balances.get(ctx.author.id, 0))} {MONEY_EMOJI}")
+        return
 
-    sender_balance_after = get_balance(ctx.guild.id, ctx.author.id)
-    recipient_balance_after = get_balance(ctx.guild.id, recipient.id)
+    sender_balance_after = res.balances[ctx.author.id]
+    recipient_balance_after = res.balances[recipient.id]
 
     # Красивый эмбед
     embed = disnake.Embed(
@@ -6620,8 +8640,8 @@ async def add_money_cmd(ctx: commands.Context, member: disnake.Member, amount_ra
         amount = safe_int(amount_raw, name="Сумма", min_v=1)
     except ValueError as e:
         return await ctx.send(embed=error_embed("Ошибка", str(e)))
-    update_balance(ctx.guild.id, member.id, amount)
-    new_bal = get_balance(ctx.guild.id, member.id)
+    await db_run(update_balance, ctx.guild.id, member.id, amount, "add_money")
+    new_bal = await db_run(get_balance, ctx.guild.id, member.id)
     embed = build_money_action_embed(
         ctx, action="add", is_role=False, target_mention=member.mention, amount=amount, new_balance=new_bal
     )
@@ -6645,7 +8665,7 @@ async def remove_money_cmd(ctx: commands.Context, member: disnake.Member, amount
     except ValueError as e:
         return await ctx.send(embed=error_embed("Ошибка", str(e)))
 
-    current = get_balance(ctx.guild.id, member.id)
+    current = await db_run(get_balance, ctx.guild.id, member.id)
     if amount > current:
         return await ctx.send(embed=error_embed(
             "Недостаточно средств для списания",
@@ -6653,8 +8673,8 @@ async def remove_money_cmd(ctx: commands.Context, member: disnake.Member, amount
             f"Нельзя списать {format_number(amount)}."
         ))
 
-    update_balance(ctx.guild.id, member.id, -amount)
-    new_bal = get_balance(ctx.guild.id, member.id)
+    await db_run(update_balance, ctx.guild.id, member.id, -amount, "remove_money")
+    new_bal = await db_run(get_balance, ctx.guild.id, member.id)
     embed = build_money_action_embed(
         ctx, action="remove", is_role=False, target_mention=member.mention, amount=amount, new_balance=new_bal
     )
@@ -6673,7 +8693,7 @@ async def reset_money_cmd(ctx: commands.Context, member: disnake.Member):
         return
     if not ctx.guild:
         return await ctx.send("Команда доступна только на сервере.")
-    set_balance(ctx.guild.id, member.id, 0)
+    await db_run(set_balance, ctx.guild.id, member.id, 0, "reset_money")
     embed = build_money_action_embed(
         ctx, action="reset", is_role=False, target_mention=member.mention, amount=None, new_balance=0
     )
@@ -6685,6 +8705,31 @@ async def reset_money_cmd(ctx: commands.Context, member: disnake.Member):
 
 # ================= Команды: управление деньгами (роль) =================
 
+async def _run_role_bulk(ctx: commands.Context, role: disnake.Role, func, value: int) -> int:
+    """
+    Запускает массовую операцию по участникам роли в потоке БД.
+    Для больших ролей показывает и обновляет сообщение с прогрессом.
+    """
+    member_ids = [m.id for m in role.members if m.guild.id == ctx.guild.id]
+    if len(member_ids) < BULK_PROGRESS_THRESHOLD:
+        return await db_run(func, ctx.guild.id, member_ids, value)
+
+    state = {"done": 0, "total": len(member_ids)}
+
+    def progress(done: int, total: int):
+        state["done"] = done
+
+    msg = await ctx.send(f"⏳ Обработка участников роли {role.mention}: 0 / {format_number(state['total'])}")
+    fut = asyncio.ensure_future(db_run(func, ctx.guild.id, member_ids, value, progress))
+    while not fut.done():
+        await asyncio.wait({fut}, timeout=2.0)
+        if not fut.done():
+            with contextlib.suppress(Exception):
+                await msg.edit(content=f"⏳ Обработка участников роли {role.mention}: {format_number(state['done'])} / {format_number(state['total'])}")
+    with contextlib.suppress(Exception):
+        await msg.delete()
+    return fut.result()
+
 @bot.command(name="add-money-role")
 async def add_money_role_cmd(ctx: commands.Context, role: disnake.Role, amount_raw: str):
     """
@@ -6700,9 +8745,7 @@ async def add_money_role_cmd(ctx: commands.Context, role: disnake.Role, amount_r
     except ValueError as e:
         return await ctx.send(embed=error_embed("Ошибка", str(e)))
 
-    members = [m for m in role.members if m.guild.id == ctx.guild.id]
-    for m in members:
-        update_balance(ctx.guild.id, m.id, amount)
+    await _run_role_bulk(ctx, role, db_bulk_update_balance, amount)
 
     embed = build_money_action_embed(
         ctx, action="add", is_role=True, target_mention=role.mention, amount=amount, new_balance=None
@@ -6727,9 +8770,7 @@ async def remove_money_role_cmd(ctx: commands.Context, role: disnake.Role, amoun
     except ValueError as e:
         return await ctx.send(embed=error_embed("Ошибка", str(e)))
 
-    members = [m for m in role.members if m.guild.id == ctx.guild.id]
-    for m in members:
-        update_balance(ctx.guild.id, m.id, -amount)
+    await _run_role_bulk(ctx, role, db_bulk_update_balance, -amount)
 
     embed = build_money_action_embed(
         ctx, action="remove", is_role=True, target_mention=role.mention, amount=amount, new_balance=None
@@ -6750,9 +8791,7 @@ async def reset_money_role_cmd(ctx: commands.Context, role: disnake.Role):
     if not ctx.guild:
         return await ctx.send("Команда доступна только на сервере.")
 
-    members = [m for m in role.members if m.guild.id == ctx.guild.id]
-    for m in members:
-        set_balance(ctx.guild.id, m.id, 0)
+    await _run_role_bulk(ctx, role, db_bulk_set_balance, 0)
 
     embed = build_money_action_embed(
         ctx, action="reset", is_role=True, target_mention=role.mention, amount=None, new_balance=None
@@ -6768,8 +8807,8 @@ async def reset_money_role_cmd(ctx: commands.Context, role: disnake.Role):
 def _wb_is_manager(member: disnake.Member) -> bool:
     return is_user_allowed_for(ALLOWED_WORLDBANK_MANAGE, member)
 
-def build_worldbank_embed(guild: disnake.Guild, invoker: disnake.Member) -> disnake.Embed:
-    percent, bank = get_worldbank(guild.id)
+async def build_worldbank_embed(guild: disnake.Guild, invoker: disnake.Member) -> disnake.Embed:
+    percent, bank = await db_run(get_worldbank, guild.id)
     e = disnake.Embed(
         title="Всемирный банк",
         color=disnake.Color.from_rgb(88, 101, 242)
@@ -6815,8 +8854,8 @@ class WBPercentModal(disnake.ui.Modal):
             val = safe_int(raw, name="Процент", min_v=1, max_v=10)
         except ValueError as e:
             return await inter.response.send_message(embed=error_embed("Ошибка", str(e)), ephemeral=True)
-        set_commission_percent(inter.guild.id, val)
-        await inter.response.edit_message(embed=build_worldbank_embed(inter.guild, self.view_ref.ctx.author), view=self.view_ref)
+        await db_run(set_commission_percent, inter.guild.id, val)
+        await inter.response.edit_message(embed=await build_worldbank_embed(inter.guild, self.view_ref.ctx.author), view=self.view_ref)
         await inter.followup.send(f"Ставка комиссии обновлена: {val}%.", ephemeral=True)
 
 class WBWithdrawModal(disnake.ui.Modal):
@@ -6844,14 +8883,14 @@ class WBWithdrawModal(disnake.ui.Modal):
             amount = safe_int(raw, name="Сумма", min_v=1)
         except ValueError as e:
             return await inter.response.send_message(embed=error_embed("Ошибка", str(e)), ephemeral=True)
-        bank_bal = get_worldbank_balance(inter.guild.id)
+        bank_bal = await db_run(get_worldbank_balance, inter.guild.id)
         if amount > bank_bal:
             return await inter.response.send_message(embed=error_embed("Недостаточно средств в казне", f"В банке только {format_number(bank_bal)} {MONEY_EMOJI}."), ephemeral=True)
-        ok = change_worldbank_balance(inter.guild.id, -amount)
+        ok = await db_run(change_worldbank_balance, inter.guild.id, -amount, "worldbank_withdraw")
         if not ok:
             return await inter.response.send_message(embed=error_embed("Ошибка", "Не удалось списать с казны."), ephemeral=True)
-        update_balance(inter.guild.id, inter.user.id, amount)
-        await inter.response.edit_message(embed=build_worldbank_embed(inter.guild, self.view_ref.ctx.author), view=self.view_ref)
+        await db_run(update_balance, inter.guild.id, inter.user.id, amount, "worldbank_withdraw")
+        await inter.response.edit_message(embed=await build_worldbank_embed(inter.guild, self.view_ref.ctx.author), view=self.view_ref)
         await inter.followup.send(f"Снято с казны: {format_number(amount)} {MONEY_EMOJI}. Средства зачислены на ваш баланс.", ephemeral=True)
 
 class WBDepositModal(disnake.ui.Modal):
@@ -6880,12 +8919,12 @@ class WBDepositModal(disnake.ui.Modal):
             amount = safe_int(raw, name="Сумма", min_v=1)
         except ValueError as e:
             return await inter.response.send_message(embed=error_embed("Ошибка", str(e)), ephemeral=True)
-        user_bal = get_balance(inter.guild.id, inter.user.id)
+        user_bal = await db_run(get_balance, inter.guild.id, inter.user.id)
         if amount > user_bal:
             return await inter.response.send_message(embed=error_embed("Недостаточно средств", f"Ваш баланс: {format_number(user_bal)} {MONEY_EMOJI}"), ephemeral=True)
-        update_balance(inter.guild.id, inter.user.id, -amount)
-        change_worldbank_balance(inter.guild.id, amount)
-        await inter.response.edit_message(embed=build_worldbank_embed(inter.guild, self.view_ref.ctx.author), view=self.view_ref)
+        await db_run(update_balance, inter.guild.id, inter.user.id, -amount, "worldbank_deposit")
+        await db_run(change_worldbank_balance, inter.guild.id, amount, "worldbank_deposit")
+        await inter.response.edit_message(embed=await build_worldbank_embed(inter.guild, self.view_ref.ctx.author), view=self.view_ref)
         await inter.followup.send(f"Казна пополнена на {format_number(amount)} {MONEY_EMOJI}. Спасибо!", ephemeral=True)
 
 class WorldBankView(disnake.ui.View):
@@ -6940,10 +8979,10 @@ async def worldbank_cmd(ctx: commands.Context):
         return await ctx.send("Команда доступна только на сервере.")
 
     # Обеспечим наличие строки WB
-    get_worldbank(ctx.guild.id)
+    await db_run(get_worldbank, ctx.guild.id)
 
     view = WorldBankView(ctx)
-    embed = build_worldbank_embed(ctx.guild, ctx.author)
+    embed = await build_worldbank_embed(ctx.guild, ctx.author)
     msg = await ctx.send(embed=embed, view=view)
     view.message = msg
 
@@ -6952,10 +8991,10 @@ async def worldbank_cmd(ctx: commands.Context):
 async def work_cmd(ctx: commands.Context):
     if not await ensure_allowed_ctx(ctx, ALLOWED_WORK):
         return
-    min_income, max_income, cooldown = get_work_settings(ctx.guild.id)
+    min_income, max_income, cooldown = await db_run(get_work_settings, ctx.guild.id)
 
     now = int(time.time())
-    last_ts = get_last_work_ts(ctx.guild.id, ctx.author.id)
+    last_ts = await db_run(get_last_work_ts, ctx.guild.id, ctx.author.id)
     if last_ts is not None:
         remaining = (last_ts + cooldown) - now
         if remaining > 0:
@@ -6987,9 +9026,9 @@ async def work_cmd(ctx: commands.Context):
         base = earn
         bonus = 0
 
-    update_balance(ctx.guild.id, ctx.author.id, earn)
-    set_last_work_ts(ctx.guild.id, ctx.author.id, now)
-    new_balance = get_balance(ctx.guild.id, ctx.author.id)
+    await db_run(update_balance, ctx.guild.id, ctx.author.id, earn, "work")
+    await db_run(set_last_work_ts, ctx.guild.id, ctx.author.id, now)
+    new_balance = await db_run(get_balance, ctx.guild.id, ctx.author.id)
     next_ts = now + cooldown
 
     embed = disnake.Embed(
@@ -7322,7 +9361,7 @@ class WorkSettingsView(disnake.ui.View):
         if self.min_income > self.max_income:
             self.min_income, self.max_income = self.max_income, self.min_income
 
-        set_work_settings(inter.guild.id, self.min_income, self.max_income, self.cooldown)
+        await db_run(set_work_settings, inter.guild.id, self.min_income, self.max_income, self.cooldown)
         self._orig = (self.min_income, self.max_income, self.cooldown)
 
         done = disnake.Embed(
@@ -7392,7 +9431,7 @@ async def role_income_cmd(ctx: commands.Context):
         return await ctx.send("Команда доступна только на сервере.")
 
     view = RoleIncomeView(ctx)
-    embed = build_role_income_embed(ctx.guild, ctx.author)
+    embed = await db_run(build_role_income_embed, ctx.guild, ctx.author)
     msg = await ctx.send(embed=embed, view=view)
     view.message = msg
 
@@ -7540,7 +9579,7 @@ async def income_list_cmd(ctx: commands.Context):
     if not ctx.guild:
         return await ctx.send("Команда доступна только на сервере.")
 
-    data = db_get_role_incomes(ctx.guild.id)
+    data = await db_run(db_get_role_incomes, ctx.guild.id)
     view = IncomeListView(ctx, data, per_page=INCOME_LIST_PAGE_SIZE)
     embed = view.build_embed()
     msg = await ctx.send(embed=embed, view=view)
@@ -7589,9 +9628,9 @@ class LogMenuView(disnake.ui.View):
                 return await i.response.send_message("Недостаточно прав.", ephemeral=True)
 
             ch = self.channel_select.values[0]
-            db_set_role_income_log_channel(i.guild.id, ch.id)
+            await db_run(db_set_role_income_log_channel, i.guild.id, ch.id)
             try:
-                await i.response.edit_message(embed=build_logmenu_embed(i.guild), view=self)
+                await i.response.edit_message(embed=await db_run(build_logmenu_embed, i.guild), view=self)
             except Exception:
                 await i.response.send_message(f"Канал логов установлен: {ch.mention}", ephemeral=True)
 
@@ -7599,9 +9638,9 @@ class LogMenuView(disnake.ui.View):
             if not is_user_allowed_for(ALLOWED_ROLE_INCOME, i.user):
                 return await i.response.send_message("Недостаточно прав.", ephemeral=True)
 
-            db_set_role_income_log_channel(i.guild.id, None)
+            await db_run(db_set_role_income_log_channel, i.guild.id, None)
             try:
-                await i.response.edit_message(embed=build_logmenu_embed(i.guild), view=self)
+                await i.response.edit_message(embed=await db_run(build_logmenu_embed, i.guild), view=self)
             except Exception:
                 await i.response.send_message("Логи отключены.", ephemeral=True)
 
@@ -7637,7 +9676,7 @@ async def logmenu_cmd(ctx: commands.Context):
         return await ctx.send("Команда доступна только на сервере.")
 
     view = LogMenuView(ctx)
-    embed = build_logmenu_embed(ctx.guild)
+    embed = await db_run(build_logmenu_embed, ctx.guild)
     msg = await ctx.send(embed=embed, view=view)
     view.message = msg
 
@@ -8153,35 +10192,36 @@ class LeaderboardView(disnake.ui.View):
         self.page_size = max(1, ps)  # защита от 0 и отрицательных
 
         self.page = 1
-        self.total = get_balances_count(self.guild.id)
-        # ceil без импорта math
-        self.total_pages = max(1, ((self.total + self.page_size - 1) // self.page_size)) if self.total else 1
+        self.total = 0
+        self.total_pages = 1
+        self.my_rank: Optional[int] = None
+        # page -> курсор (balance, user_id) последней строки предыдущей страницы
+        self._anchors: dict[int, Optional[tuple[int, int]]] = {1: None}
         self.message: disnake.Message | None = None
 
-    async def _resolve_name(self, user_id: int) -> str:
-        # Ник без пинга: берем display_name в гильдии, иначе глобальное имя/ID
-        member = self.guild.get_member(user_id)
-        if member:
-            return member.display_name
-        user = self.bot.get_user(user_id)
-        if user is None:
-            try:
-                user = await self.bot.fetch_user(user_id)
-            except Exception:
-                user = None
-        return user.name if user else f"ID {user_id}"
-
     async def make_embed(self) -> disnake.Embed:
+        if self.my_rank is None:
+            self.total = await db_run(leaderboard_total, self.guild.id)
+            # ceil без импорта math
+            self.total_pages = max(1, ((self.total + self.page_size - 1) // self.page_size)) if self.total else 1
+            self.my_rank = await db_run(leaderboard_rank, self.guild.id, self.author_id)
+
         offset = (self.page - 1) * self.page_size
-        rows = get_top_balances(self.guild.id, self.page_size, offset)
+        if self.page in self._anchors:
+            rows = await db_run(get_top_balances_after, self.guild.id, self.page_size, self._anchors[self.page])
+        else:
+            rows = await db_run(get_top_balances, self.guild.id, self.page_size, offset)
+        if len(rows) == self.page_size:
+            last_uid, last_bal = rows[-1]
+            self._anchors[self.page + 1] = (int(last_bal), int(last_uid))
 
         if not rows:
             description = "Пока нет данных по балансу на этом сервере."
         else:
+            names = await resolve_user_names(self.guild, [user_id for user_id, _ in rows])
             lines = []
             for i, (user_id, balance) in enumerate(rows, start=offset + 1):
-                name = await self._resolve_name(user_id)
-                lines.append(f"{i}. {name} → {format_number(balance)} {MONEY_EMOJI}")
+                lines.append(f"{i}. {names[user_id]} → {format_number(balance)} {MONEY_EMOJI}")
             description = "\n".join(lines)
 
         embed = disnake.Embed(
@@ -8191,7 +10231,7 @@ class LeaderboardView(disnake.ui.View):
         )
         if self.guild.icon:
             embed.set_thumbnail(url=self.guild.icon.url)
-        embed.set_footer(text=f"Страница {self.page}/{self.total_pages}")
+        embed.set_footer(text=f"Страница {self.page}/{self.total_pages} • Ваше место: {self.my_rank}")
         # Переключим доступность кнопок под текущую страницу
         self._sync_buttons_state()
         return embed
@@ -8242,6 +10282,164 @@ class LeaderboardView(disnake.ui.View):
         except Exception:
             pass
 
+# ======== История операций (!history) ========
+JOURNAL_REASON_TITLES = {
+    "buy": "покупка", "sell": "продажа", "use": "использование",
+    "pay": "перевод", "transfer": "перевод", "export": "экспортная сделка",
+    "work": "работа", "bump": "награда за бамп",
+    "collect": "доход ролей", "autopay": "автовыплата дохода ролей",
+    "add_money": "выдача денег", "remove_money": "списание денег", "reset_money": "обнуление баланса",
+    "role": "операция по роли", "give_item": "выдача предмета", "take_item": "изъятие предмета",
+    "reset_inventory": "обнуление инвентаря", "item_delete": "удаление предмета",
+    "admin_reset": "сброс через апанель", "clear_shop": "очистка магазина",
+    "worldbank_withdraw": "снятие из казны", "worldbank_deposit": "пополнение казны",
+    "restore": "восстановление из снимка",
+}
+
+def _journal_entry_line(entry: dict, id2name: dict[int, str]) -> str:
+    amount = int(entry["amount"])
+    if entry["kind"] == JOURNAL_MONEY_SET:
+        what = f"баланс = {format_number(amount)} {MONEY_EMOJI}"
+    elif entry["kind"] == JOURNAL_ITEM:
+        name = id2name.get(entry["item_id"], f"предмет #{entry['item_id']}")
+        what = f"{'+' if amount > 0 else '−'}{format_number(abs(amount))} × {name}"
+    else:
+        what = f"{'+' if amount > 0 else '−'}{format_number(abs(amount))} {MONEY_EMOJI}"
+    reason = JOURNAL_REASON_TITLES.get(entry["reason"] or "", entry["reason"] or "—")
+    return f"<t:{entry['ts']}:d> <t:{entry['ts']}:t> • {what} • {reason}"
+
+class HistoryView(disnake.ui.View):
+    """Листание журнала участника: курсор (ts, id) на каждую открытую страницу, без OFFSET."""
+
+    def __init__(self, ctx: commands.Context, member: disnake.Member):
+        super().__init__(timeout=120)
+        self.ctx = ctx
+        self.member = member
+        self.page = 1
+        self.has_next = False
+        # page -> курсор (ts, id) последней строки предыдущей страницы
+        self._anchors: dict[int, Optional[tuple[int, int]]] = {1: None}
+        self.message: Optional[disnake.Message] = None
+
+    async def make_embed(self) -> disnake.Embed:
+        rows = await db_run(db_get_journal_page, self.ctx.guild.id, self.member.id,
+                            self._anchors[self.page], JOURNAL_PAGE_SIZE + 1)
+        self.has_next = len(rows) > JOURNAL_PAGE_SIZE
+        rows = rows[:JOURNAL_PAGE_SIZE]
+        if self.has_next:
+            self._anchors[self.page + 1] = (rows[-1]["ts"], rows[-1]["id"])
+
+        id2name = await db_run(item_names_map, self.ctx.guild.id)
+        e = disnake.Embed(
+            title=f"История операций: {self.member.display_name}",
+            description="\n".join(_journal_entry_line(r, id2name) for r in rows) or "Операций пока нет.",
+            color=disnake.Color.blurple(),
+        )
+        e.set_thumbnail(url=self.member.display_avatar.url)
+        e.set_footer(text=f"Страница {self.page}")
+        self.back.disabled = self.page <= 1
+        self.forward.disabled = not self.has_next
+        return e
+
+    async def interaction_check(self, inter: disnake.MessageInteraction) -> bool:
+        if inter.user.id != self.ctx.author.id:
+            await inter.response.send_message("Только автор команды может листать страницы.", ephemeral=True)
+            return False
+        return True
+
+    @disnake.ui.button(label="Назад", emoji="⬅️", style=disnake.ButtonStyle.secondary)
+    async def back(self, button: disnake.ui.Button, inter: disnake.MessageInteraction):
+        self.page = max(1, self.page - 1)
+        await inter.response.edit_message(embed=await self.make_embed(), view=self)
+
+    @disnake.ui.button(label="Вперед", emoji="➡️", style=disnake.ButtonStyle.secondary)
+    async def forward(self, button: disnake.ui.Button, inter: disnake.MessageInteraction):
+        if self.has_next:
+            self.page += 1
+        await inter.response.edit_message(embed=await self.make_embed(), view=self)
+
+    async def on_timeout(self):
+        for child in self.children:
+            if isinstance(child, disnake.ui.Button):
+                child.disabled = True
+        with contextlib.suppress(Exception):
+            if self.message:
+                await self.message.edit(view=self)
+
+@bot.command(name="history", aliases=["History", "HISTORY", "история", "История"])
+async def history_cmd(ctx: commands.Context, member: Optional[disnake.Member] = None):
+    """
+    История движений денег и предметов:
+      !history               — своя
+      !history @пользователь — чужая (ALLOWED_HISTORY)
+    """
+    if not ctx.guild:
+        return await ctx.send("Команда доступна только на сервере.")
+    member = member or ctx.author
+    if member.id != ctx.author.id and not await ensure_allowed_ctx(ctx, ALLOWED_HISTORY):
+        return
+    view = HistoryView(ctx, member)
+    view.message = await ctx.send(embed=await view.make_embed(), view=view)
+
+# ======== Снимки экономики (!snapshot, !snapshots, !restore-snapshot) ========
+@bot.command(name="snapshot")
+async def snapshot_cmd(ctx: commands.Context):
+    """Снять снимок базы сейчас: !snapshot"""
+    if not ctx.guild:
+        return await ctx.send("Команда доступна только на сервере.")
+    if not _apanel_is_admin(ctx.author):
+        return await ctx.send(embed=error_embed("Недостаточно прав", "Эта команда доступна только администраторам."))
+    try:
+        name = await take_snapshot("manual")
+    except Exception as e:
+        return await ctx.send(embed=error_embed("Ошибка", f"Не удалось снять снимок: {e}"))
+    await ctx.send(f"✅ Снимок `{name}` ({SNAPSHOT_STATS['last_bytes'] / 1024:.0f} КБ, {SNAPSHOT_STATS['last_ms']:.0f} мс).")
+
+@bot.command(name="snapshots")
+async def snapshots_cmd(ctx: commands.Context):
+    """Список снимков: !snapshots"""
+    if not ctx.guild:
+        return await ctx.send("Команда доступна только на сервере.")
+    if not _apanel_is_admin(ctx.author):
+        return await ctx.send(embed=error_embed("Недостаточно прав", "Эта команда доступна только администраторам."))
+    snaps = await asyncio.to_thread(list_snapshots)
+    lines = [f"{i}. `{name}` • {size / 1024:.0f} КБ" for i, (name, size, _) in enumerate(snaps[:20], start=1)]
+    e = disnake.Embed(
+        title="Снимки базы",
+        description="\n".join(lines) or "Снимков пока нет.",
+        color=disnake.Color.blurple(),
+    )
+    e.set_footer(text=f"Восстановить сервер: !restore-snapshot <номер или имя> • плановых хранится {SNAPSHOT_KEEP_SCHEDULED}, остальных — по {SNAPSHOT_KEEP} на метку")
+    await ctx.send(embed=e)
+
+@bot.command(name="restore-snapshot")
+async def restore_snapshot_cmd(ctx: commands.Context, ref: str):
+    """
+    Вернуть экономику этого сервера к снимку (другие серверы не затрагиваются):
+      !restore-snapshot <номер из !snapshots | имя файла>
+    """
+    if not ctx.guild:
+        return await ctx.send("Команда доступна только на сервере.")
+    if not _apanel_is_admin(ctx.author):
+        return await ctx.send(embed=error_embed("Недостаточно прав", "Эта команда доступна только администраторам."))
+    path = await asyncio.to_thread(resolve_snapshot, ref)
+    if not path:
+        return await ctx.send(embed=error_embed("Снимок не найден", "Смотрите список: !snapshots"))
+
+    async def do_confirm(_i: disnake.MessageInteraction):
+        restored = await db_run(db_restore_guild_from_snapshot, path, _i.guild.id)
+        details = "; ".join(f"{t}: {n}" for t, n in restored.items())
+        await send_admin_action_log(_i.guild, _i.user, "restore_snapshot",
+                                    f"Снимок: {os.path.basename(path)}; {details}")
+        return f"✅ Состояние сервера восстановлено из `{os.path.basename(path)}`. Строк: {details}"
+
+    view = AdminConfirmView(ctx, "restore", do_confirm)
+    await ctx.send(
+        f"Вернуть балансы, инвентари, казну, магазин и доходные роли сервера к снимку "
+        f"`{os.path.basename(path)}`? Текущее состояние будет сохранено отдельным снимком.",
+        view=view,
+    )
+
 # >>> ВСТАВИТЬ В РАЗДЕЛ КОМАНД
 
 @bot.command(name="apanel")
@@ -8292,71 +10490,67 @@ BUMP_REMINDER_BOT_ID = 478321260481478677
 SERVER_MONITORING_BOT_ID = 315926021457051650
 SUPPORTED_BUMP_BOT_IDS = {BUMP_REMINDER_BOT_ID, SERVER_MONITORING_BOT_ID}
 
-def setup_bump_tables():
-    """Создаём таблицы для настроек и логов наград за бамп."""
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS bump_reward_settings (
-            guild_id INTEGER PRIMARY KEY,
-            enabled INTEGER NOT NULL DEFAULT 0,
-            amount INTEGER NOT NULL DEFAULT 0
-        )
-    """)
-    c.execute("""
-        CREATE TABLE IF NOT EXISTS bump_reward_awards (
-            guild_id INTEGER NOT NULL,
-            message_id INTEGER PRIMARY KEY,
-            awarded_user_id INTEGER NOT NULL,
-            awarded_ts INTEGER NOT NULL
-        )
-    """)
-    conn.commit()
-    conn.close()
-
 def db_get_bump_settings(guild_id: int) -> tuple[int, int]:
     """Возвращает (enabled, amount)."""
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("SELECT enabled, amount FROM bump_reward_settings WHERE guild_id = ?", (guild_id,))
-    row = c.fetchone()
-    if not row:
-        # создадим дефолт
-        c.execute("INSERT OR IGNORE INTO bump_reward_settings (guild_id, enabled, amount) VALUES (?, ?, ?)", (guild_id, 0, 0))
-        conn.commit()
-        conn.close()
-        return 0, 0
-    conn.close()
+    with db_writer() as conn:
+        c = conn.cursor()
+        c.execute("SELECT enabled, amount FROM bump_reward_settings WHERE guild_id = ?", (guild_id,))
+        row = c.fetchone()
+        if not row:
+            # создадим дефолт
+            c.execute("INSERT OR IGNORE INTO bump_reward_settings (guild_id, enabled, amount) VALUES (?, ?, ?)", (guild_id, 0, 0))
+            conn.commit()
+            return 0, 0
     return int(row[0]), int(row[1])
 
+# guild_id -> (enabled, amount): слушатель сообщений читает настройки отсюда, без БД
+_bump_settings_cache: dict[int, tuple[int, int]] = {}
+_bump_settings_version = 0  # растёт после каждой записи настроек
+
+def get_bump_settings_cached(guild_id: int) -> tuple[int, int]:
+    cached = _bump_settings_cache.get(guild_id)
+    if cached is None:
+        version = _bump_settings_version
+        cached = db_get_bump_settings(guild_id)
+        # если пока читали, настройки успели изменить — не кладём устаревшее
+        if _bump_settings_version == version:
+            _bump_settings_cache[guild_id] = cached
+    return cached
+
+def _invalidate_bump_settings(guild_id: int):
+    """Вызывать после commit: сначала версия, потом сброс — параллельное чтение не закэширует старое."""
+    global _bump_settings_version
+    _bump_settings_version += 1
+    _bump_settings_cache.pop(guild_id, None)
+
 def db_set_bump_enabled(guild_id: int, enabled: bool):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO bump_reward_settings (guild_id, enabled, amount)
-        VALUES (?, ?, COALESCE((SELECT amount FROM bump_reward_settings WHERE guild_id = ?), 0))
-        ON CONFLICT(guild_id) DO UPDATE SET enabled = excluded.enabled
-    """, (guild_id, 1 if enabled else 0, guild_id))
-    conn.commit()
-    conn.close()
+    with db_writer() as conn:
+        c = conn.cursor()
+        c.execute("""
+            INSERT INTO bump_reward_settings (guild_id, enabled, amount)
+            VALUES (?, ?, COALESCE((SELECT amount FROM bump_reward_settings WHERE guild_id = ?), 0))
+            ON CONFLICT(guild_id) DO UPDATE SET enabled = excluded.enabled
+        """, (guild_id, 1 if enabled else 0, guild_id))
+        conn.commit()
+    _invalidate_bump_settings(guild_id)
 
 def db_set_bump_amount(guild_id: int, amount: int):
-    conn = sqlite3.connect(get_db_path())
-    c = conn.cursor()
-    c.execute("""
-        INSERT INTO bump_reward_settings (guild_id, enabled, amount)
-        VALUES (?, COALESCE((SELECT enabled FROM bump_reward_settings WHERE guild_id = ?), 0), ?)
-        ON CONFLICT(guild_id) DO UPDATE SET amount = excluded.amount
-    """, (guild_id, guild_id, int(amount)))
-    conn.commit()
-    conn.close()
+    with db_writer() as conn:
+        c = conn.cursor()
+        c.execute("""
+            INSERT INTO bump_reward_settings (guild_id, enabled, amount)
+            VALUES (?, COALESCE((SELECT enabled FROM bump_reward_settings WHERE guild_id = ?), 0), ?)
+            ON CONFLICT(guild_id) DO UPDATE SET amount = excluded.amount
+        """, (guild_id, guild_id, int(amount)))
+        conn.commit()
+    _invalidate_bump_settings(guild_id)
 
 def db_mark_bump_awarded(guild_id: int, message_id: int, user_id: int) -> bool:
     """
     Пишем лог выдачи по message_id. Если такая запись уже есть — вернём False (не выдавать повторно).
     """
     import time as _time
-    conn = sqlite3.connect(get_db_path())
+    conn = db_connect()
     c = conn.cursor()
     try:
         c.execute("""
@@ -8408,8 +10602,8 @@ class BumpRewardAmountModal(disnake.ui.Modal):
                 embed=error_embed("Ошибка", str(e)),
                 ephemeral=True
             )
-        db_set_bump_amount(inter.guild.id, amount)
-        await inter.response.edit_message(embed=_build_bump_settings_embed(inter.guild, inter.user), view=self.view_ref)
+        await db_run(db_set_bump_amount, inter.guild.id, amount)
+        await inter.response.edit_message(embed=await db_run(_build_bump_settings_embed, inter.guild, inter.user), view=self.view_ref)
 
 class BumpRewardView(disnake.ui.View):
     def __init__(self, ctx: commands.Context):
@@ -8435,10 +10629,10 @@ class BumpRewardView(disnake.ui.View):
 
     @disnake.ui.button(label="Включить", style=disnake.ButtonStyle.success, custom_id="bump_toggle", row=0)
     async def _toggle(self, btn: disnake.ui.Button, inter: disnake.MessageInteraction):
-        enabled, amount = db_get_bump_settings(inter.guild.id)
-        db_set_bump_enabled(inter.guild.id, not bool(enabled))
+        enabled, amount = await db_run(db_get_bump_settings, inter.guild.id)
+        await db_run(db_set_bump_enabled, inter.guild.id, not bool(enabled))
         self._sync_toggle_label()
-        await inter.response.edit_message(embed=_build_bump_settings_embed(inter.guild, inter.user), view=self)
+        await inter.response.edit_message(embed=await db_run(_build_bump_settings_embed, inter.guild, inter.user), view=self)
 
     @disnake.ui.button(label="Награда", style=disnake.ButtonStyle.primary, custom_id="bump_amount", row=0)
     async def _amount(self, btn: disnake.ui.Button, inter: disnake.MessageInteraction):
@@ -8467,14 +10661,125 @@ async def set_money_bump_cmd(ctx: commands.Context):
     if not ctx.guild:
         return await ctx.send("Команда доступна только на сервере.")
     view = BumpRewardView(ctx)
-    embed = _build_bump_settings_embed(ctx.guild, ctx.author)
+    embed = await db_run(_build_bump_settings_embed, ctx.guild, ctx.author)
     msg = await ctx.send(embed=embed, view=view)
     view.message = msg
 
-@bot.listen("on_ready")
-async def _bump_on_ready():
-    setup_bump_tables()
-    print("Таблицы Bump Reward готовы.")
+# ======== Индекс участников по имени ========
+# Поиск участника по нику/отображаемому имени без перебора guild.members.
+# Индекс строится лениво при первом запросе и дальше поддерживается событиями
+# on_member_join/remove/update и on_user_update; on_guild_available сбрасывает его
+# (кэш участников мог догрузиться чанками без событий join).
+class MemberNameIndex:
+    def __init__(self, guild: disnake.Guild):
+        self.guild_id = guild.id
+        # ключ -> упорядоченное множество user_id (dict сохраняет порядок добавления)
+        self.exact: dict[str, dict[int, None]] = {}
+        self.folded: dict[str, dict[int, None]] = {}
+        self._keys: dict[int, tuple[tuple[str, ...], tuple[str, ...]]] = {}
+        for member in guild.members:
+            self.add(member)
+
+    @staticmethod
+    def _names(member: disnake.Member) -> tuple[tuple[str, ...], tuple[str, ...]]:
+        exact = tuple(dict.fromkeys(n for n in (member.name, member.display_name) if n))
+        folded = tuple(dict.fromkeys(n.casefold() for n in exact))
+        return exact, folded
+
+    def add(self, member: disnake.Member):
+        self.remove(member.id)
+        exact, folded = self._names(member)
+        for key in exact:
+            self.exact.setdefault(key, {})[member.id] = None
+        for key in folded:
+            self.folded.setdefault(key, {})[member.id] = None
+        self._keys[member.id] = (exact, folded)
+
+    def remove(self, user_id: int):
+        keys = self._keys.pop(user_id, None)
+        if keys is None:
+            return
+        for table, names in ((self.exact, keys[0]), (self.folded, keys[1])):
+            for key in names:
+                ids = table.get(key)
+                if ids is not None:
+                    ids.pop(user_id, None)
+                    if not ids:
+                        del table[key]
+
+    def __len__(self):
+        return len(self._keys)
+
+_member_name_index: dict[int, MemberNameIndex] = {}
+
+def get_member_name_index(guild: disnake.Guild) -> MemberNameIndex:
+    index = _member_name_index.get(guild.id)
+    if index is None:
+        index = _member_name_index[guild.id] = MemberNameIndex(guild)
+    return index
+
+def find_member_by_name(guild: disnake.Guild, name: str) -> Optional[disnake.Member]:
+    """
+    Участник по точному нику/отображаемому имени; иначе — по регистронезависимому,
+    но только если такой участник один (неоднозначность -> None).
+    """
+    name = (name or "").strip()
+    if not name:
+        return None
+    index = get_member_name_index(guild)
+    for uid in index.exact.get(name, ()):
+        member = guild.get_member(uid)
+        if member is not None:
+            return member
+    ids = index.folded.get(name.casefold())
+    if ids and len(ids) == 1:
+        return guild.get_member(next(iter(ids)))
+    return None
+
+@bot.listen("on_member_join")
+async def _name_index_on_join(member: disnake.Member):
+    index = _member_name_index.get(member.guild.id)
+    if index is not None:
+        index.add(member)
+
+@bot.listen("on_member_remove")
+async def _name_index_on_remove(member: disnake.Member):
+    index = _member_name_index.get(member.guild.id)
+    if index is not None:
+        index.remove(member.id)
+
+@bot.listen("on_member_update")
+async def _name_index_on_member_update(before: disnake.Member, after: disnake.Member):
+    if before.name == after.name and before.display_name == after.display_name:
+        return
+    index = _member_name_index.get(after.guild.id)
+    if index is not None:
+        index.add(after)
+
+@bot.listen("on_user_update")
+async def _name_index_on_user_update(before: disnake.User, after: disnake.User):
+    if before.name == after.name and getattr(before, "global_name", None) == getattr(after, "global_name", None):
+        return
+    for gid, index in _member_name_index.items():
+        guild = bot.get_guild(gid)
+        member = guild.get_member(after.id) if guild else None
+        if member is not None:
+            index.add(member)
+
+@bot.listen("on_guild_available")
+async def _name_index_on_guild_available(guild: disnake.Guild):
+    _member_name_index.pop(guild.id, None)
+
+@bot.listen("on_guild_remove")
+async def _name_index_on_guild_remove(guild: disnake.Guild):
+    _member_name_index.pop(guild.id, None)
+
+_BUMP_MENTION_RE = re.compile(r"<@!?(\d+)>")
+_BUMP_AVATAR_ID_RE = re.compile(r"/avatars/(\d+)/")
+_BUMP_BY_RE = re.compile(r"server\s+bumped\s+by\s+(<@!?\d+>|@?[^\s\n]+)", re.IGNORECASE)
+
+def _bump_message_text(message: disnake.Message) -> str:
+    return (message.content or "") + "\n" + _extract_text_from_embeds(message.embeds or [])
 
 def _extract_text_from_embeds(embeds: list[disnake.Embed]) -> str:
     """Собираем текст из эмбедов: title/description/fields."""
@@ -8490,7 +10795,7 @@ def _extract_text_from_embeds(embeds: list[disnake.Embed]) -> str:
     return "\n".join(parts)
 
 # ЗАМЕНИТЬ целиком функцию на эту (совместима с прежней логикой)
-def _try_extract_user_from_bump_message(message: disnake.Message) -> disnake.Member | None:
+def _try_extract_user_from_bump_message(message: disnake.Message, text: Optional[str] = None) -> disnake.Member | None:
     """
     Пытаемся понять, кто бампнул сервер, по сообщению от поддерживаемых ботов.
     Стратегии:
@@ -8503,7 +10808,7 @@ def _try_extract_user_from_bump_message(message: disnake.Message) -> disnake.Mem
     if not guild:
         return None
 
-    combined_text = (message.content or "") + "\n" + _extract_text_from_embeds(message.embeds or [])
+    combined_text = text if text is not None else _bump_message_text(message)
 
     # 1) Явные упоминания в самом сообщении
     if message.mentions:
@@ -8511,7 +10816,7 @@ def _try_extract_user_from_bump_message(message: disnake.Message) -> disnake.Mem
         return guild.get_member(m.id) if hasattr(m, "id") else None
 
     # 2) Парсим упоминания вида <@id> внутри текста/эмбедов
-    m = re.search(r"<@!?(\d+)>", combined_text)
+    m = _BUMP_MENTION_RE.search(combined_text)
     if m:
         uid = int(m.group(1))
         mem = guild.get_member(uid)
@@ -8522,19 +10827,14 @@ def _try_extract_user_from_bump_message(message: disnake.Message) -> disnake.Mem
     if message.embeds:
         em = message.embeds[0]
         if em.author and em.author.name:
-            name = em.author.name.strip()
-            for member in guild.members:
-                if member.name == name or member.display_name == name:
-                    return member
-            name_low = name.casefold()
-            candidates = [m for m in guild.members if (m.name or "").casefold() == name_low or (m.display_name or "").casefold() == name_low]
-            if len(candidates) == 1:
-                return candidates[0]
+            member = find_member_by_name(guild, em.author.name)
+            if member:
+                return member
         # 3.1 user_id из icon_url
         try:
             icon_url = getattr(em.author, "icon_url", None) or getattr(em.author, "icon", None)
             icon_url = str(icon_url) if icon_url else ""
-            m2 = re.search(r"/avatars/(\d+)/", icon_url)
+            m2 = _BUMP_AVATAR_ID_RE.search(icon_url)
             if m2:
                 uid = int(m2.group(1))
                 mem = guild.get_member(uid)
@@ -8544,36 +10844,28 @@ def _try_extract_user_from_bump_message(message: disnake.Message) -> disnake.Mem
             pass
 
     # 4) Fallback для Server Monitoring: "Server bumped by ..."
-    #    Сначала смотрим, есть ли вообще триггерная фраза (на всякий случай)
-    if message.author.id == SERVER_MONITORING_BOT_ID and re.search(r"server\s+bumped\s+by\s+", combined_text, flags=re.I):
-        # Пытаемся выцепить либо <@id>, либо @ник после фразы
-        m = re.search(r"server\s+bumped\s+by\s+(<@!?\d+>|@?[^\s\n]+)", combined_text, flags=re.I)
+    #    Пытаемся выцепить либо <@id>, либо @ник после фразы
+    if message.author.id == SERVER_MONITORING_BOT_ID:
+        m = _BUMP_BY_RE.search(combined_text)
         if m:
             token = m.group(1).strip()
             # Если это mention — уже обработали бы выше, но на всякий случай:
-            m_id = re.search(r"<@!?(\d+)>", token)
+            m_id = _BUMP_MENTION_RE.search(token)
             if m_id:
                 uid = int(m_id.group(1))
                 mem = guild.get_member(uid)
                 if mem:
                     return mem
             # Иначе пробуем как ник
-            name = token.lstrip("@").strip()
-            if name:
-                # Сначала точное совпадение
-                for member in guild.members:
-                    if member.name == name or member.display_name == name:
-                        return member
-                # Потом регистронезависимое
-                name_low = name.casefold()
-                candidates = [memb for memb in guild.members if (memb.name or "").casefold() == name_low or (memb.display_name or "").casefold() == name_low]
-                if len(candidates) == 1:
-                    return candidates[0]
+            # Сначала точное совпадение, потом регистронезависимое (только однозначное)
+            member = find_member_by_name(guild, token.lstrip("@"))
+            if member:
+                return member
 
     return None
 
 # ЗАМЕНИТЬ целиком функцию
-def _is_probably_success_bump_message(message: disnake.Message) -> bool:
+def _is_probably_success_bump_message(message: disnake.Message, text: Optional[str] = None) -> bool:
     """
     Проверяет, что сообщение — успех бампа для поддерживаемых ботов.
 
@@ -8582,8 +10874,7 @@ def _is_probably_success_bump_message(message: disnake.Message) -> bool:
     Server Monitoring:
       - содержит "Server bumped by"
     """
-    text = (message.content or "") + "\n" + _extract_text_from_embeds(message.embeds or [])
-    tl = text.lower()
+    tl = (text if text is not None else _bump_message_text(message)).lower()
 
     if message.author.id == BUMP_REMINDER_BOT_ID:
         return ("запущенная команда" in tl and "/bump" in tl) or ("время реакции" in tl)
@@ -8612,30 +10903,37 @@ async def bump_reward_listener(message: disnake.Message):
       - это сообщение похоже на успешный бамп
       - ещё не награждали по данному message.id
     """
+    # Проверки от дешёвых к дорогим: обычный трафик отсекается первым сравнением
+    if message.author.id not in SUPPORTED_BUMP_BOT_IDS:
+        return
+    if not message.embeds or not message.guild:
+        return
     try:
-        if not message.guild:
-            return
-        if message.author.id not in SUPPORTED_BUMP_BOT_IDS:
-            return
-        enabled, amount = db_get_bump_settings(message.guild.id)
+        settings = _bump_settings_cache.get(message.guild.id)
+        if settings is None:
+            settings = await db_run(get_bump_settings_cached, message.guild.id)
+        enabled, amount = settings
         if not enabled or amount <= 0:
             return
-        if not message.embeds:
-            return
-        if not _is_probably_success_bump_message(message):
+        text = _bump_message_text(message)
+        if not _is_probably_success_bump_message(message, text):
             return
 
-        member = _try_extract_user_from_bump_message(message)
+        member = _try_extract_user_from_bump_message(message, text)
         if not member:
             # Не удалось однозначно определить — не начисляем, чтобы не ошибиться.
             return
 
+        # Старые сообщения не награждаем: их message_id мог уже уйти из bump_reward_awards при очистке
+        if time.time() - disnake.utils.snowflake_time(message.id).timestamp() > BUMP_AWARD_MAX_AGE_SECONDS:
+            return
+
         # Идемпотентность по message_id
-        if not db_mark_bump_awarded(message.guild.id, message.id, member.id):
+        if not await db_run(db_mark_bump_awarded, message.guild.id, message.id, member.id):
             return  # уже обработано
 
         # Начисление
-        update_balance(message.guild.id, member.id, amount)
+        await db_run(update_balance, message.guild.id, member.id, amount, "bump")
 
         # Сообщение о начислении
         await message.channel.send(embed=_build_award_embed(message.guild, member, amount))
@@ -8662,7 +10960,7 @@ async def collect_cmd(ctx: commands.Context):
     member: disnake.Member = ctx.author
     now = int(time.time())
 
-    incomes = db_get_role_incomes(ctx.guild.id)
+    incomes = await db_run(db_get_role_incomes, ctx.guild.id)
     if not incomes:
         return await ctx.send(embed=error_embed("Нет доходных ролей", "На сервере ещё не настроены доходные роли."))
 
@@ -8672,17 +10970,9 @@ async def collect_cmd(ctx: commands.Context):
     if not eligible:
         return await ctx.send(embed=error_embed("Нет подходящих ролей", "У вас нет ролей, дающих доход."))
 
-    ready: list[dict] = []
-    cooling: list[tuple[dict, int]] = []  # (ri, remaining_sec)
-
-    for ri in eligible:
-        last = db_get_ri_last_ts(ctx.guild.id, ri["role_id"], member.id)
-        cd = int(ri["cooldown_seconds"] or 0)
-        if not last or last + cd <= now:
-            ready.append(ri)
-        else:
-            remaining = (last + cd) - now
-            cooling.append((ri, remaining))
+    # Проверка кулдаунов и выдача — одна транзакция
+    result = await db_run(db_collect_role_incomes, ctx.guild.id, member.id, eligible, now)
+    ready, cooling = result.ready, result.cooling
 
     if not ready:
         # Показать эмбед с таймерами
@@ -8700,17 +10990,16 @@ async def collect_cmd(ctx: commands.Context):
         e.set_footer(text=f"{ctx.guild.name} • {footer_time}", icon_url=server_icon)
         return await ctx.send(embed=e)
 
-    # Выдаём доход
-    total_money = 0
+    # Доход уже выдан — формируем строки отчёта
+    total_money = result.total_money
     money_lines = []
     item_lines = []
-    id2name = items_id_to_name_map(ctx.guild)
+    id2name = await db_run(items_id_to_name_map, ctx.guild)
 
     for ri in ready:
         if ri["income_type"] == "money":
             amt = int(ri["money_amount"] or 0)
             if amt > 0:
-                total_money += amt
                 money_lines.append(f"<@&{ri['role_id']}> → {format_number(amt)} {MONEY_EMOJI} (cash)")
         else:
             # Предметы
@@ -8722,7 +11011,6 @@ async def collect_cmd(ctx: commands.Context):
                 qty = int(it["qty"])
                 if qty <= 0:
                     continue
-                add_items_to_user(ctx.guild.id, member.id, iid, qty)
                 sub_lines.append(f"{id2name.get(iid, f'ID {iid}')} {qty} (item)")
             if sub_lines:
                 if len(sub_lines) == 1:
@@ -8730,12 +11018,6 @@ async def collect_cmd(ctx: commands.Context):
                 else:
                     item_lines.append(f"<@&{ri['role_id']}> →:\n" + "\n".join(f" {ln}" for ln in sub_lines))
 
-        # зафиксировать кулдаун для этой роли
-        db_set_ri_last_ts(ctx.guild.id, ri["role_id"], member.id, now)
-
-    if total_money > 0:
-        update_balance(ctx.guild.id, member.id, total_money)
-
     # Собираем эмбед результата
     e = disnake.Embed(
         title=":ballot_box_with_check: Доход с ролей получен!",
@@ -8792,4 +11074,8 @@ async def on_command_error(ctx: commands.Context, error):
 
 
 if __name__ == "__main__":
-    bot.run(TOKEN)
+    run_migrations()
+    try:
+        bot.run(TOKEN)
+    finally:
+        flush_balances()